@@ -0,0 +1,87 @@
+"""
+Sets of areas of interest with a spatial index
+
+An AOI set holds every feature of a GeoJSON FeatureCollection, or of all
+GeoJSON files in a directory, in EPSG:4326, indexed with an STRtree so
+the AOIs touching a tile footprint are found without testing each one.
+"""
+import re
+import logging
+from pathlib import Path
+from typing import Any, Iterator, List, NamedTuple, Tuple, Union
+from shapely.geometry import box, shape
+from shapely.strtree import STRtree
+
+from src.auxiliary.read_geojson import read_geojson
+
+class AOI(NamedTuple):
+    name: str
+    geometry: Any  # Shapely geometry in EPSG:4326
+
+def safe_name(name: str) -> str:
+    """AOI name usable in file names"""
+    return re.sub(r'[^\w-]+', '_', str(name)).strip('_') or 'aoi'
+
+class AOISet:
+    def __init__(self, aois: List[AOI]):
+        self.aois = aois
+        self.tree = STRtree([aoi.geometry for aoi in aois])
+
+    @classmethod
+    def from_path(cls, path: Union[str, Path], name_field: str = 'name') -> "AOISet":
+        """
+        Load every AOI feature of a GeoJSON file, or of all GeoJSON files in a directory
+
+        AOIs are named after the name_field property of their feature, or
+        after their file (with the feature number when a file holds several).
+
+        Args:
+            path: GeoJSON file or directory of GeoJSON files
+            name_field: Feature property holding the AOI name
+
+        Returns:
+            AOISet: The AOIs, possibly empty
+        """
+        path = Path(path)
+        files = sorted(path.glob('*.geojson')) if path.is_dir() else [path]
+
+        aois = []
+        names = set()
+        for geojson_file in files:
+            geojson_data = read_geojson(geojson_file)
+            if not geojson_data:
+                logging.error(f"Failed to read GeoJSON file {geojson_file}")
+                continue
+            features = geojson_data.get('features', [geojson_data])
+            for i, feature in enumerate(features):
+                if not feature.get('geometry'):
+                    continue
+                properties = feature.get('properties') or {}
+                name = properties.get(name_field) or (
+                    geojson_file.stem if len(features) == 1 else f"{geojson_file.stem}_{i}")
+                name = base = safe_name(name)
+                # Suffixed names may be taken too: clips are written per AOI name
+                suffix = i
+                while name in names:
+                    name = f"{base}_{suffix}"
+                    suffix += 1
+                names.add(name)
+                aois.append(AOI(name, shape(feature['geometry'])))
+
+        logging.info(f"Loaded {len(aois)} AOIs from {path}")
+        return cls(aois)
+
+    def __len__(self) -> int:
+        return len(self.aois)
+
+    def __iter__(self) -> Iterator[AOI]:
+        return iter(self.aois)
+
+    def intersecting(self, footprint) -> List[AOI]:
+        """AOIs intersecting a footprint geometry in EPSG:4326"""
+        candidates = self.tree.query(footprint, predicate='intersects')
+        return [self.aois[i] for i in sorted(candidates)]
+
+    def intersecting_bounds(self, bounds: Tuple[float, float, float, float]) -> List[AOI]:
+        """AOIs intersecting a (min_x, min_y, max_x, max_y) box in EPSG:4326"""
+        return self.intersecting(box(*bounds))
@@ -1,13 +1,35 @@
 import os
+import json
 import logging
 import pickle
+import threading
 import rasterio
 import numpy as np
+from affine import Affine
+from collections import OrderedDict
+from collections.abc import Mapping
 from pathlib import Path
-from typing import Dict, List, Optional
+from rasterio.crs import CRS
+from rasterio.windows import Window
+from typing import Any, Dict, Iterator, List, Optional, Union
 
-def find_band_file(img_data_dir: Path, band: str, resolution: str) -> Optional[Path]:
-    """Find band file using glob pattern matching"""
+from src.auxiliary.safe_index import SafeIndex, RESOLUTIONS
+
+# Backends selected by preprocessing.output_format
+BAND_STORE_FORMATS = ('pickle', 'npy')
+
+def find_band_file(img_data_dir: Path, band: str, resolution: str,
+                   index: Optional[SafeIndex] = None) -> Optional[Path]:
+    """Find band file in the SAFE index if given, else using glob pattern matching"""
+    if index is not None:
+        product_dir = img_data_dir.parents[3]
+        product_name = index.index(product_dir)
+        band_files = index.band_paths(product_name, [band], resolution) if product_name else {}
+        if band in band_files:
+            logging.info(f"Found {band} in: {Path(band_files[band]).name}")
+            return Path(band_files[band])
+        return None
+    
     # Search for files containing band name in filename
     pattern = f'*{band}*.jp2'
     matches = list(img_data_dir.glob(pattern))
@@ -17,80 +39,351 @@ def find_band_file(img_data_dir: Path, band: str, resolution: str) -> Optional[P
         return matches[0]
     return None
 
-def read_sentinel_bands(l2_dir: str, bands: Optional[List[str]] = None) -> Dict[str, Dict[str, rasterio.DatasetReader]]:
+def find_img_data(product_dir: Path) -> Optional[Path]:
+    """IMG_DATA directory of a SAFE product, looked up at its fixed depth first"""
+    img_data = next(product_dir.glob('GRANULE/*/IMG_DATA'), None)
+    if img_data is None:
+        # Non-standard layouts only
+        img_data = next(product_dir.glob('**/IMG_DATA'), None)
+    return img_data
+
+def index_band_files(img_data: Path, bands: List[str]) -> Dict[str, Path]:
+    """
+    Map band names to band files with one directory listing per resolution
+    
+    Bands are taken from the finest resolution directory that has them.
+    """
+    band_files = {}
+    for res in RESOLUTIONS:
+        res_dir = img_data / res
+        if not res_dir.is_dir():
+            continue
+        jp2_files = sorted(entry.name for entry in os.scandir(res_dir) if entry.name.endswith('.jp2'))
+        for band in bands:
+            if band not in band_files:
+                match = next((name for name in jp2_files if band in name), None)
+                if match:
+                    band_files[band] = res_dir / match
+    return band_files
+
+class HandlePool:
+    """
+    LRU-bounded pool of open rasterio datasets
+    
+    At most max_open datasets are open at a time; opening another one
+    closes the least recently used. close() closes everything.
+    """
+    def __init__(self, max_open: int = 64):
+        self.max_open = max_open
+        self._handles: "OrderedDict[str, rasterio.DatasetReader]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, path: Path) -> rasterio.DatasetReader:
+        """Open dataset for path, reusing a pooled handle when possible"""
+        key = str(path)
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is not None and not handle.closed:
+                self._handles.move_to_end(key)
+                return handle
+            while len(self._handles) >= self.max_open:
+                _, oldest = self._handles.popitem(last=False)
+                oldest.close()
+            handle = rasterio.open(key)
+            self._handles[key] = handle
+            return handle
+    
+    def __len__(self) -> int:
+        return len(self._handles)
+    
+    def close(self) -> None:
+        with self._lock:
+            for handle in self._handles.values():
+                handle.close()
+            self._handles.clear()
+
+class ProductBands(Mapping):
+    """{band_name: rasterio.DatasetReader} view of a product, opening bands through the pool"""
+    def __init__(self, paths: Dict[str, Path], pool: HandlePool):
+        self.paths = paths
+        self.pool = pool
+    
+    def __getitem__(self, band: str) -> rasterio.DatasetReader:
+        return self.pool.get(self.paths[band])
+    
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.paths)
+    
+    def __len__(self) -> int:
+        return len(self.paths)
+
+class ProductCatalog(Mapping):
+    """
+    Lazy catalog of L2A products: {product_name: {band_name: rasterio.DatasetReader}}
+    
+    Band paths are indexed once by scan(), from the SAFE index when one is
+    given; datasets are only opened when a band is accessed, through an LRU-bounded HandlePool, and are all closed
+    by close() or on leaving a with block. A handle may be closed once
+    max_open other bands have been accessed, so look bands up again rather
+    than keeping readers around.
+    """
+    def __init__(self,
+                 l2_dir: Union[str, Path],
+                 bands: Optional[List[str]] = None,
+                 max_open: int = 64,
+                 index: Optional[SafeIndex] = None):
+        self.l2_dir = Path(l2_dir)
+        self.bands = bands or ['B02', 'B03', 'B04', 'B08']
+        self.pool = HandlePool(max_open)
+        self.index = index
+        self.band_paths: Dict[str, Dict[str, Path]] = {}
+    
+    def scan(self) -> "ProductCatalog":
+        """Index the band paths of every product directory under l2_dir"""
+        for product_dir in sorted(self.l2_dir.iterdir()):
+            if not product_dir.is_dir():
+                continue
+            
+            try:
+                product_name = product_dir.name
+                if self.index is not None:
+                    indexed_name = self.index.index(product_dir)
+                    if indexed_name is None:
+                        continue
+                    band_files = {band: Path(path) for band, path
+                                  in self.index.band_paths(indexed_name, self.bands).items()}
+                else:
+                    img_data = find_img_data(product_dir)
+                    if img_data is None:
+                        logging.warning(f"No IMG_DATA directory found in {product_name}")
+                        continue
+                    band_files = index_band_files(img_data, self.bands)
+                for band in self.bands:
+                    if band not in band_files:
+                        logging.warning(f"Band {band} not found in any resolution directory of {product_name}")
+                
+                if band_files:
+                    self.band_paths[product_name] = band_files
+                    logging.info(f"Indexed {len(band_files)} bands for {product_name}")
+                else:
+                    logging.warning(f"No bands were found for {product_name}")
+            
+            except Exception as e:
+                logging.error(f"Error indexing {product_dir.name}: {str(e)}")
+        
+        return self
+    
+    def __getitem__(self, product_name: str) -> ProductBands:
+        return ProductBands(self.band_paths[product_name], self.pool)
+    
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.band_paths)
+    
+    def __len__(self) -> int:
+        return len(self.band_paths)
+    
+    def read(self, product_name: str, band: str, window: Optional[Window] = None) -> np.ndarray:
+        """Read a band, or a window of it"""
+        return self[product_name][band].read(1, window=window)
+    
+    def close(self) -> None:
+        """Close every open dataset"""
+        self.pool.close()
+    
+    def __enter__(self) -> "ProductCatalog":
+        return self
+    
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+def read_sentinel_bands(l2_dir: str,
+                        bands: Optional[List[str]] = None,
+                        max_open: int = 64,
+                        index: Optional[SafeIndex] = None) -> ProductCatalog:
     """
     Read Sentinel-2 bands from L2A products
     
     Args:
         l2_dir: Path to L2 directory containing extracted products
         bands: List of band names to read. Default: ['B02', 'B03', 'B04', 'B08']
+        max_open: Maximum number of band datasets open at the same time
+        index: SAFE index to look band paths up in instead of listing IMG_DATA
     
     Returns:
-        dict: Nested dictionary with structure {product_name: {band_name: rasterio.DatasetReader}}
+        ProductCatalog: Lazy mapping {product_name: {band_name: rasterio.DatasetReader}};
+            close it (or use it as a context manager) when done
     """
-    if bands is None:
-        bands = ['B02', 'B03', 'B04', 'B08']
+    return ProductCatalog(l2_dir, bands, max_open, index).scan()
+
+def write_band_store(product_name: str,
+                     bands: Mapping,
+                     store_dir: Path,
+                     block_rows: int = 1024) -> Path:
+    """
+    Write a product as one .npy file per band plus a metadata.json sidecar
     
-    products = {}
+    Each band is copied in strips of block_rows rows into a memory-mapped
+    .npy file, so neither writing nor later reading needs the whole band
+    in memory.
     
-    for product_dir in Path(l2_dir).glob('*'):
-        if not product_dir.is_dir():
-            continue
-            
-        try:
-            product_name = product_dir.name
-            logging.info(f"Processing product: {product_name}")
-            
-            # Find IMG_DATA directory
-            img_data_dirs = list(product_dir.glob('**/IMG_DATA'))
-            if not img_data_dirs:
-                logging.warning(f"No IMG_DATA directory found in {product_name}")
-                continue
-            
-            img_data = img_data_dirs[0]
-            logging.info(f"Found IMG_DATA directory: {img_data}")
-            
-            # Read each band
-            band_dict = {}
-            for band in bands:
-                try:
-                    # Look for band file in any resolution directory
-                    band_file = None
-                    for res in ['R10m', 'R20m', 'R60m']:
-                        res_dir = img_data / res
-                        if res_dir.exists():
-                            band_file = find_band_file(res_dir, band, res)
-                            if band_file:
-                                break
-                    
-                    if band_file:
-                        band_dict[band] = rasterio.open(band_file)
-                        logging.info(f"Successfully read {band} from {band_file.name}")
-                    else:
-                        logging.warning(f"Band {band} not found in any resolution directory")
-                        
-                except Exception as e:
-                    logging.error(f"Error reading band {band}: {str(e)}")
-            
-            if band_dict:
-                products[product_name] = band_dict
-                logging.info(f"Successfully read {len(band_dict)} bands for {product_name}")
-            else:
-                logging.warning(f"No bands were read for {product_name}")
-                
-        except Exception as e:
-            logging.error(f"Error processing {product_dir.name}: {str(e)}")
-            continue
+    Args:
+        product_name: Name of the product
+        bands: Open band readers of the product
+        store_dir: Directory of the store, created if needed
+        block_rows: Rows copied per read
+    
+    Returns:
+        Path: The store directory
+    """
+    store_dir.mkdir(parents=True, exist_ok=True)
+    first = next(iter(bands.values()))
+    metadata = {
+        'name': product_name,
+        'crs': first.crs.to_wkt() if first.crs else None,
+        'transform': list(first.transform)[:6],
+        'timestamp': product_name.split('_')[2][:8],  # Extract date from product name
+        'bands': {}
+    }
     
-    return products
+    for band_name, band_reader in bands.items():
+        band_file = store_dir / f"{band_name}.npy"
+        shape = (band_reader.height, band_reader.width)
+        data = np.lib.format.open_memmap(band_file, mode='w+', dtype=band_reader.dtypes[0], shape=shape)
+        for row in range(0, band_reader.height, block_rows):
+            rows = min(block_rows, band_reader.height - row)
+            data[row:row + rows] = band_reader.read(1, window=Window(0, row, band_reader.width, rows))
+        data.flush()
+        del data
+        
+        metadata['bands'][band_name] = {
+            'file': band_file.name,
+            'shape': list(shape),
+            'dtype': band_reader.dtypes[0],
+            'transform': list(band_reader.transform)[:6]
+        }
+        logging.info(f"Stored band {band_name} in {band_file}")
+    
+    with open(store_dir / 'metadata.json', 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return store_dir
 
-def create_bands_dictionary(products: Dict[str, Dict[str, rasterio.DatasetReader]], root_dir: Path) -> bool:
+class BandStore:
+    """Lazy, memory-mapped access to a product written by write_band_store"""
+    def __init__(self, store_dir: Path):
+        self.path = Path(store_dir)
+        with open(self.path / 'metadata.json') as f:
+            self.metadata = json.load(f)
+        self.name = self.metadata['name']
+        self._arrays = {}
+    
+    @property
+    def bands(self) -> List[str]:
+        return list(self.metadata['bands'])
+    
+    @property
+    def crs(self) -> Optional[CRS]:
+        return CRS.from_wkt(self.metadata['crs']) if self.metadata['crs'] else None
+    
+    def transform(self, band_name: Optional[str] = None) -> Affine:
+        """Geotransform of a band, or of the product's first band"""
+        if band_name is None:
+            return Affine(*self.metadata['transform'])
+        return Affine(*self.metadata['bands'][band_name]['transform'])
+    
+    def band(self, band_name: str) -> np.ndarray:
+        """Read-only memory map of a band; pages are loaded only when accessed"""
+        if band_name not in self.metadata['bands']:
+            raise KeyError(f"Band '{band_name}' not in {self.name}. Available: {self.bands}")
+        if band_name not in self._arrays:
+            band_file = self.path / self.metadata['bands'][band_name]['file']
+            self._arrays[band_name] = np.load(band_file, mmap_mode='r')
+        return self._arrays[band_name]
+    
+    def read(self, band_name: str, window: Optional[Window] = None) -> np.ndarray:
+        """Copy a band, or only a window of it, into memory"""
+        data = self.band(band_name)
+        if window is None:
+            return np.array(data)
+        (row_start, row_stop), (col_start, col_stop) = window.toranges()
+        return np.array(data[row_start:row_stop, col_start:col_stop])
+    
+    def close(self) -> None:
+        """Drop the memory maps"""
+        self._arrays.clear()
+
+class PickleBandStore:
+    """BandStore interface over a product pickle written by create_bands_dictionary"""
+    def __init__(self, pickle_file: Path):
+        self.path = Path(pickle_file)
+        self.name = self.path.stem[:-len('_bands')] if self.path.stem.endswith('_bands') else self.path.stem
+        self._product = None
+    
+    @property
+    def product(self) -> Dict[str, Any]:
+        if self._product is None:
+            with open(self.path, 'rb') as f:
+                self._product = pickle.load(f)
+        return self._product
+    
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        return self.product['metadata']
+    
+    @property
+    def bands(self) -> List[str]:
+        return list(self.product['bands'])
+    
+    @property
+    def crs(self) -> Optional[CRS]:
+        return self.metadata['crs']
+    
+    def transform(self, band_name: Optional[str] = None) -> Affine:
+        return self.metadata['transform']
+    
+    def band(self, band_name: str) -> np.ndarray:
+        if band_name not in self.product['bands']:
+            raise KeyError(f"Band '{band_name}' not in {self.name}. Available: {self.bands}")
+        return self.product['bands'][band_name]
+    
+    def read(self, band_name: str, window: Optional[Window] = None) -> np.ndarray:
+        data = self.band(band_name)
+        if window is None:
+            return data
+        (row_start, row_stop), (col_start, col_stop) = window.toranges()
+        return data[row_start:row_stop, col_start:col_stop]
+    
+    def close(self) -> None:
+        self._product = None
+
+def open_band_stores(preprocessed_dir: Path, output_format: str = 'pickle') -> List[Union[BandStore, PickleBandStore]]:
+    """
+    Find the per-product band stores written with the given backend
+    
+    Args:
+        preprocessed_dir: Directory searched recursively
+        output_format: 'pickle' or 'npy', as in preprocessing.output_format
+    
+    Returns:
+        list: One store per product, opened lazily
+    """
+    if output_format not in BAND_STORE_FORMATS:
+        raise ValueError(f"Unknown band store format '{output_format}'. Available: {BAND_STORE_FORMATS}")
+    if output_format == 'npy':
+        return [BandStore(metadata_file.parent)
+                for metadata_file in sorted(preprocessed_dir.rglob('*_bands/metadata.json'))]
+    return [PickleBandStore(pickle_file) for pickle_file in sorted(preprocessed_dir.rglob('*_bands.pkl'))]
+
+def create_bands_dictionary(products: Mapping,
+                            root_dir: Path,
+                            output_format: str = 'pickle') -> bool:
     """
     Create and save a dictionary containing band data
     
     Args:
-        products: Dictionary of products and their bands
+        products: Products and their bands, e.g. a ProductCatalog
         root_dir: Project root directory
+        output_format: 'pickle' for one pickle per product plus all_products.pkl,
+            'npy' for a memory-mappable store per product (see write_band_store)
     
     Returns:
         bool: True if successful, False otherwise
@@ -100,6 +393,17 @@ def create_bands_dictionary(products: Dict[str, Dict[str, rasterio.DatasetReader
         output_dir = root_dir / 'data' / 'preprocessed' / 'Sentinel-2' / 'L2A'
         output_dir.mkdir(parents=True, exist_ok=True)
         
+        if output_format not in BAND_STORE_FORMATS:
+            logging.error(f"Unknown output format '{output_format}'. Available: {BAND_STORE_FORMATS}")
+            return False
+        
+        if output_format == 'npy':
+            for product_name, bands in products.items():
+                store_dir = write_band_store(product_name, bands, output_dir / f"{product_name}_bands")
+                logging.info(f"Saved {product_name} to {store_dir}")
+            logging.info(f"Successfully saved all processed data to {output_dir}")
+            return True
+        
         processed_data = {}
         for product_name, bands in products.items():
             logging.info(f"Processing {product_name}")
@@ -0,0 +1,143 @@
+"""
+Incremental build cache shared by the pipeline stages
+
+Each stage fingerprints the inputs of a product (source files, parameters
+such as bands, AOI geometry or thresholds, and the code version) and
+records the outputs it produced in a JSON manifest. A rerun only
+recomputes products whose fingerprint changed or whose outputs are gone.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+import src
+
+def stat_identity(path: Union[str, Path]) -> List:
+    """Identity of a file by name, size and mtime, without reading it"""
+    path = Path(path)
+    stat = path.stat()
+    return [path.name, stat.st_size, stat.st_mtime_ns]
+
+def file_identity(path: Union[str, Path], hash_limit: int) -> List:
+    """
+    Identity of an input file or directory
+
+    Files up to hash_limit bytes (AOIs, metadata) are identified by a hash of
+    their content; larger rasters and archives by name, size and mtime, which
+    avoids re-reading gigabytes on every run. Directories are identified by
+    name and mtime only, never walked: stages reading a few files of a
+    directory (the bands of a SAFE) pass those files instead.
+    """
+    path = Path(path)
+    if path.is_dir():
+        return [path.name, path.stat().st_mtime_ns]
+
+    if path.stat().st_size <= hash_limit:
+        with open(path, 'rb') as f:
+            return [path.name, hashlib.sha256(f.read()).hexdigest()]
+    return stat_identity(path)
+
+def module_digest(*module_files: Union[str, Path]) -> str:
+    """
+    Short hash of the source files of a stage
+
+    Stages pass their own file and every module computing their outputs,
+    so a code change in any of them invalidates the cached outputs.
+    """
+    digest = hashlib.sha256()
+    for module_file in module_files:
+        with open(module_file, 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()[:16]
+
+class StageCache:
+    def __init__(self, manifest_path: Path, enabled: bool = True, hash_limit_mb: float = 16):
+        self.manifest_path = Path(manifest_path)
+        self.enabled = enabled
+        self.hash_limit = int(hash_limit_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self.manifest = self._load()
+
+    @classmethod
+    def from_config(cls, root_dir: Path, config: Dict[str, Any]) -> "StageCache":
+        """Build the cache described by the 'cache' section of config.yaml"""
+        settings = config.get('cache', {})
+        return cls(Path(root_dir) / settings.get('manifest', 'data/cache/manifest.json'),
+                   enabled=settings.get('enabled', True),
+                   hash_limit_mb=settings.get('hash_limit_mb', 16))
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if not self.enabled or not self.manifest_path.exists():
+            return {}
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable cache manifest {self.manifest_path}: {e}")
+            return {}
+
+    def _save(self) -> None:
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.manifest_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def fingerprint(self,
+                    inputs: Iterable[Union[str, Path]],
+                    params: Optional[Dict[str, Any]] = None,
+                    code: Optional[str] = None,
+                    stat_inputs: Iterable[Union[str, Path]] = ()) -> str:
+        """
+        Fingerprint a stage run of one product
+
+        Args:
+            inputs: Files or directories the stage reads
+            params: Settings that change the output (bands, thresholds, AOI...)
+            code: Digest of the code producing the output
+            stat_inputs: Files identified by name, size and mtime whatever their size
+
+        Returns:
+            str: Hex digest identifying the run
+        """
+        payload = {
+            'inputs': [file_identity(path, self.hash_limit) for path in inputs],
+            'params': params or {},
+            'code': [src.__version__, code]
+        }
+        stat_inputs = [stat_identity(path) for path in stat_inputs]
+        if stat_inputs:
+            payload['stat_inputs'] = stat_inputs
+        encoded = json.dumps(payload, sort_keys=True, default=str).encode('utf-8')
+        return hashlib.sha256(encoded).hexdigest()
+
+    def is_fresh(self, stage: str, key: str, fingerprint: str) -> bool:
+        """True if key was built by stage with this fingerprint and its outputs still exist"""
+        if not self.enabled:
+            return False
+        entry = self.manifest.get(stage, {}).get(key)
+        if not entry or entry['fingerprint'] != fingerprint:
+            return False
+        return all(Path(path).exists() for path in entry['outputs'])
+
+    def outputs(self, stage: str, key: str) -> List[Path]:
+        """Outputs recorded for key by stage"""
+        entry = self.manifest.get(stage, {}).get(key, {})
+        return [Path(path) for path in entry.get('outputs', [])]
+
+    def record(self, stage: str, key: str, fingerprint: str, outputs: Iterable[Union[str, Path]]) -> None:
+        """Record the outputs of a successful stage run and persist the manifest"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.manifest.setdefault(stage, {})[key] = {
+                'fingerprint': fingerprint,
+                'outputs': [str(path) for path in outputs],
+                'created': time.time()
+            }
+            self._save()
@@ -8,74 +8,69 @@ from typing import Dict, Tuple, Optional
 import rasterio
 import geopandas as gpd
 import numpy as np
-from rasterio.mask import mask
-from rasterio.warp import transform_geom
-from shapely.geometry import box, mapping
+from rasterio.windows import transform as window_transform
 import pickle
 
+from src.auxiliary.raster_utils import aoi_mask, apply_mask, bounds_window
+
 def clip_to_aoi(bands_data: Dict[str, Dict], aoi_file: Path, product_name: str) -> Tuple[Optional[Dict], Dict]:
     """
     Clip Sentinel-2 bands to Area of Interest using GeoJSON boundary
+    
+    Bands are cropped to the AOI envelope and masked to the polygon with a
+    rasterised AOI mask that is computed once per band grid and cached,
+    so all bands on a grid, and later products on the same tile, share it.
     """
     try:
         # Read AOI boundary
         aoi = gpd.read_file(aoi_file)
         logging.info(f"Loaded AOI boundary from: {aoi_file.absolute()}")
 
-        # Get sample band for spatial reference
-        sample_band_name = next(iter(bands_data['bands'].keys()))
-        sample_band = bands_data['bands'][sample_band_name]
-        
         # Transform AOI geometry to match raster CRS if needed
         if aoi.crs != bands_data['metadata']['crs']:
             aoi = aoi.to_crs(bands_data['metadata']['crs'])
             logging.info(f"Transformed AOI to match raster CRS: {bands_data['metadata']['crs']}")
 
-        # Get geometry in GeoJSON format
-        geom = [mapping(aoi.geometry.iloc[0])]
+        geometry = aoi.geometry.iloc[0]
 
-        # Clip each band
-        clipped_bands = {}
+        # Bands sharing a grid (same transform and shape) are clipped together
+        grids = {}
         for band_name, band_data in bands_data['bands'].items():
-            logging.info(f"Clipping band {band_name}")
+            grid = (tuple(band_data['transform']), band_data['data'].shape)
+            grids.setdefault(grid, []).append(band_name)
+
+        clipped_bands = {}
+        for (_, (height, width)), band_names in grids.items():
+            band_transform = bands_data['bands'][band_names[0]]['transform']
+            window = bounds_window(geometry.bounds, band_transform, width, height)
+            if window is None:
+                logging.error(f"AOI does not overlap bands {band_names}")
+                return None, {}
             
-            # Create temporary raster in memory
-            with rasterio.io.MemoryFile() as memfile:
-                with memfile.open(
-                    driver='GTiff',
-                    height=band_data['data'].shape[0],
-                    width=band_data['data'].shape[1],
-                    count=1,
-                    dtype=band_data['data'].dtype,
-                    crs=bands_data['metadata']['crs'],
-                    transform=band_data['transform']
-                ) as dataset:
-                    dataset.write(band_data['data'], 1)
-                    
-                    # Perform the clipping
-                    clipped, transform = mask(
-                        dataset,
-                        geom,
-                        crop=True,
-                        all_touched=True,
-                        nodata=0
-                    )
-
-            clipped_bands[band_name] = {
-                'data': clipped[0],
-                'transform': transform,
-                'nodata': 0
-            }
+            # Crop once, rasterise the AOI once per grid, mask all bands in one step
+            (row_start, row_stop), (col_start, col_stop) = window.toranges()
+            stack = np.stack([bands_data['bands'][name]['data'][row_start:row_stop, col_start:col_stop]
+                              for name in band_names])
+            transform = window_transform(window, band_transform)
+            apply_mask(stack, aoi_mask(geometry, transform, stack.shape[1:]))
+            logging.info(f"Clipped bands {', '.join(band_names)}")
+
+            for band_name, clipped in zip(band_names, stack):
+                clipped_bands[band_name] = {
+                    'data': clipped,
+                    'transform': transform,
+                    'nodata': 0
+                }
 
         metadata = {
             'product_name': product_name,
             'aoi_name': aoi_file.stem,
             'crs': bands_data['metadata']['crs'],
             'transform': transform,
-            'shape': clipped[0].shape,
+            'shape': stack.shape[1:],
             'bounds': rasterio.transform.array_bounds(
-                clipped[0].shape[0],
-                clipped[0].shape[1],
+                stack.shape[1],
+                stack.shape[2],
                 transform
             )
         }
@@ -0,0 +1,22 @@
+import logging
+from pathlib import Path
+from typing import Any, Dict
+import yaml
+
+def load_config(root_dir: Path) -> Dict[str, Any]:
+    """
+    Load the pipeline configuration from config/config.yaml
+
+    Args:
+        root_dir: Project root directory
+
+    Returns:
+        dict: Parsed configuration, empty if the file is missing
+    """
+    config_path = Path(root_dir) / "config" / "config.yaml"
+    if not config_path.exists():
+        logging.warning(f"Configuration file not found: {config_path}")
+        return {}
+
+    with open(config_path, "r", encoding="utf-8") as f:
+        return yaml.safe_load(f) or {}
@@ -0,0 +1,319 @@
+"""
+Lightweight run instrumentation shared by the pipeline stages
+
+Each unit of work is wrapped in run_metrics.measure(stage, product), which
+records its wall time, CPU time of the calling thread and the peak RSS of
+the process while the unit ran; stages add counters (bytes read and
+written, pixels processed, network bytes) to the same record. Records are exported as a JSON or CSV
+run report, or as Prometheus text. Worker processes hand their records
+back with drain() and the parent merges them.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Summed per (stage, product) record
+COUNTERS = ['calls', 'wall_s', 'cpu_s', 'bytes_read', 'bytes_written', 'pixels', 'network_bytes']
+
+def _windows_peak_rss() -> Optional[int]:
+    """Peak working set of the current process through psapi"""
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    kernel32 = ctypes.windll.kernel32
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    if ctypes.windll.psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(),
+                                                ctypes.byref(counters), counters.cb):
+        return int(counters.PeakWorkingSetSize)
+    return None
+
+def peak_rss_bytes() -> Optional[int]:
+    """Peak resident set size of the current process, None if unavailable"""
+    try:
+        if resource is not None:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # Bytes on macOS, kilobytes elsewhere
+            return int(peak) if sys.platform == 'darwin' else int(peak) * 1024
+        if sys.platform == 'win32':
+            return _windows_peak_rss()
+    except Exception as e:
+        logging.debug(f"Peak RSS unavailable: {str(e)}")
+    return None
+
+def high_water_rss_bytes() -> Optional[int]:
+    """Resettable peak RSS (VmHWM) of the current process on Linux, None elsewhere"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def reset_high_water_rss() -> bool:
+    """Reset VmHWM to the current RSS, False where the kernel does not allow it"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def file_size(path: Union[str, Path]) -> int:
+    """Size of a local file, 0 for missing files and GDAL virtual paths"""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+class RunMetrics:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.started = time.time()
+        self._records: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # Peak RSS so far of the units being measured, None if it cannot be reset per unit
+        self._open_peaks: Optional[Dict[int, int]] = None
+        self._next_unit = 0
+        # Resetting the high-water mark also resets ru_maxrss: keep the run peak here
+        self._run_peak = 0
+
+    def configure(self, config: Dict[str, Any]) -> "RunMetrics":
+        """Apply the 'metrics' section of config.yaml"""
+        self.enabled = config.get('metrics', {}).get('enabled', True)
+        return self
+
+    def _forget_parent(self) -> None:
+        """Drop records inherited from the parent of a forked worker process"""
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._records.clear()
+            if self._open_peaks is not None:
+                self._open_peaks.clear()
+            self._run_peak = 0
+
+    def _start_peak(self) -> Optional[int]:
+        """
+        Reset the process high-water mark at the start of a unit
+
+        Units measured concurrently share the process peak: before the reset,
+        the peak reached so far is folded into every unit still open.
+        Returns the unit key, None without per-unit peaks.
+        """
+        if self._open_peaks is None:
+            if high_water_rss_bytes() is None or not reset_high_water_rss():
+                return None
+            self._open_peaks = {}
+        peak = high_water_rss_bytes() or 0
+        self._run_peak = max(self._run_peak, peak)
+        for unit in self._open_peaks:
+            self._open_peaks[unit] = max(self._open_peaks[unit], peak)
+        if not reset_high_water_rss():
+            return None
+        self._next_unit += 1
+        self._open_peaks[self._next_unit] = 0
+        return self._next_unit
+
+    def _end_peak(self, unit: Optional[int]) -> Optional[int]:
+        """Peak RSS of the process while a unit ran"""
+        if unit is None or self._open_peaks is None or unit not in self._open_peaks:
+            return None
+        peak = max(self._open_peaks.pop(unit), high_water_rss_bytes() or 0)
+        self._run_peak = max(self._run_peak, peak)
+        return peak
+
+    def process_peak_rss(self) -> Optional[int]:
+        """Peak RSS of the process over the run, None if unavailable"""
+        with self._lock:
+            self._forget_parent()
+            peak = max(self._run_peak, peak_rss_bytes() or 0)
+        return peak or None
+
+    def _record(self, stage: str, product: str) -> Dict[str, Any]:
+        self._forget_parent()
+        key = (stage, product)
+        if key not in self._records:
+            self._records[key] = {'stage': stage, 'product': product,
+                                  **{name: 0 for name in COUNTERS}, 'peak_rss_bytes': None}
+        return self._records[key]
+
+    def add(self, stage: str, product: str = '-', **counters: float) -> None:
+        """Add counters (bytes_read, bytes_written, pixels, network_bytes...) to a record"""
+        if not self.enabled:
+            return
+        with self._lock:
+            record = self._record(stage, product)
+            for name, value in counters.items():
+                record[name] = record.get(name, 0) + value
+
+    @contextmanager
+    def measure(self, stage: str, product: str = '-') -> Iterator["RunMetrics"]:
+        """
+        Time a unit of work of a stage
+
+        Wall time, CPU time of the calling thread (other threads of the
+        process are not charged to the record) and the peak RSS of the
+        process while the unit ran are added to the (stage, product) record.
+        The peak needs a resettable high-water mark (Linux); elsewhere the
+        records carry no peak and only the run-level process peak is reported.
+        """
+        if not self.enabled:
+            yield self
+            return
+        with self._lock:
+            self._forget_parent()
+            unit = self._start_peak()
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield self
+        finally:
+            with self._lock:
+                peak = self._end_peak(unit)
+                record = self._record(stage, product)
+                record['calls'] += 1
+                record['wall_s'] += time.perf_counter() - wall
+                record['cpu_s'] += time.thread_time() - cpu
+                if peak is not None:
+                    record['peak_rss_bytes'] = max(record['peak_rss_bytes'] or 0, peak)
+
+    def records(self) -> List[Dict[str, Any]]:
+        """Per (stage, product) records, sorted by stage and product"""
+        with self._lock:
+            return [dict(self._records[key]) for key in sorted(self._records)]
+
+    def drain(self) -> List[Dict[str, Any]]:
+        """Return and clear the records, e.g. at the end of a worker process task"""
+        with self._lock:
+            self._forget_parent()
+            records = [dict(record) for record in self._records.values()]
+            self._records.clear()
+        return records
+
+    def merge(self, records: Iterable[Dict[str, Any]]) -> None:
+        """Add records drained from another process"""
+        if not self.enabled:
+            return
+        with self._lock:
+            for other in records:
+                record = self._record(other['stage'], other['product'])
+                for name in COUNTERS:
+                    record[name] += other.get(name, 0)
+                if other.get('peak_rss_bytes') is not None:
+                    record['peak_rss_bytes'] = max(record['peak_rss_bytes'] or 0, other['peak_rss_bytes'])
+
+    def stage_totals(self) -> List[Dict[str, Any]]:
+        """Records summed over products, one per stage"""
+        totals = {}
+        for record in self.records():
+            total = totals.setdefault(record['stage'], {'stage': record['stage'], 'products': 0,
+                                                        **{name: 0 for name in COUNTERS},
+                                                        'peak_rss_bytes': None})
+            total['products'] += 1
+            for name in COUNTERS:
+                total[name] += record[name]
+            if record['peak_rss_bytes'] is not None:
+                total['peak_rss_bytes'] = max(total['peak_rss_bytes'] or 0, record['peak_rss_bytes'])
+        return list(totals.values())
+
+    def write_json(self, path: Path) -> Path:
+        """Write stage totals and per-product records as JSON"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        report = {
+            'started': datetime.fromtimestamp(self.started).isoformat(),
+            'elapsed_s': time.time() - self.started,
+            'peak_rss_bytes': self.process_peak_rss(),
+            'stages': self.stage_totals(),
+            'products': self.records()
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        return path
+
+    def write_csv(self, path: Path) -> Path:
+        """Write the per-product records as CSV"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['stage', 'product', *COUNTERS, 'peak_rss_bytes'])
+            writer.writeheader()
+            writer.writerows(self.records())
+        return path
+
+    def prometheus(self, prefix: str = 'eo_pipeline') -> str:
+        """Stage totals in the Prometheus text exposition format"""
+        lines = []
+        totals = self.stage_totals()
+        for name in COUNTERS:
+            metric = f"{prefix}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.extend(f'{metric}{{stage="{total["stage"]}"}} {total[name]}' for total in totals)
+        peak = self.process_peak_rss()
+        if peak is not None:
+            lines.append(f"# TYPE {prefix}_peak_rss_bytes gauge")
+            lines.append(f"{prefix}_peak_rss_bytes {peak}")
+        return "\n".join(lines) + "\n"
+
+    def log_summary(self) -> None:
+        """Log one line per stage"""
+        for total in self.stage_totals():
+            peak = total['peak_rss_bytes']
+            logging.info(f"  {total['stage']}: {total['products']} products, {total['wall_s']:.1f}s wall, "
+                         f"{total['cpu_s']:.1f}s CPU, {total['bytes_read'] / 1e6:.1f} MB read, "
+                         f"{total['bytes_written'] / 1e6:.1f} MB written, {total['pixels'] / 1e6:.1f} Mpx, "
+                         f"{total['network_bytes'] / 1e6:.1f} MB downloaded"
+                         + (f", peak RSS {peak / 1e6:.0f} MB" if peak else ""))
+
+def write_report(root_dir: Path, config: Dict[str, Any], name: str = 'run') -> List[Path]:
+    """
+    Write the run report in the formats listed in the 'metrics' section of config.yaml
+
+    Returns:
+        List[Path]: Written reports, results/metrics/<name>_<timestamp>.<format> by default
+    """
+    settings = config.get('metrics', {})
+    if not run_metrics.enabled or not settings.get('enabled', True):
+        return []
+
+    report_dir = Path(root_dir) / settings.get('report_folder', 'results/metrics')
+    stem = f"{name}_{datetime.now().strftime('%Y%m%dT%H%M%S')}"
+    paths = []
+    for fmt in settings.get('formats', ['json', 'csv']):
+        if fmt == 'json':
+            paths.append(run_metrics.write_json(report_dir / f"{stem}.json"))
+        elif fmt == 'csv':
+            paths.append(run_metrics.write_csv(report_dir / f"{stem}.csv"))
+        else:
+            logging.warning(f"Unknown metrics report format: {fmt}")
+
+    logging.info("Run metrics:")
+    run_metrics.log_summary()
+    for path in paths:
+        logging.info(f"Saved run report: {path}")
+    return paths
+
+# Process-wide recorder used by every stage
+run_metrics = RunMetrics()
@@ -1,7 +1,6 @@
 import sys
 from pathlib import Path
 import logging
-import pickle
 import matplotlib.pyplot as plt
 import numpy as np
 import geopandas as gpd
@@ -17,48 +16,47 @@ else:
     raise RuntimeError("Project root 'processing-root-folder' not found")
 sys.path.append(str(project_root))
 
+from src.auxiliary.band_utils import open_band_stores
+from src.auxiliary.config_utils import load_config
+
+def load_preprocessed_band(root_dir: Path, band_name: str):
+    """
+    Load one band of the first preprocessed product through the band store API
+    
+    preprocessing.output_format selects the backend; only the requested band
+    is read, from a memory map for the 'npy' store.
+    
+    Returns:
+        tuple: (product_name, band array), or None if unavailable
+    """
+    preprocessed_dir = root_dir / "data" / "preprocessed"
+    output_format = load_config(root_dir).get('preprocessing', {}).get('output_format', 'pickle')
+    logging.info(f"Looking for {output_format} band stores in: {preprocessed_dir}")
+    
+    stores = open_band_stores(preprocessed_dir, output_format)
+    if not stores:
+        logging.error(f"No {output_format} band stores found in {preprocessed_dir}")
+        return None
+    
+    store = stores[0]
+    logging.info(f"Loading band {band_name} from: {store.path}")
+    if band_name not in store.bands:
+        logging.error(f"Band '{band_name}' not found in product '{store.name}'. Available keys: {store.bands}")
+        return None
+    return store.name, store.read(band_name)
+
 def plot_band_from_preprocessed(root_dir: Path, band_name: str = "B02", cmap: str = "viridis") -> bool:
     """
     Plot preprocessed band data with AOI overlay.
-    This version adapts to a pickle file structure where the outer dictionary key
-    is the product name and its value is the band container.
     """
     try:
         logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
         
-        preprocessed_dir = root_dir / "data" / "preprocessed"
-        logging.info(f"Looking for data in: {preprocessed_dir}")
-        
-        # Look for pickle files recursively.
-        pickle_files = list(preprocessed_dir.rglob("*.pkl"))
-        if not pickle_files:
-            logging.error(f"No pickle files found in {preprocessed_dir}")
-            return False
-        
-        # Load the first available pickle file.
-        data_file = pickle_files[0]
-        logging.info(f"Loading data from: {data_file}")
-        with open(data_file, "rb") as f:
-            products = pickle.load(f)
-        
-        # Get first product name and its data.
-        product_name = list(products.keys())[0]
-        product_data = products[product_name]
-        
-        # If the product data is wrapped under a "bands" key, use it;
-        # otherwise assume the product_data itself holds the band arrays.
-        if isinstance(product_data, dict) and "bands" in product_data:
-            band_container = product_data["bands"]
-        else:
-            band_container = product_data
-        
-        if band_name not in band_container:
-            available_bands = list(band_container.keys())
-            logging.error(f"Band '{band_name}' not found in product '{product_name}'. Available keys: {available_bands}")
-            return False
-        
         # Retrieve the requested band data.
-        band_data = band_container[band_name]
+        loaded = load_preprocessed_band(root_dir, band_name)
+        if loaded is None:
+            return False
+        product_name, band_data = loaded
         
         # Load AOI boundary using our reader.
         aoi_path = root_dir / "data" / "external" / "municipio_1_Rome.geojson"
@@ -103,28 +101,10 @@ def plot_separate_figures(root_dir: Path, band_name: str = "B02") -> bool:
         logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
         
         # Load band data
-        preprocessed_dir = root_dir / "data" / "preprocessed"
-        pickle_files = list(preprocessed_dir.rglob("*.pkl"))
-        if not pickle_files:
-            logging.error(f"No pickle files found in {preprocessed_dir}")
+        loaded = load_preprocessed_band(root_dir, band_name)
+        if loaded is None:
             return False
-        
-        data_file = pickle_files[0]
-        logging.info(f"Loading band data from: {data_file}")
-        with open(data_file, "rb") as f:
-            products = pickle.load(f)
-        
-        # Get first product
-        product_name = list(products.keys())[0]
-        product_data = products[product_name]
-        
-        # Get band data
-        band_container = product_data.get("bands", product_data)
-        if band_name not in band_container:
-            logging.error(f"Band {band_name} not found. Available: {list(band_container.keys())}")
-            return False
-        
-        band_data = band_container[band_name]
+        product_name, band_data = loaded
         
         # Load AOI boundary
         aoi_path = root_dir / "data" / "external" / "municipio_1_Rome.geojson"
@@ -0,0 +1,148 @@
+"""
+Quicklook rendering for pipeline rasters
+
+Previews are read at a reduced size, which GDAL serves from the internal
+overviews of the COG outputs, colourised through small uint8 lookup
+tables and written as PNG, so no matplotlib figure is ever rendered.
+"""
+import warnings
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.errors import NotGeoreferencedWarning
+
+from src.auxiliary.metrics_utils import run_metrics, file_size
+
+# ColorBrewer RdYlGn anchors, from low (red) to high (green) index values
+RDYLGN = [
+    (165, 0, 38), (214, 47, 39), (244, 109, 67), (253, 173, 96),
+    (254, 224, 139), (254, 255, 190), (217, 239, 139), (165, 216, 106),
+    (102, 189, 99), (25, 151, 80), (0, 104, 55)
+]
+
+# Nodata (NaN) index pixels, a neutral grey outside the RdYlGn ramp
+NODATA_COLOR = (191, 191, 191)
+
+# Land cover class colours: unclassified, water, built-up, vegetation
+CLASS_COLORS = [(0, 0, 0), (0, 0, 255), (128, 128, 128), (0, 128, 0)]
+
+def colormap_lut(anchors: Sequence[Tuple[int, int, int]], size: int = 256) -> np.ndarray:
+    """Interpolate colour anchors into a (size, 3) uint8 lookup table"""
+    anchors = np.asarray(anchors, dtype='float32')
+    positions = np.linspace(0, 1, len(anchors))
+    samples = np.linspace(0, 1, size)
+    channels = [np.interp(samples, positions, anchors[:, c]) for c in range(3)]
+    return np.stack(channels, axis=1).round().astype(np.uint8)
+
+def index_lut(anchors: Sequence[Tuple[int, int, int]]) -> np.ndarray:
+    """Lookup table with NODATA_COLOR at 0 and the colour ramp over 1-255"""
+    return np.vstack([np.asarray([NODATA_COLOR], dtype=np.uint8), colormap_lut(anchors, 255)])
+
+def palette_lut(colors: Sequence[Tuple[int, int, int]]) -> np.ndarray:
+    """Lookup table mapping class values to colours, black for unknown values"""
+    lut = np.zeros((256, 3), dtype=np.uint8)
+    lut[:len(colors)] = colors
+    return lut
+
+def preview_shape(width: int, height: int, max_size: int) -> Tuple[int, int]:
+    """(rows, cols) of a preview whose long side is at most max_size pixels"""
+    scale = max(1, max(width, height) / max_size)
+    return max(1, int(height / scale)), max(1, int(width / scale))
+
+def read_decimated(path: Path,
+                   max_size: int,
+                   indexes: Optional[List[int]] = None,
+                   resampling: str = 'average') -> np.ndarray:
+    """
+    Read a raster downsampled to at most max_size pixels on its long side
+
+    Args:
+        path: Raster to read
+        max_size: Long side of the result in pixels
+        indexes: 1-based bands to read, all bands if None
+        resampling: Resampling used when no overview matches, 'nearest' for classes
+
+    Returns:
+        np.ndarray: (bands, rows, cols) array
+    """
+    with rasterio.open(path) as src:
+        indexes = indexes or list(range(1, src.count + 1))
+        rows, cols = preview_shape(src.width, src.height, max_size)
+        return src.read(indexes, out_shape=(len(indexes), rows, cols),
+                        resampling=Resampling[resampling])
+
+def to_uint8(values: np.ndarray, vmin: float, vmax: float) -> np.ndarray:
+    """Scale values in [vmin, vmax] linearly to 1-255, keeping 0 for NaN"""
+    scaled = np.clip((values.astype('float32') - vmin) * (254.0 / (vmax - vmin)) + 1, 1, 255)
+    return np.nan_to_num(scaled, nan=0.0).astype(np.uint8)
+
+def apply_lut(values: np.ndarray, lut: np.ndarray) -> np.ndarray:
+    """Colourise a 2D uint8 array into a (3, rows, cols) image"""
+    return np.moveaxis(lut[values], -1, 0)
+
+def side_by_side(images: Sequence[np.ndarray], gap: int = 8) -> np.ndarray:
+    """Place (3, rows, cols) images next to each other on a white background"""
+    rows = max(image.shape[1] for image in images)
+    cols = sum(image.shape[2] for image in images) + gap * (len(images) - 1)
+    canvas = np.full((3, rows, cols), 255, dtype=np.uint8)
+    col = 0
+    for image in images:
+        canvas[:, :image.shape[1], col:col + image.shape[2]] = image
+        col += image.shape[2] + gap
+    return canvas
+
+def write_png(path: Path, image: np.ndarray) -> Path:
+    """Write a (bands, rows, cols) uint8 image as PNG"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', NotGeoreferencedWarning)
+        with rasterio.open(path, 'w', driver='PNG', width=image.shape[2], height=image.shape[1],
+                           count=image.shape[0], dtype='uint8') as dst:
+            dst.write(image)
+    return path
+
+def render_index(index_path: Path, max_size: int = 1024,
+                 vmin: float = -1.0, vmax: float = 1.0) -> np.ndarray:
+    """Quicklook of a single-band index through the RdYlGn lookup table, nodata in grey"""
+    values = read_decimated(index_path, max_size, [1])[0]
+    return apply_lut(to_uint8(values, vmin, vmax), index_lut(RDYLGN))
+
+def render_classes(class_path: Path, max_size: int = 1024) -> np.ndarray:
+    """Quicklook of a land cover class raster"""
+    classes = read_decimated(class_path, max_size, [1], resampling='nearest')[0]
+    return apply_lut(classes, palette_lut(CLASS_COLORS))
+
+def save_product_preview(rgb_path: Path,
+                         index_path: Path,
+                         preview_path: Path,
+                         max_size: int = 1024,
+                         index_range: Tuple[float, float] = (-1.0, 1.0)) -> Path:
+    """
+    Save the RGB and index quicklooks of a product side by side as PNG
+
+    Args:
+        rgb_path: 8-bit RGB GeoTIFF
+        index_path: Spectral index GeoTIFF, e.g. NDVI
+        preview_path: PNG to write
+        max_size: Long side of each quicklook in pixels
+        index_range: Index values mapped to the ends of the colour ramp
+
+    Returns:
+        Path: The written preview
+    """
+    with run_metrics.measure('preview', Path(rgb_path).stem):
+        rgb = read_decimated(rgb_path, max_size, [1, 2, 3])
+        index = render_index(index_path, max_size, *index_range)
+        write_png(preview_path, side_by_side([rgb, index]))
+        run_metrics.add('preview', Path(rgb_path).stem, bytes_written=file_size(preview_path))
+    return Path(preview_path)
+
+def save_class_preview(class_path: Path, preview_path: Path, max_size: int = 1024) -> Path:
+    """Save the quicklook of a classified raster as PNG"""
+    with run_metrics.measure('preview', Path(class_path).stem):
+        write_png(preview_path, render_classes(class_path, max_size))
+        run_metrics.add('preview', Path(class_path).stem, bytes_written=file_size(preview_path))
+    return Path(preview_path)
@@ -0,0 +1,421 @@
+"""
+Raster helpers shared by the pipeline stages: block sizing, AOI read
+windows, Cloud-Optimized GeoTIFF output and windowed, block-streaming
+band stacking
+"""
+import os
+import math
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import numpy as np
+import rasterio
+import rasterio.shutil
+from affine import Affine
+from rasterio.enums import Interleaving, Resampling
+from rasterio.features import geometry_mask
+from rasterio.crs import CRS
+from rasterio.warp import transform_bounds, transform_geom
+from rasterio import windows
+from rasterio.windows import Window
+from shapely.geometry import mapping, shape
+
+# Defaults of the 'raster_output' section of config.yaml
+COG_DEFAULTS = {
+    'block_size': 512,
+    'compress': 'DEFLATE',
+    'predictor': 'auto',
+    'overviews': True,
+    'min_overview_size': 256,
+    'sparse': True
+}
+
+def cog_settings(settings: Optional[Dict[str, Any]] = None, block_size: Optional[int] = None) -> Dict[str, Any]:
+    """Merge raster output settings with the defaults, optionally forcing the block size"""
+    merged = {**COG_DEFAULTS, **(settings or {})}
+    if block_size:
+        merged['block_size'] = block_size
+    return merged
+
+def _predictor(dtype: str, predictor) -> int:
+    """Resolve 'auto' to horizontal (2) for integers and floating point (3) for floats"""
+    if predictor != 'auto':
+        return int(predictor)
+    return 3 if np.issubdtype(np.dtype(dtype), np.floating) else 2
+
+def cog_profile(profile: Dict[str, Any], settings: Optional[Dict[str, Any]] = None,
+                block_size: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Turn a rasterio profile into a tiled, compressed GeoTIFF profile
+
+    Args:
+        profile: Base profile (size, CRS, transform, dtype, count...)
+        settings: 'raster_output' settings: block_size, compress, predictor
+        block_size: Tile edge overriding the settings
+
+    Returns:
+        dict: Profile for rasterio.open(..., 'w')
+    """
+    settings = cog_settings(settings, block_size)
+    cog = dict(profile)
+    cog.update({
+        'driver': 'GTiff',
+        'tiled': True,
+        'blockxsize': settings['block_size'],
+        'blockysize': settings['block_size'],
+        'compress': settings['compress'].lower(),
+        'predictor': _predictor(cog['dtype'], settings['predictor']),
+        'BIGTIFF': 'IF_SAFER',
+        'SPARSE_OK': settings['sparse']
+    })
+    return cog
+
+def gdal_creation_options(dtype: str, settings: Optional[Dict[str, Any]] = None) -> List[str]:
+    """GDAL GTiff creation options equivalent to cog_profile"""
+    settings = cog_settings(settings)
+    return [
+        'TILED=YES',
+        f"BLOCKXSIZE={settings['block_size']}",
+        f"BLOCKYSIZE={settings['block_size']}",
+        f"COMPRESS={settings['compress'].upper()}",
+        f"PREDICTOR={_predictor(dtype, settings['predictor'])}",
+        'BIGTIFF=IF_SAFER',
+        f"SPARSE_OK={'TRUE' if settings['sparse'] else 'FALSE'}"
+    ]
+
+def finalize_cog(path: Path, settings: Optional[Dict[str, Any]] = None,
+                 resampling: str = 'average') -> None:
+    """
+    Build internal overviews once and rewrite a tiled GeoTIFF in COG layout
+
+    Overviews are added by factors of 2 until the smallest level fits in
+    min_overview_size pixels, then the file is copied with its overviews
+    ahead of the full resolution data so readers fetch only the blocks
+    and zoom levels they need. With the sparse setting, blocks holding
+    only nodata are left out of the file and read back as nodata.
+
+    Args:
+        path: Tiled GeoTIFF written with cog_profile
+        settings: 'raster_output' settings
+        resampling: Overview resampling, 'nearest' for class rasters
+    """
+    settings = cog_settings(settings)
+    path = Path(path)
+
+    with rasterio.open(path, 'r+') as dst:
+        profile = dst.profile
+        if settings['overviews']:
+            factors = []
+            factor = 2
+            while max(dst.width, dst.height) / factor >= settings['min_overview_size']:
+                factors.append(factor)
+                factor *= 2
+            if factors:
+                dst.build_overviews(factors, Resampling[resampling])
+                dst.update_tags(ns='rio_overview', resampling=resampling)
+
+    tmp_path = path.with_name(f"{path.stem}.cog{path.suffix}")
+    rasterio.shutil.copy(
+        path, tmp_path,
+        driver='GTiff',
+        copy_src_overviews=True,
+        tiled=True,
+        blockxsize=profile['blockxsize'],
+        blockysize=profile['blockysize'],
+        compress=settings['compress'].lower(),
+        predictor=_predictor(profile['dtype'], settings['predictor']),
+        BIGTIFF='IF_SAFER',
+        SPARSE_OK=settings['sparse']
+    )
+    os.replace(tmp_path, path)
+
+def window_is_sparse(src: rasterio.DatasetReader, window: Window) -> bool:
+    """
+    True if no internal block of a tiled GeoTIFF under window is stored
+
+    Blocks left out of sparse files read as nodata, so stages can skip
+    them without reading or computing anything.
+    """
+    if src.driver != 'GTiff' or not src.profile.get('tiled'):
+        return False
+    block_height, block_width = src.block_shapes[0]
+    (row_start, row_stop), (col_start, col_stop) = window.toranges()
+    band_indexes = src.indexes if src.interleaving == Interleaving.band else [1]
+    for row in range(int(row_start) // block_height, (int(row_stop) - 1) // block_height + 1):
+        for col in range(int(col_start) // block_width, (int(col_stop) - 1) // block_width + 1):
+            for bidx in band_indexes:
+                if src.get_tag_item(f"BLOCK_OFFSET_{col}_{row}", 'TIFF', bidx=bidx):
+                    return False
+    return True
+
+def overview_level_for(native_resolution: float,
+                       target_resolution: Optional[float],
+                       available_levels: int) -> Optional[int]:
+    """
+    Map a target pixel size to a JPEG2000 resolution level
+
+    Each JP2 resolution level halves the native resolution and is exposed by
+    GDAL as an overview, so 20 m from a 10 m band is overview level 0.
+
+    Args:
+        native_resolution: Pixel size of the full resolution band
+        target_resolution: Wanted pixel size, None for full resolution
+        available_levels: Number of overviews the band exposes
+
+    Returns:
+        Optional[int]: Overview level to open, None for full resolution
+    """
+    if not target_resolution or target_resolution <= native_resolution or not available_levels:
+        return None
+    factor = int(math.log2(target_resolution / native_resolution))
+    if factor < 1:
+        return None
+    return min(factor - 1, available_levels - 1)
+
+def bounds_window(bounds: tuple, transform: Affine, width: int, height: int) -> Optional[Window]:
+    """
+    Pixel window covering bounds in the CRS of a raster grid
+
+    The bounds are snapped outwards to whole pixels and intersected with
+    the grid extent.
+
+    Returns:
+        Optional[Window]: Window inside the grid, None if there is no overlap
+    """
+    left, bottom, right, top = bounds
+    inverse = ~transform
+    col_min, row_min = inverse * (left, top)
+    col_max, row_max = inverse * (right, bottom)
+
+    col_off = max(0, math.floor(min(col_min, col_max)))
+    row_off = max(0, math.floor(min(row_min, row_max)))
+    col_end = min(width, math.ceil(max(col_min, col_max)))
+    row_end = min(height, math.ceil(max(row_min, row_max)))
+
+    if col_end <= col_off or row_end <= row_off:
+        return None
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+def aoi_window(dataset: rasterio.DatasetReader, bounds: tuple, bounds_crs: str = 'EPSG:4326') -> Optional[Window]:
+    """
+    Compute the pixel window covering an AOI envelope
+
+    The envelope is reprojected into the dataset CRS, snapped outwards to
+    whole pixels and intersected with the dataset extent.
+
+    Args:
+        dataset: Open raster the window refers to
+        bounds: AOI envelope as (min_x, min_y, max_x, max_y)
+        bounds_crs: CRS of the envelope
+
+    Returns:
+        Optional[Window]: Window inside the dataset, None if there is no overlap
+    """
+    projected = transform_bounds(bounds_crs, dataset.crs, *bounds)
+    return bounds_window(projected, dataset.transform, dataset.width, dataset.height)
+
+# Guards the geometry and mask caches shared by worker threads
+_MASK_CACHE_LOCK = threading.Lock()
+
+# Reprojected AOI geometries by (geometry, source CRS, target CRS)
+_GEOMETRY_CACHE: "OrderedDict[tuple, Any]" = OrderedDict()
+GEOMETRY_CACHE_SIZE = 64
+
+def reproject_geometry(geometry, dst_crs, src_crs='EPSG:4326'):
+    """
+    Reproject a geometry, caching the result per target CRS
+
+    All products of a UTM zone share an EPSG code, so the AOI is only
+    transformed once per zone.
+
+    Args:
+        geometry: Shapely geometry or GeoJSON-like mapping
+        dst_crs: Target CRS (EPSG string, WKT or rasterio CRS)
+        src_crs: CRS of the geometry
+
+    Returns:
+        Shapely geometry in dst_crs
+    """
+    geom = shape(geometry) if isinstance(geometry, dict) else geometry
+    dst, src = CRS.from_user_input(dst_crs), CRS.from_user_input(src_crs)
+    if dst == src:
+        return geom
+    key = (geom.wkb, src.to_string(), dst.to_string())
+    with _MASK_CACHE_LOCK:
+        projected = _GEOMETRY_CACHE.get(key)
+        if projected is not None:
+            _GEOMETRY_CACHE.move_to_end(key)
+            return projected
+
+    projected = shape(transform_geom(src, dst, mapping(geom)))
+    with _MASK_CACHE_LOCK:
+        _GEOMETRY_CACHE[key] = projected
+        while len(_GEOMETRY_CACHE) > GEOMETRY_CACHE_SIZE:
+            _GEOMETRY_CACHE.popitem(last=False)
+    return projected
+
+# Rasterised AOI masks by (geometry, transform, shape, all_touched), most recent last
+_MASK_CACHE: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+MASK_CACHE_SIZE = 16
+
+def aoi_mask(geometry, transform: Affine, out_shape: Tuple[int, int], all_touched: bool = True) -> np.ndarray:
+    """
+    Rasterise a polygon into a boolean mask, True inside, once per raster grid
+
+    Masks are cached by geometry, transform and shape, so every band of a
+    product and every product on the same MGRS tile reuse one
+    rasterisation. Cached masks are shared and read-only.
+
+    Args:
+        geometry: Shapely geometry or GeoJSON-like mapping, in the grid CRS
+        transform: Geotransform of the grid
+        out_shape: (rows, cols) of the grid
+        all_touched: Include every pixel touched by the polygon
+
+    Returns:
+        np.ndarray: Read-only boolean mask
+    """
+    geom = shape(geometry) if isinstance(geometry, dict) else geometry
+    key = (geom.wkb, tuple(transform)[:6], tuple(out_shape), all_touched)
+    with _MASK_CACHE_LOCK:
+        mask = _MASK_CACHE.get(key)
+        if mask is not None:
+            _MASK_CACHE.move_to_end(key)
+            return mask
+
+    mask = geometry_mask([mapping(geom)], out_shape=tuple(out_shape), transform=transform,
+                         invert=True, all_touched=all_touched)
+    mask.setflags(write=False)
+    with _MASK_CACHE_LOCK:
+        _MASK_CACHE[key] = mask
+        while len(_MASK_CACHE) > MASK_CACHE_SIZE:
+            _MASK_CACHE.popitem(last=False)
+    return mask
+
+def apply_mask(data: np.ndarray, mask: np.ndarray, nodata: float = 0) -> np.ndarray:
+    """Set pixels outside mask to nodata in place, for one band or a (bands, rows, cols) stack"""
+    np.copyto(data, np.asarray(nodata, dtype=data.dtype), where=~mask)
+    return data
+
+def fit_block_size(block_size: int, count: int, dtype: str, max_block_memory_mb: float) -> int:
+    """
+    Shrink a square block edge until one block of all bands fits the memory budget
+
+    Args:
+        block_size: Requested block edge in pixels
+        count: Number of bands held per block
+        dtype: Numpy dtype name of the pixels
+        max_block_memory_mb: Memory budget for a single block of all bands
+
+    Returns:
+        int: Block edge in pixels, a multiple of 16 as required by tiled GeoTIFFs
+    """
+    itemsize = np.dtype(dtype).itemsize
+    budget = max_block_memory_mb * 1024 * 1024
+    while block_size > 16 and block_size * block_size * count * itemsize > budget:
+        block_size //= 2
+    return max(16, block_size - block_size % 16)
+
+def stream_clip_bands(band_files: Dict[str, Path],
+                      clips: Dict[Path, Tuple[Window, Any]],
+                      block_size: int = 512,
+                      max_block_memory_mb: float = 64,
+                      overview_level: Optional[int] = None,
+                      cog: Optional[Dict[str, Any]] = None,
+                      nodata_mask: Optional[Callable[[Window], np.ndarray]] = None) -> List[Path]:
+    """
+    Stack single-band rasters into several clipped GeoTIFFs in one pass
+
+    The union of the clip windows is read block by block, each block of
+    every band is decoded once, and the part of it falling inside each
+    clip window is written to that clip. Blocks outside every clip are
+    never read, nor are the bands of blocks fully covered by nodata_mask.
+
+    Args:
+        band_files: Ordered mapping of band name to band file
+        clips: {output path: (source window, polygon in the band CRS or None)};
+            pixels outside a polygon are set to 0 (nodata)
+        block_size: Edge of the read blocks and output tiles in pixels
+        max_block_memory_mb: Memory budget for one block of all bands
+        overview_level: Source overview (JP2 resolution level) to read from
+        cog: 'raster_output' settings of the Cloud-Optimized GeoTIFF outputs
+        nodata_mask: Returns, for a source window, True where pixels are set
+            to 0 (nodata), e.g. cloudy pixels from the scene classification
+
+    Returns:
+        List[Path]: The written clips
+    """
+    open_kwargs = {} if overview_level is None else {'overview_level': overview_level}
+    union = windows.union(*(window for window, _ in clips.values()))
+    with ExitStack() as stack:
+        sources = [stack.enter_context(rasterio.open(band_file, **open_kwargs))
+                   for band_file in band_files.values()]
+        base_profile = sources[0].profile
+        block_size = fit_block_size(block_size, len(sources),
+                                    base_profile['dtype'], max_block_memory_mb)
+
+        dsts = {}
+        masks = {}
+        for output_path, (window, mask_geometry) in clips.items():
+            profile = dict(base_profile)
+            profile.update({
+                'width': int(window.width),
+                'height': int(window.height),
+                'transform': sources[0].window_transform(window),
+                'count': len(sources)
+            })
+            profile = cog_profile(profile, cog, block_size)
+            if mask_geometry is not None:
+                masks[output_path] = aoi_mask(mask_geometry, profile['transform'],
+                                              (profile['height'], profile['width']))
+            if mask_geometry is not None or nodata_mask is not None:
+                profile['nodata'] = 0
+            dst = stack.enter_context(rasterio.open(output_path, 'w', **profile))
+            for idx, name in enumerate(band_files, start=1):
+                dst.set_band_description(idx, name)
+            dsts[output_path] = dst
+
+        row_end = int(union.row_off + union.height)
+        col_end = int(union.col_off + union.width)
+        masked_blocks = 0
+        for row in range(int(union.row_off), row_end, block_size):
+            for col in range(int(union.col_off), col_end, block_size):
+                block_window = Window(col, row, min(block_size, col_end - col), min(block_size, row_end - row))
+                block = None
+                for output_path, (window, _) in clips.items():
+                    if not windows.intersect(block_window, window):
+                        continue
+                    if block is None:
+                        masked = nodata_mask(block_window) if nodata_mask is not None else None
+                        if masked is not None and masked.all():
+                            # Nothing to decode: the block is nodata in every band
+                            block = np.zeros((len(sources), int(block_window.height), int(block_window.width)),
+                                             dtype=base_profile['dtype'])
+                            masked_blocks += 1
+                        else:
+                            block = np.stack([src.read(1, window=block_window) for src in sources])
+                            if masked is not None:
+                                apply_mask(block, ~masked)
+
+                    part = block_window.intersection(window)
+                    rows = slice(int(part.row_off - row), int(part.row_off - row + part.height))
+                    cols = slice(int(part.col_off - col), int(part.col_off - col + part.width))
+                    dst_window = Window(part.col_off - window.col_off, part.row_off - window.row_off,
+                                        part.width, part.height)
+                    data = block[:, rows, cols]
+                    if output_path in masks:
+                        (mask_row0, mask_row1), (mask_col0, mask_col1) = dst_window.toranges()
+                        data = apply_mask(data.copy(),
+                                          masks[output_path][int(mask_row0):int(mask_row1),
+                                                             int(mask_col0):int(mask_col1)])
+                    dsts[output_path].write(data, window=dst_window)
+
+    for output_path in clips:
+        finalize_cog(output_path, cog)
+    logging.info(f"Streamed {len(band_files)} bands to {len(clips)} clips "
+                 f"from a {int(union.width)}x{int(union.height)} window"
+                 + (f", {masked_blocks} fully masked blocks not decoded" if masked_blocks else ""))
+    return list(clips)
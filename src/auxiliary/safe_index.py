@@ -0,0 +1,264 @@
+"""
+Persistent SQLite index of Sentinel-2 L2A SAFE products
+
+Each product is parsed once from its MTD_MSIL2A.xml (tile, sensing time,
+cloud cover, granules and the image file of every band at every
+resolution); later lookups are primary-key queries instead of globbing
+the SAFE tree. Products are re-parsed only when their SAFE directory or
+zip changes.
+"""
+import os
+import sqlite3
+import logging
+import zipfile
+import threading
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+# Resolution directories of IMG_DATA, finest first
+RESOLUTIONS = ['R10m', 'R20m', 'R60m']
+
+METADATA_FILE = 'MTD_MSIL2A.xml'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    name TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    tile TEXT,
+    sensing_time TEXT,
+    cloud_cover REAL
+);
+CREATE TABLE IF NOT EXISTS bands (
+    product TEXT NOT NULL REFERENCES products(name) ON DELETE CASCADE,
+    granule TEXT NOT NULL,
+    resolution TEXT NOT NULL,
+    band TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (product, granule, resolution, band)
+);
+CREATE INDEX IF NOT EXISTS products_tile_time ON products (tile, sensing_time);
+"""
+
+def product_name(source: Union[str, Path]) -> str:
+    """Product identifier shared by a SAFE directory and its zip"""
+    return Path(source).name.split('.')[0]
+
+def _local(tag: str) -> str:
+    """Element tag without its XML namespace"""
+    return tag.rsplit('}', 1)[-1]
+
+def parse_product_metadata(xml_bytes: bytes) -> Dict[str, Any]:
+    """
+    Parse the fields of an MTD_MSIL2A.xml the index needs
+
+    Returns:
+        dict: sensing_time, cloud_cover and image_files, the IMG_DATA
+            paths relative to the SAFE root without extension
+    """
+    root = ET.fromstring(xml_bytes)
+    metadata = {'sensing_time': None, 'cloud_cover': None, 'image_files': []}
+    for element in root.iter():
+        tag = _local(element.tag)
+        if tag == 'PRODUCT_START_TIME' and metadata['sensing_time'] is None:
+            metadata['sensing_time'] = element.text.strip().rstrip('Z')
+        elif tag == 'Cloud_Coverage_Assessment' and metadata['cloud_cover'] is None:
+            metadata['cloud_cover'] = float(element.text)
+        elif tag == 'IMAGE_FILE':
+            metadata['image_files'].append(element.text.strip())
+    return metadata
+
+def band_entry(image_file: str) -> Optional[tuple]:
+    """(granule, resolution, band) of an IMG_DATA path, None for other files"""
+    parts = image_file.split('/')
+    if len(parts) < 5 or parts[0] != 'GRANULE' or parts[2] != 'IMG_DATA' or parts[3] not in RESOLUTIONS:
+        return None
+    name_parts = Path(parts[-1]).stem.split('_')
+    if len(name_parts) < 3:
+        return None
+    return parts[1], parts[3], name_parts[2]
+
+class SafeIndex:
+    def __init__(self, db_path: Union[str, Path]):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.executescript(SCHEMA)
+
+    @classmethod
+    def from_config(cls, root_dir: Path, config: Dict[str, Any]) -> "SafeIndex":
+        """Open the index named by cache.safe_index in config.yaml"""
+        path = config.get('cache', {}).get('safe_index', 'data/cache/safe_index.sqlite')
+        return cls(Path(root_dir) / path)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> "SafeIndex":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _read_source(self, source: Path) -> Dict[str, Any]:
+        """Metadata and band file paths of a SAFE directory or zip"""
+        if source.suffix.lower() == '.zip':
+            with zipfile.ZipFile(source) as zip_ref:
+                names = zip_ref.namelist()
+                safe_root = names[0].split('/')[0]
+                metadata = parse_product_metadata(zip_ref.read(f"{safe_root}/{METADATA_FILE}"))
+            prefix = f"/vsizip/{source.resolve().as_posix()}/{safe_root}"
+            metadata['paths'] = {image_file: f"{prefix}/{image_file}.jp2"
+                                 for image_file in metadata['image_files']}
+            return metadata
+
+        metadata_file = source / METADATA_FILE
+        if metadata_file.exists():
+            metadata = parse_product_metadata(metadata_file.read_bytes())
+        else:
+            # Partial extractions without the product metadata: list IMG_DATA once
+            logging.warning(f"{METADATA_FILE} not found in {source.name}, listing IMG_DATA instead")
+            metadata = {'sensing_time': None, 'cloud_cover': None, 'image_files': []}
+            for res_dir in sorted(source.glob('GRANULE/*/IMG_DATA/R*m')):
+                granule = res_dir.parent.parent.name
+                metadata['image_files'].extend(
+                    f"GRANULE/{granule}/IMG_DATA/{res_dir.name}/{entry.name[:-4]}"
+                    for entry in sorted(os.scandir(res_dir), key=lambda e: e.name)
+                    if entry.name.endswith('.jp2'))
+        metadata['paths'] = {image_file: str(source / f"{image_file}.jp2")
+                             for image_file in metadata['image_files']}
+        return metadata
+
+    def index(self, source: Union[str, Path], force: bool = False) -> Optional[str]:
+        """
+        Add or refresh a SAFE directory or zip in the index
+
+        Args:
+            source: SAFE directory or SAFE zip
+            force: Re-parse even if the source is unchanged
+
+        Returns:
+            Optional[str]: Product name, None if the source could not be indexed
+        """
+        source = Path(source)
+        name = product_name(source)
+        try:
+            mtime_ns = source.stat().st_mtime_ns
+            row = self.conn.execute("SELECT path, mtime_ns FROM products WHERE name = ?", (name,)).fetchone()
+            if not force and row and row['path'] == str(source) and row['mtime_ns'] == mtime_ns:
+                return name
+
+            metadata = self._read_source(source)
+            name_parts = name.split('_')
+            tile = name_parts[5][1:] if len(name_parts) > 5 else None
+            sensing_time = metadata['sensing_time']
+            if sensing_time is None and len(name_parts) > 2:
+                sensing_time = datetime.strptime(name_parts[2], '%Y%m%dT%H%M%S').isoformat()
+
+            bands = []
+            for image_file, path in metadata['paths'].items():
+                entry = band_entry(image_file)
+                if entry:
+                    bands.append((name, *entry, path))
+
+            with self._lock, self.conn:
+                self.conn.execute("DELETE FROM products WHERE name = ?", (name,))
+                self.conn.execute(
+                    "INSERT INTO products (name, path, mtime_ns, tile, sensing_time, cloud_cover) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (name, str(source), mtime_ns, tile, sensing_time, metadata['cloud_cover']))
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO bands (product, granule, resolution, band, path) "
+                    "VALUES (?, ?, ?, ?, ?)", bands)
+            logging.info(f"Indexed {name}: {len(bands)} band files")
+            return name
+
+        except Exception as e:
+            logging.error(f"Error indexing {source}: {str(e)}")
+            return None
+
+    def index_dir(self, raw_dir: Union[str, Path]) -> List[str]:
+        """Index every SAFE directory and SAFE zip in raw_dir"""
+        names = []
+        for source in sorted(Path(raw_dir).iterdir()):
+            if source.suffix.lower() == '.zip' or (source.is_dir() and (source / 'GRANULE').exists()):
+                name = self.index(source)
+                if name:
+                    names.append(name)
+        return names
+
+    def product(self, name: str) -> Optional[Dict[str, Any]]:
+        """Indexed metadata of a product"""
+        row = self.conn.execute("SELECT * FROM products WHERE name = ?", (name,)).fetchone()
+        return dict(row) if row else None
+
+    def granules(self, name: str) -> List[str]:
+        """Granules of a product"""
+        rows = self.conn.execute("SELECT DISTINCT granule FROM bands WHERE product = ? ORDER BY granule",
+                                 (name,))
+        return [row['granule'] for row in rows]
+
+    def band_paths(self,
+                   name: str,
+                   bands: Iterable[str],
+                   resolution: Optional[str] = None,
+                   granule: Optional[str] = None) -> Dict[str, str]:
+        """
+        Paths of the requested bands of a product
+
+        Args:
+            name: Product name
+            bands: Band names, e.g. ['B02', 'B03', 'B04', 'B08'] or ['SCL']
+            resolution: Resolution directory, the finest one having each band if None
+            granule: Granule directory, the first granule if None
+
+        Returns:
+            dict: {band_name: path} for the bands present on disk (or in the zip)
+        """
+        if granule is None:
+            granules = self.granules(name)
+            if not granules:
+                return {}
+            granule = granules[0]
+
+        bands = list(bands)
+        placeholders = ', '.join('?' * len(bands))
+        rows = self.conn.execute(
+            f"SELECT band, resolution, path FROM bands WHERE product = ? AND granule = ? "
+            f"AND band IN ({placeholders})", (name, granule, *bands)).fetchall()
+
+        paths = {}
+        for res in ([resolution] if resolution else RESOLUTIONS):
+            for row in rows:
+                if (row['resolution'] == res and row['band'] not in paths
+                        and (row['path'].startswith('/vsizip/') or Path(row['path']).exists())):
+                    paths[row['band']] = row['path']
+        return {band: paths[band] for band in bands if band in paths}
+
+    def query(self,
+              tile: Optional[str] = None,
+              start: Optional[str] = None,
+              end: Optional[str] = None,
+              max_cloud_cover: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Products matching a tile, an ISO sensing time range and a cloud cover limit"""
+        clauses, params = [], []
+        if tile:
+            clauses.append("tile = ?")
+            params.append(tile)
+        if start:
+            clauses.append("sensing_time >= ?")
+            params.append(start)
+        if end:
+            clauses.append("sensing_time <= ?")
+            params.append(end)
+        if max_cloud_cover is not None:
+            clauses.append("(cloud_cover IS NULL OR cloud_cover <= ?)")
+            params.append(max_cloud_cover)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self.conn.execute(f"SELECT * FROM products {where} ORDER BY sensing_time", params)
+        return [dict(row) for row in rows]
@@ -0,0 +1,132 @@
+"""
+Sentinel-2 L2A Scene Classification (SCL) helpers
+
+The SCL layer is delivered at 20 m in IMG_DATA/R20m. Stages read it block
+by block on the grid of the 10 m products: on grids that subdivide the
+SCL pixels (the bands of the same tile and clips of them) each 20 m
+class is repeated over the 10 m pixels it covers, other grids go through
+a nearest-neighbour warped view. Class values become a mask through a
+256-entry lookup table instead of one comparison per masked class.
+"""
+import math
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, bounds as window_bounds
+
+from src.auxiliary.raster_utils import bounds_window
+
+# Scene Classification classes of the L2A processor
+SCL_CLASSES = {
+    0: 'No data',
+    1: 'Saturated or defective',
+    2: 'Dark area pixels',
+    3: 'Cloud shadows',
+    4: 'Vegetation',
+    5: 'Not vegetated',
+    6: 'Water',
+    7: 'Unclassified',
+    8: 'Cloud medium probability',
+    9: 'Cloud high probability',
+    10: 'Thin cirrus',
+    11: 'Snow or ice'
+}
+
+# No data, defective pixels, cloud shadows, clouds and cirrus
+DEFAULT_MASK_CLASSES = [0, 1, 3, 8, 9, 10]
+
+def mask_lut(classes: Optional[Iterable[int]] = None) -> np.ndarray:
+    """Lookup table, True for the SCL values to mask"""
+    lut = np.zeros(256, dtype=bool)
+    lut[list(DEFAULT_MASK_CLASSES if classes is None else classes)] = True
+    return lut
+
+def masked_pixels(scl: np.ndarray, lut: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """True where the SCL class is masked by lut"""
+    return np.take(lut, scl, out=out)
+
+def _whole(value: float) -> Optional[int]:
+    """value as an int if it is a whole number, else None"""
+    rounded = round(value)
+    return int(rounded) if math.isclose(value, rounded, abs_tol=1e-6) else None
+
+def grid_factor(scl: rasterio.DatasetReader, crs, transform: Affine) -> Optional[Tuple[int, int, int]]:
+    """
+    Relation between the SCL grid and a grid subdividing its pixels
+
+    Returns:
+        Optional[Tuple[int, int, int]]: (factor, row offset, col offset) such that
+            pixel (row, col) of the grid lies in SCL pixel
+            ((row + row offset) // factor, (col + col offset) // factor),
+            None if the grids are not aligned that way
+    """
+    if scl.crs != crs or transform.b or transform.d or scl.transform.b or scl.transform.d:
+        return None
+    factor = _whole(scl.transform.a / transform.a)
+    if not factor or factor < 1 or _whole(scl.transform.e / transform.e) != factor:
+        return None
+    row_off = _whole((transform.f - scl.transform.f) / transform.e)
+    col_off = _whole((transform.c - scl.transform.c) / transform.a)
+    if row_off is None or col_off is None:
+        return None
+    return factor, row_off, col_off
+
+def read_repeated(scl: rasterio.DatasetReader, window: Window, factor: int,
+                  row_off: int = 0, col_off: int = 0) -> np.ndarray:
+    """
+    Read the SCL under a window of a grid factor times finer
+
+    Only the covering SCL pixels are decoded; each is repeated factor x
+    factor times and the result cropped to the window.
+    """
+    (row_start, row_stop), (col_start, col_stop) = window.toranges()
+    row_start, row_stop = int(row_start) + row_off, int(row_stop) + row_off
+    col_start, col_stop = int(col_start) + col_off, int(col_stop) + col_off
+    coarse_window = Window(col_start // factor, row_start // factor,
+                           (col_stop - 1) // factor - col_start // factor + 1,
+                           (row_stop - 1) // factor - row_start // factor + 1)
+    boundless = (coarse_window.col_off < 0 or coarse_window.row_off < 0
+                 or coarse_window.col_off + coarse_window.width > scl.width
+                 or coarse_window.row_off + coarse_window.height > scl.height)
+    coarse = scl.read(1, window=coarse_window, boundless=boundless, fill_value=0)
+    if factor > 1:
+        coarse = coarse.repeat(factor, axis=0).repeat(factor, axis=1)
+    rows = slice(row_start % factor, row_start % factor + row_stop - row_start)
+    cols = slice(col_start % factor, col_start % factor + col_stop - col_start)
+    return coarse[rows, cols]
+
+@contextmanager
+def scl_blocks(scl_path: str, crs, transform: Affine, width: int, height: int) -> Iterator[Callable[[Window], np.ndarray]]:
+    """
+    Open an SCL band as a block reader on another raster grid
+
+    Yields a function returning the SCL classes under a window of the
+    target grid. Pixels outside the SCL extent read as 0 (no data).
+    """
+    with rasterio.open(scl_path) as src:
+        aligned = grid_factor(src, crs, transform)
+        if aligned is not None:
+            yield lambda window: read_repeated(src, window, *aligned)
+            return
+        with WarpedVRT(src, crs=crs, transform=transform, width=width, height=height,
+                       resampling=Resampling.nearest, nodata=0) as vrt:
+            yield lambda window: vrt.read(1, window=window)
+
+def masked_fraction(scl_path: str, crs, transform: Affine, window: Window, lut: np.ndarray) -> float:
+    """
+    Fraction of masked SCL pixels under a window of another grid
+
+    Computed on the 20 m SCL pixels covering the window, without
+    resampling; the window counts as fully masked outside the SCL extent.
+    """
+    with rasterio.open(scl_path) as src:
+        bounds = transform_bounds(crs, src.crs, *window_bounds(window, transform))
+        scl_window = bounds_window(bounds, src.transform, src.width, src.height)
+        if scl_window is None:
+            return 1.0
+        return float(masked_pixels(src.read(1, window=scl_window), lut).mean())
@@ -3,7 +3,7 @@ import logging
 import zipfile
 import shutil
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List
 
 def get_short_name(filename: str) -> str:
     """Create a shorter name from Sentinel-2 product identifier"""
@@ -11,13 +11,24 @@ def get_short_name(filename: str) -> str:
     # Use satellite, date, and tile info only
     return f"{parts[0]}_{parts[2][:8]}_{parts[5]}"
 
-def unzip_sentinel_data(zip_path: str, output_dir: str) -> str:
+def is_extracted(zip_ref: zipfile.ZipFile, output_dir: Path) -> bool:
+    """True if every file member of the zip already exists with the same size"""
+    for info in zip_ref.infolist():
+        if info.is_dir():
+            continue
+        target = output_dir / info.filename
+        if not target.exists() or target.stat().st_size != info.file_size:
+            return False
+    return True
+
+def unzip_sentinel_data(zip_path: str, output_dir: str, overwrite: bool = False) -> str:
     """
     Unzip Sentinel-2 data in place and return the path to the SAFE directory
     
     Args:
         zip_path: Path to the zip file
         output_dir: Directory where to extract the data
+        overwrite: Re-extract even if a complete SAFE directory already exists
     
     Returns:
         Path to the extracted SAFE directory or empty string if failed
@@ -33,14 +44,19 @@ def unzip_sentinel_data(zip_path: str, output_dir: str) -> str:
         
         safe_path = output_dir / safe_name
         
-        # Remove existing directory if present
-        if safe_path.exists():
-            logging.info(f"Removing existing directory: {safe_path}")
-            shutil.rmtree(safe_path)
-        
-        # Extract to the output directory
-        logging.info(f"Extracting {zip_path} to {output_dir}")
         with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            # Keep a complete existing extraction
+            if safe_path.exists() and not overwrite and is_extracted(zip_ref, output_dir):
+                logging.info(f"Already extracted: {safe_path}")
+                return str(safe_path)
+            
+            # Remove existing directory if present
+            if safe_path.exists():
+                logging.info(f"Removing existing directory: {safe_path}")
+                shutil.rmtree(safe_path)
+            
+            # Extract to the output directory
+            logging.info(f"Extracting {zip_path} to {output_dir}")
             zip_ref.extractall(output_dir)
         
         logging.info(f"Extraction complete: {safe_path}")
@@ -48,4 +64,85 @@ def unzip_sentinel_data(zip_path: str, output_dir: str) -> str:
     
     except Exception as e:
         logging.error(f"Error extracting {zip_path}: {str(e)}")
-        return ""
\ No newline at end of file
+        return ""
+
+def find_band_members(zip_path: str, bands: List[str], resolution: str = "R10m") -> Dict[str, str]:
+    """
+    Find the JP2 members of the requested bands inside a SAFE zip
+
+    Args:
+        zip_path: Path to the zip file
+        bands: Band names to look for, e.g. ['B02', 'B03', 'B04', 'B08']
+        resolution: Resolution folder of IMG_DATA
+
+    Returns:
+        dict: {band_name: member name} for the bands found in the first granule
+    """
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        names = sorted(name for name in zip_ref.namelist()
+                       if f"/IMG_DATA/{resolution}/" in name and name.endswith('.jp2'))
+
+    members = {}
+    for band in bands:
+        matches = [name for name in names if f"_{band}_" in Path(name).name]
+        if matches:
+            members[band] = matches[0]
+    return members
+
+def vsizip_band_paths(zip_path: str, bands: List[str], resolution: str = "R10m") -> Dict[str, str]:
+    """
+    Build GDAL /vsizip/ paths to the requested bands, reading them in place
+
+    Args:
+        zip_path: Path to the zip file
+        bands: Band names to look for
+        resolution: Resolution folder of IMG_DATA
+
+    Returns:
+        dict: {band_name: '/vsizip/...' path} openable by rasterio/GDAL
+    """
+    zip_posix = Path(zip_path).resolve().as_posix()
+    return {band: f"/vsizip/{zip_posix}/{member}"
+            for band, member in find_band_members(zip_path, bands, resolution).items()}
+
+def extract_band_members(zip_path: str, output_dir: str, bands: List[str], resolution: str = "R10m") -> str:
+    """
+    Extract only the requested band JP2 files of a SAFE zip
+
+    The product metadata (MTD_MSIL2A.xml) is extracted along with them so
+    the SAFE index can be built from it. Members already extracted with
+    the same size are left untouched, so repeated runs do not rewrite them.
+
+    Args:
+        zip_path: Path to the zip file
+        output_dir: Directory where to extract the data
+        bands: Band names to extract
+        resolution: Resolution folder of IMG_DATA
+
+    Returns:
+        Path to the SAFE directory or empty string if failed
+    """
+    try:
+        members = find_band_members(zip_path, bands, resolution)
+        if not members:
+            logging.error(f"No {resolution} band members found in {zip_path}")
+            return ""
+
+        output_dir = Path(output_dir)
+        safe_name = next(iter(members.values())).split('/')[0]
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            metadata_member = f"{safe_name}/MTD_MSIL2A.xml"
+            if metadata_member in zip_ref.namelist():
+                members['metadata'] = metadata_member
+            for band, member in members.items():
+                target = output_dir / member
+                if target.exists() and target.stat().st_size == zip_ref.getinfo(member).file_size:
+                    continue
+                zip_ref.extract(member, output_dir)
+                logging.info(f"Extracted {band}: {Path(member).name}")
+
+        return str(output_dir / safe_name)
+
+    except Exception as e:
+        logging.error(f"Error extracting bands from {zip_path}: {str(e)}")
+        return ""
@@ -0,0 +1,308 @@
+"""
+Benchmark suite for the pipeline hot paths on synthetic Sentinel-2 products
+
+Times unzip_sentinel_data, process_safe_directory, clip_to_aoi,
+process_sentinel_data and classify_ndvi for every configured tile size,
+and a full preprocessing run for every worker count. Results are stored
+in results/benchmarks and compared with a baseline run: medians slower
+than the baseline by more than the tolerance are reported as regressions,
+as are cases whose runs fail.
+"""
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import logging
+import platform
+import statistics
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+import numpy as np
+import rasterio
+
+# Add project root to Python path
+current_file = Path(__file__).resolve()
+project_root = None
+for parent in current_file.parents:
+    if parent.name == "processing-root-folder":
+        project_root = parent
+        break
+if project_root is None:
+    raise RuntimeError("Project root 'processing-root-folder' not found")
+sys.path.append(str(project_root))
+
+from src.auxiliary.config_utils import load_config
+from src.auxiliary.metrics_utils import run_metrics
+from src.auxiliary.unzip_utils import unzip_sentinel_data
+from src.auxiliary.aoi_utils import AOISet
+from src.main.preprocessing.preprocessing import PreprocessingPipeline
+from src.main.processing.processing import process_sentinel_data
+from src.main.analysis.analysis import classify_ndvi
+from src.benchmarks.synthetic import BANDS, make_safe, make_zip, make_aois, clear_outputs
+
+def setup_logging():
+    """Configure logging"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+def environment() -> Dict[str, Any]:
+    """Versions and hardware the results were measured on"""
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'rasterio': rasterio.__version__,
+        'gdal': rasterio.__gdal_version__
+    }
+
+def time_case(run: Callable[[], Any],
+              repeats: int,
+              setup: Optional[Callable[[], Any]] = None,
+              check: Callable[[Any], bool] = bool) -> Dict[str, float]:
+    """
+    Time repeated runs of a benchmark case
+
+    Args:
+        run: The timed call
+        repeats: Number of timed runs
+        setup: Untimed call before every run, e.g. to remove previous outputs
+        check: Predicate on the result of a run; the pipeline functions report
+            failure through their return value (False, "" or [])
+
+    Returns:
+        dict: min_s, median_s and mean_s over the runs
+
+    Raises:
+        RuntimeError: If a run fails its check, so a broken run is never timed as fast
+    """
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = run()
+        times.append(time.perf_counter() - start)
+        if not check(result):
+            raise RuntimeError(f"Run failed its check (returned {result!r})")
+    return {
+        'min_s': min(times),
+        'median_s': statistics.median(times),
+        'mean_s': statistics.fmean(times)
+    }
+
+def case_key(result: Dict[str, Any]) -> str:
+    """Identity of a case across runs"""
+    return f"{result['case']}/size={result['size']}/workers={result['workers']}"
+
+class BenchmarkSuite:
+    def __init__(self, root_dir: Path, config: Optional[Dict[str, Any]] = None):
+        self.root_dir = root_dir
+        self.config = config if config is not None else load_config(root_dir)
+        self.settings = self.config.get('benchmark', {})
+        self.workspace = root_dir / self.settings.get('workspace', 'data/benchmarks')
+        self.repeats = self.settings.get('repeats', 3)
+        self.seed = self.settings.get('seed', 42)
+        self.results = []
+
+    def pipeline_config(self, workers: int = 1) -> Dict[str, Any]:
+        """Pipeline config of a workspace: no stage cache, local SAFE index and AOIs"""
+        config = copy.deepcopy(self.config)
+        config.setdefault('cache', {}).update({'enabled': False, 'safe_index': 'data/cache/safe_index.sqlite'})
+        config.setdefault('preprocessing', {}).update({'aoi': 'aois.geojson', 'workers': workers})
+        return config
+
+    def fixtures(self, size: int) -> Path:
+        """Workspace of a tile size with its SAFE directories, zips and AOIs, generated once"""
+        root = self.workspace / f"size_{size}"
+        tiles = self.settings.get('tiles', 4)
+        raw_dir = root / "data" / "raw" / "Sentinel-2"
+        for index in range(tiles):
+            safe_path = make_safe(raw_dir, size, index, self.seed)
+            make_zip(safe_path, root / "zips")
+        make_aois(root / "aois.geojson", tiles, size, self.settings.get('aois', 3), self.seed)
+        return root
+
+    def record(self, case: str, size: int, workers: int, pixels: int, timing: Dict[str, float],
+               peak_rss: Optional[int] = None) -> None:
+        result = {'case': case, 'size': size, 'workers': workers, 'repeats': self.repeats, **timing,
+                  'mpx_per_s': pixels / timing['median_s'] / 1e6 if timing['median_s'] else 0.0,
+                  'peak_rss_bytes': peak_rss}
+        self.results.append(result)
+        logging.info(f"{case_key(result)}: median {timing['median_s']:.3f}s, "
+                     f"min {timing['min_s']:.3f}s, {result['mpx_per_s']:.1f} Mpx/s")
+
+    def run_case(self, case: str, size: int, workers: int, pixels: int,
+                 run: Callable[[], Any], setup: Optional[Callable[[], Any]] = None,
+                 check: Callable[[Any], bool] = bool) -> None:
+        """Time a case and record it with its peak RSS, or record it as failed if a run fails"""
+        key = case_key({'case': case, 'size': size, 'workers': workers})
+        try:
+            with run_metrics.measure('benchmark', key):
+                timing = time_case(run, self.repeats, setup, check)
+            peak_rss = next((record['peak_rss_bytes'] for record in run_metrics.records()
+                             if record['stage'] == 'benchmark' and record['product'] == key), None)
+            self.record(case, size, workers, pixels, timing, peak_rss)
+        except Exception as e:
+            self.record_failure(case, size, workers, str(e))
+
+    def record_failure(self, case: str, size: int, workers: int, error: str) -> None:
+        """Record a case that could not be timed"""
+        result = {'case': case, 'size': size, 'workers': workers, 'repeats': self.repeats,
+                  'failed': True, 'error': error}
+        self.results.append(result)
+        logging.error(f"{case_key(result)}: failed - {error}")
+
+    def run_size(self, size: int) -> None:
+        """Time the single-product hot paths on one tile size"""
+        root = self.fixtures(size)
+        clear_outputs(root)
+        config = self.pipeline_config()
+        pipeline = PreprocessingPipeline(root, config)
+        aois = AOISet.from_path(root / "aois.geojson")
+        safe_path = sorted((root / "data" / "raw" / "Sentinel-2").glob("*.SAFE"))[0]
+        zip_path = sorted((root / "zips").glob("*.zip"))[0]
+        band_pixels = size * size * len(BANDS)
+        scratch = root / "scratch"
+
+        # Extraction of a whole product
+        unzip_dir = scratch / "unzip"
+        self.run_case('unzip_sentinel_data', size, 1, band_pixels,
+                      lambda: unzip_sentinel_data(str(zip_path), str(unzip_dir), overwrite=True))
+
+        # Stack and clip to every AOI in one read
+        clip_dir = scratch / "clipped"
+        self.run_case('process_safe_directory', size, 1, band_pixels,
+                      lambda: pipeline.process_safe_directory(safe_path, clip_dir, BANDS, aois),
+                      setup=lambda: shutil.rmtree(clip_dir, ignore_errors=True))
+
+        # Full-tile stack, then a GDAL clip to the first AOI
+        stack_dir = scratch / "stack"
+        try:
+            stack_paths = pipeline.process_safe_directory(safe_path, stack_dir, BANDS)
+            stack_error = "Full-tile stack produced no output"
+        except Exception as e:
+            stack_paths, stack_error = [], f"Full-tile stack failed: {str(e)}"
+        if stack_paths:
+            aoi = next(iter(aois))
+            self.run_case('clip_to_aoi', size, 1, band_pixels,
+                          lambda: pipeline.clip_to_aoi(stack_paths[0], aoi.geometry, scratch / "aoi_clip.tif"))
+        else:
+            self.record_failure('clip_to_aoi', size, 1, stack_error)
+
+        # RGB and indices from the full-tile stack; failed products are skipped
+        # without an error, so the run is checked through its outputs
+        processed_dir = scratch / "processed"
+        self.run_case('process_sentinel_data', size, 1, band_pixels,
+                      lambda: process_sentinel_data(stack_dir, processed_dir,
+                                                    block_size=self.config.get('processing', {}).get('block_size', 512),
+                                                    cog=self.config.get('raster_output', {})),
+                      setup=lambda: shutil.rmtree(processed_dir, ignore_errors=True),
+                      check=lambda _: bool(stack_paths) and all(
+                          (processed_dir / f"{path.stem}_ndvi.tif").exists() for path in stack_paths))
+
+        # In-memory classification of an NDVI tile
+        ndvi = np.random.default_rng(self.seed).uniform(-1, 1, (size, size)).astype('float32')
+        self.run_case('classify_ndvi', size, 1, size * size, lambda: classify_ndvi(ndvi),
+                      check=lambda classes: classes is not None)
+
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    def run_workers(self, size: int) -> None:
+        """Time a full preprocessing run over all tiles for every worker count"""
+        root = self.fixtures(size)
+        tiles = self.settings.get('tiles', 4)
+        # Every generated AOI lies within one tile: a complete run writes one clip per AOI
+        aois = self.settings.get('aois', 3)
+        for workers in self.settings.get('workers', [1, 2, 4]):
+            pipeline = PreprocessingPipeline(root, self.pipeline_config(workers))
+            self.run_case('preprocessing_run', size, workers, size * size * len(BANDS) * tiles,
+                          pipeline.run, setup=lambda: clear_outputs(root),
+                          check=lambda ok: ok and len(list(pipeline.output_dir().glob("*.tif"))) == aois)
+        clear_outputs(root)
+
+    def baseline(self, results_dir: Path, current: Path) -> Optional[Path]:
+        """Results file to compare with: benchmark.baseline, else the previous run"""
+        if self.settings.get('baseline'):
+            return self.root_dir / self.settings['baseline']
+        previous = sorted(path for path in results_dir.glob("benchmark_*.json") if path != current)
+        return previous[-1] if previous else None
+
+    def compare(self, baseline_path: Path) -> List[str]:
+        """Log the change of every case against a baseline run and return the regressions"""
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            baseline = {case_key(result): result for result in json.load(f)['results']}
+        tolerance = self.settings.get('tolerance', 0.15)
+
+        logging.info(f"Comparison with {baseline_path.name} (tolerance {tolerance:.0%}):")
+        regressions = []
+        for result in self.results:
+            key = case_key(result)
+            if result.get('failed'):
+                regressions.append(key)
+                logging.info(f"  {key}: FAILED")
+                continue
+            if key not in baseline or baseline[key].get('failed') or not baseline[key]['median_s']:
+                logging.info(f"  {key}: new case")
+                continue
+            ratio = result['median_s'] / baseline[key]['median_s']
+            flag = ""
+            if ratio > 1 + tolerance:
+                regressions.append(key)
+                flag = " REGRESSION"
+            logging.info(f"  {key}: {baseline[key]['median_s']:.3f}s -> {result['median_s']:.3f}s "
+                         f"({ratio - 1:+.1%}){flag}")
+        return regressions
+
+    def run(self) -> bool:
+        """Run every case, store the results and compare them with the baseline"""
+        try:
+            sizes = self.settings.get('sizes', [1024, 2048])
+            logging.info(f"Benchmarking sizes {sizes}, {self.repeats} repeats")
+            for size in sizes:
+                self.run_size(size)
+                self.run_workers(size)
+
+            results_dir = self.root_dir / self.settings.get('results_folder', 'results/benchmarks')
+            results_dir.mkdir(parents=True, exist_ok=True)
+            results_path = results_dir / f"benchmark_{datetime.now().strftime('%Y%m%dT%H%M%S')}.json"
+            with open(results_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'created': datetime.now().isoformat(),
+                    'environment': environment(),
+                    'settings': self.settings,
+                    'results': self.results
+                }, f, indent=2)
+            logging.info(f"Saved benchmark results to {results_path}")
+
+            failed = [case_key(result) for result in self.results if result.get('failed')]
+            baseline_path = self.baseline(results_dir, results_path)
+            if baseline_path is None:
+                logging.info("No baseline to compare with")
+                if failed:
+                    logging.warning(f"{len(failed)} cases failed")
+                return not failed
+            regressions = self.compare(baseline_path)
+            if regressions:
+                logging.warning(f"{len(regressions)} cases failed or slower than the baseline")
+            return not regressions
+
+        except Exception as e:
+            logging.error(f"Benchmark error: {str(e)}", exc_info=True)
+            return False
+
+def main():
+    """Run the benchmark suite configured in config.yaml"""
+    setup_logging()
+
+    if not BenchmarkSuite(project_root).run():
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Synthetic Sentinel-2 L2A products for benchmarks
+
+Products follow the SAFE layout the pipeline reads
+(GRANULE/<granule>/IMG_DATA/R10m/T<tile>_<time>_B0x_10m.jp2, the R20m SCL
+and MTD_MSIL2A.xml) and are generated deterministically from a seed:
+blocky water, built-up and vegetation parcels with sensor-like noise, so
+compression, clipping and classification behave as on real scenes.
+"""
+import json
+import shutil
+import zipfile
+import logging
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.warp import transform_geom
+from shapely.geometry import Point, mapping
+
+BANDS = ['B02', 'B03', 'B04', 'B08']
+CRS = 'EPSG:32632'
+
+# Mean DN per land cover (water, built-up, vegetation) for B02, B03, B04, B08
+REFLECTANCE = {
+    'B02': (800, 1200, 400),
+    'B03': (700, 1300, 700),
+    'B04': (500, 1400, 500),
+    'B08': (300, 1800, 3500)
+}
+
+# SCL classes per land cover, plus cloud and cloud shadow patches
+SCL_CLASSES = (6, 5, 4)
+SCL_CLOUD, SCL_SHADOW = 9, 3
+
+def land_cover(size: int, rng: np.random.Generator, parcel: int = 64) -> np.ndarray:
+    """(size, size) array of 0 water, 1 built-up, 2 vegetation parcels"""
+    cells = -(-size // parcel)
+    coarse = np.digitize(rng.random((cells, cells)), [0.15, 0.55]).astype(np.uint8)
+    return np.repeat(np.repeat(coarse, parcel, axis=0), parcel, axis=1)[:size, :size]
+
+def band_data(cover: np.ndarray, band: str, rng: np.random.Generator) -> np.ndarray:
+    """DN of a band over a land cover map, with Gaussian noise"""
+    means = np.asarray(REFLECTANCE[band], dtype='float32')[cover]
+    noisy = means + rng.normal(0, 60, cover.shape).astype('float32')
+    return np.clip(noisy, 1, 10000).astype(np.uint16)
+
+def scl_data(cover: np.ndarray, rng: np.random.Generator, cloud_fraction: float = 0.1) -> np.ndarray:
+    """20 m scene classification with round cloud patches and their shadows"""
+    scl = np.asarray(SCL_CLASSES, dtype=np.uint8)[cover[::2, ::2]]
+    rows, cols = np.indices(scl.shape)
+    target = cloud_fraction * scl.size
+    radius = max(4, scl.shape[0] // 16)
+    while (scl == SCL_CLOUD).sum() < target:
+        row, col = rng.integers(0, scl.shape[0], 2)
+        shadow = (rows - row - radius // 2) ** 2 + (cols - col - radius // 2) ** 2 < radius ** 2
+        scl[shadow & (scl != SCL_CLOUD)] = SCL_SHADOW
+        scl[(rows - row) ** 2 + (cols - col) ** 2 < radius ** 2] = SCL_CLOUD
+    return scl
+
+def write_jp2(path: Path, data: np.ndarray, transform) -> None:
+    """Write a single band losslessly as JPEG 2000, like the L2A products"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with rasterio.open(path, 'w', driver='JP2OpenJPEG', width=data.shape[1], height=data.shape[0],
+                       count=1, dtype=data.dtype, crs=CRS, transform=transform,
+                       QUALITY='100', REVERSIBLE='YES', BLOCKXSIZE=1024, BLOCKYSIZE=1024) as dst:
+        dst.write(data, 1)
+
+def product_metadata(sensing_time: datetime, image_files: List[str], cloud_cover: float) -> bytes:
+    """Minimal MTD_MSIL2A.xml with the fields the SAFE index reads"""
+    ns = 'https://psd-14.sentinel2.eo.esa.int/PSD/User_Product_Level-2A.xsd'
+    root = ET.Element(f"{{{ns}}}Level-2A_User_Product")
+    product_info = ET.SubElement(ET.SubElement(root, f"{{{ns}}}General_Info"), 'Product_Info')
+    ET.SubElement(product_info, 'PRODUCT_START_TIME').text = sensing_time.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    granule = ET.SubElement(ET.SubElement(ET.SubElement(product_info, 'Product_Organisation'),
+                                          'Granule_List'), 'Granule')
+    for image_file in image_files:
+        ET.SubElement(granule, 'IMAGE_FILE').text = image_file
+    quality = ET.SubElement(root, f"{{{ns}}}Quality_Indicators_Info")
+    ET.SubElement(quality, 'Cloud_Coverage_Assessment').text = f"{cloud_cover:.3f}"
+    return ET.tostring(root, encoding='utf-8', xml_declaration=True)
+
+def tile_id(index: int) -> str:
+    """Distinct MGRS-like tile identifier per generated product"""
+    return f"32T{chr(ord('A') + index // 26 % 26)}{chr(ord('A') + index % 26)}"
+
+def tile_origin(index: int, size: int) -> tuple:
+    """Upper-left corner of a tile; tiles are laid side by side around Rome"""
+    return 280000.0 + index * size * 10, 4650000.0
+
+def make_safe(output_dir: Path,
+              size: int,
+              index: int = 0,
+              seed: int = 42,
+              sensing_time: Optional[datetime] = None) -> Path:
+    """
+    Generate one synthetic L2A SAFE directory
+
+    Args:
+        output_dir: Directory receiving the SAFE
+        size: Edge of the 10 m bands in pixels (10980 for a full tile)
+        index: Product number, selects the tile and its position
+        seed: Random seed; the same arguments always give the same product
+        sensing_time: Acquisition time, one day after 2025-04-01 per index if None
+
+    Returns:
+        Path: The SAFE directory
+    """
+    sensing_time = sensing_time or datetime(2025, 4, 1, 10, 0, 29) + timedelta(days=index)
+    stamp = sensing_time.strftime('%Y%m%dT%H%M%S')
+    tile = tile_id(index)
+    safe_path = output_dir / f"S2B_MSIL2A_{stamp}_N0511_R122_T{tile}_{stamp[:8]}T125144.SAFE"
+    granule = f"L2A_T{tile}_A000000_{stamp}"
+    if (safe_path / 'MTD_MSIL2A.xml').exists():
+        return safe_path
+
+    rng = np.random.default_rng([seed, index, size])
+    cover = land_cover(size, rng)
+    x0, y0 = tile_origin(index, size)
+
+    image_files = []
+    for band in BANDS:
+        image_file = f"GRANULE/{granule}/IMG_DATA/R10m/T{tile}_{stamp}_{band}_10m"
+        write_jp2(safe_path / f"{image_file}.jp2", band_data(cover, band, rng), from_origin(x0, y0, 10, 10))
+        image_files.append(image_file)
+
+    scl = scl_data(cover, rng)
+    image_file = f"GRANULE/{granule}/IMG_DATA/R20m/T{tile}_{stamp}_SCL_20m"
+    write_jp2(safe_path / f"{image_file}.jp2", scl, from_origin(x0, y0, 20, 20))
+    image_files.append(image_file)
+
+    cloud_cover = float((scl == SCL_CLOUD).mean() * 100)
+    (safe_path / 'MTD_MSIL2A.xml').write_bytes(product_metadata(sensing_time, image_files, cloud_cover))
+    logging.info(f"Generated {safe_path.name} ({size}x{size})")
+    return safe_path
+
+def make_zip(safe_path: Path, output_dir: Path) -> Path:
+    """Zip a SAFE directory as distributed by the Copernicus Data Space (<product>.zip)"""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    zip_path = output_dir / f"{safe_path.name.split('.')[0]}.zip"
+    if zip_path.exists():
+        return zip_path
+    tmp_path = zip_path.with_suffix('.tmp')
+    # JP2 is already compressed: store members as they are
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_STORED) as zip_ref:
+        for path in sorted(safe_path.rglob('*')):
+            if path.is_file():
+                zip_ref.write(path, path.relative_to(safe_path.parent).as_posix())
+    tmp_path.replace(zip_path)
+    return zip_path
+
+def make_aois(path: Path, tiles: int, size: int, count: int = 3, seed: int = 42) -> Path:
+    """
+    Write a GeoJSON FeatureCollection of round AOIs (EPSG:4326) over the generated tiles
+
+    Each AOI covers about a sixth of a tile; they are spread over all tiles.
+    """
+    rng = np.random.default_rng([seed, count, size])
+    features = []
+    for i in range(count):
+        x0, y0 = tile_origin(i % tiles, size)
+        extent = size * 10
+        center = Point(x0 + extent * rng.uniform(0.25, 0.75), y0 - extent * rng.uniform(0.25, 0.75))
+        polygon = center.buffer(extent * 0.23, 16)
+        features.append({
+            'type': 'Feature',
+            'properties': {'name': f"aoi_{i}"},
+            'geometry': transform_geom(CRS, 'EPSG:4326', mapping(polygon))
+        })
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    return path
+
+def clear_outputs(root_dir: Path) -> None:
+    """Remove everything the pipeline wrote under a benchmark workspace, keeping the fixtures"""
+    for folder in ['data/preprocessed', 'data/processed', 'data/analysis', 'data/cache']:
+        shutil.rmtree(root_dir / folder, ignore_errors=True)
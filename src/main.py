@@ -21,6 +21,11 @@ sys.path.append(str(project_root))
 from src.main.preprocessing.preprocessing import PreprocessingPipeline
 from src.main.processing.processing import ProcessingPipeline
 from src.main.analysis.analysis import AnalysisPipeline
+from src.main.preview.preview import PreviewPipeline
+from src.main.streaming.streaming import StreamingPipeline
+from src.main.compositing.compositing import CompositingPipeline
+from src.auxiliary.config_utils import load_config
+from src.auxiliary.metrics_utils import run_metrics, write_report
 
 def setup_logging() -> None:
     """Configure logging"""
@@ -39,36 +44,82 @@ def setup_logging() -> None:
         handlers=handlers
     )
 
-def main():
-    """Run complete pipeline"""
-    try:
-        # Setup logging
-        setup_logging()
-        logging.info("Starting complete pipeline...")
-        
-        # Step 1: Preprocessing (BOA reflectance + clipping)
-        logging.info("\n=== Starting Preprocessing ===")
-        preprocessor = PreprocessingPipeline(project_root)
+def run_compositing(config) -> bool:
+    """Build the temporal composites once every product of the period is preprocessed"""
+    if not config.get('compositing', {}).get('enabled', False):
+        return True
+    logging.info("\n=== Starting Compositing ===")
+    with run_metrics.measure('compositing'):
+        if not CompositingPipeline(project_root, config).run():
+            logging.error("Compositing failed")
+            return False
+    return True
+
+def run_stages(config) -> bool:
+    """Run the pipeline stages, streaming or one after another"""
+    # Streaming mode: products flow through all stages without barriers
+    if config.get('pipeline', {}).get('mode', 'barrier') == 'streaming':
+        with run_metrics.measure('pipeline'):
+            if not StreamingPipeline(project_root, config).run():
+                logging.error("Streaming pipeline failed")
+                return False
+        return run_compositing(config)
+    
+    # Step 1: Preprocessing (BOA reflectance + clipping)
+    logging.info("\n=== Starting Preprocessing ===")
+    with run_metrics.measure('preprocessing'):
+        preprocessor = PreprocessingPipeline(project_root, config)
         if not preprocessor.run():
             logging.error("Preprocessing failed")
             return False
-            
-        # Step 2: Processing (RGB + NDVI generation)
-        logging.info("\n=== Starting Processing ===")
-        processor = ProcessingPipeline(project_root)
+    
+    # Temporal composites of the clipped products
+    if not run_compositing(config):
+        return False
+        
+    # Step 2: Processing (RGB + NDVI generation)
+    logging.info("\n=== Starting Processing ===")
+    with run_metrics.measure('processing'):
+        processor = ProcessingPipeline(project_root, config)
         if not processor.run():
             logging.error("Processing failed")
             return False
-            
-        # Step 3: Analysis (Land cover classification)
-        logging.info("\n=== Starting Analysis ===")
-        analyzer = AnalysisPipeline(project_root)
+        
+    # Step 3: Analysis (Land cover classification)
+    logging.info("\n=== Starting Analysis ===")
+    with run_metrics.measure('analysis'):
+        analyzer = AnalysisPipeline(project_root, config)
         if not analyzer.run():
             logging.error("Analysis failed")
             return False
-            
-        logging.info("\nComplete pipeline finished successfully")
-        return True
+    
+    # Step 4: Quicklooks, unless already rendered by the stages above
+    preview = config.get('preview', {})
+    if preview.get('enabled', True) and not preview.get('inline', True):
+        logging.info("\n=== Starting Preview ===")
+        with run_metrics.measure('previews'):
+            if not PreviewPipeline(project_root, config).run():
+                logging.warning("Some previews could not be rendered")
+    return True
+
+def main():
+    """Run complete pipeline"""
+    try:
+        # Setup logging
+        setup_logging()
+        logging.info("Starting complete pipeline...")
+        
+        config = load_config(project_root)
+        run_metrics.configure(config)
+        try:
+            success = run_stages(config)
+        finally:
+            # Per-stage and per-product timings, also for failed runs
+            write_report(project_root, config)
+        
+        if success:
+            logging.info("\nComplete pipeline finished successfully")
+        return success
         
     except Exception as e:
         logging.error(f"Pipeline error: {str(e)}", exc_info=True)
@@ -3,12 +3,44 @@ Analysis module for classifying NDVI images into land cover classes
 """
 import os
 import sys
+import csv
+import json
 import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
 import numpy as np
 import rasterio
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
+
+# Add project root to Python path
+current_file = Path(__file__).resolve()
+project_root = None
+for parent in current_file.parents:
+    if parent.name == "processing-root-folder":
+        project_root = parent
+        break
+if project_root is None:
+    raise RuntimeError("Project root 'processing-root-folder' not found")
+sys.path.append(str(project_root))
+
+from src.auxiliary.config_utils import load_config
+from src.auxiliary.cache_utils import StageCache, module_digest
+from src.auxiliary.metrics_utils import run_metrics, file_size
+from src.auxiliary.raster_utils import cog_profile, finalize_cog, window_is_sparse
+from src.auxiliary.preview_utils import save_class_preview
+from src.auxiliary import raster_utils, preview_utils
+
+CLASS_LABELS = ['Unclassified', 'Water', 'Built-up', 'Vegetation']
+
+# Sources of the outputs: code changes in any of them invalidate the cache
+CODE_FILES = [__file__, raster_utils.__file__, preview_utils.__file__]
+
+# Thresholds adjusted for better cloud and water/building separation
+DEFAULT_THRESHOLDS = {
+    'water': 0.015,        # Pure water bodies
+    'builtup_max': 0.39,   # Buildings and mixed water pixels (vegetation above)
+    'cloud': 0.75          # High reflectance indicates clouds; None when clouds are masked from the SCL
+}
 
 def setup_logging():
     """Configure logging"""
@@ -26,127 +58,250 @@ def read_ndvi(src: rasterio.DatasetReader) -> np.ndarray:
     logging.info(f"  Mean: {np.mean(ndvi):.3f}")
     return ndvi
 
-def classify_ndvi(ndvi_array: np.ndarray) -> np.ndarray:
+def classification_lut(thresholds: Optional[Dict[str, float]] = None):
+    """
+    Build the digitize edges and class lookup table for the NDVI thresholds
+
+    Edges are nudged up by one ULP so that the closed upper bounds of the
+    built-up and vegetation ranges map to the right bin. Without a cloud
+    threshold only NaN (nodata) is left unclassified.
+    """
+    t = {**DEFAULT_THRESHOLDS, **(thresholds or {})}
+    cloud = np.inf if t['cloud'] is None else t['cloud']
+    edges = np.array([
+        t['water'],
+        np.nextafter(np.float32(t['builtup_max']), np.float32(np.inf)),
+        np.nextafter(np.float32(cloud), np.float32(np.inf))
+    ], dtype='float32')
+    # bins: < water, water..builtup_max, ..cloud, > cloud or NaN
+    lut = np.array([1, 2, 3, 0], dtype=np.uint8)
+    return edges, lut
+
+def classify_ndvi(ndvi_array: np.ndarray,
+                  thresholds: Optional[Dict[str, float]] = None,
+                  out: Optional[np.ndarray] = None) -> np.ndarray:
     """
     Classify NDVI values into land cover classes:
-    0 - Unclassified (clouds)
+    0 - Unclassified (clouds, nodata)
     1 - Water (very low NDVI)
     2 - Built-up/Water (low-mid NDVI)
     3 - Vegetation (high NDVI)
-    """
-    classified = np.zeros_like(ndvi_array, dtype=np.uint8)
     
-    # Thresholds adjusted for better cloud and water/building separation
-    cloud_threshold = 0.75    # High reflectance indicates clouds
-    water_threshold = 0.015    # Pure water bodies
-    buildup_max = 0.39       # Buildings and mixed water pixels
-    veg_threshold = 0.39     # Clear vegetation signal
+    One np.digitize pass through a lookup table, written into out
+    (a uint8 array of the same shape) when given.
+    """
+    edges, lut = classification_lut(thresholds)
+    if out is None:
+        out = np.empty(ndvi_array.shape, dtype=np.uint8)
+    return np.take(lut, np.digitize(ndvi_array, edges), out=out)
 
+def log_thresholds(thresholds: Optional[Dict[str, float]] = None) -> None:
+    """Log the classification thresholds in use"""
+    t = {**DEFAULT_THRESHOLDS, **(thresholds or {})}
     logging.info(f"Classification thresholds:")
-    logging.info(f"  Clouds: NDVI > {cloud_threshold}")
-    logging.info(f"  Water: NDVI < {water_threshold}")
-    logging.info(f"  Built-up/Water: {water_threshold} ≤ NDVI ≤ {buildup_max}")
-    logging.info(f"  Vegetation: NDVI > {veg_threshold}")
-    
-    # Clouds (unclassified)
-    classified = np.where(ndvi_array > cloud_threshold, 0, classified)
-    
-    # Pure water bodies
-    classified = np.where(
-        (ndvi_array < water_threshold) & (ndvi_array <= cloud_threshold),
-        1,
-        classified
-    )
-    
-    # Built-up areas and mixed water
-    classified = np.where(
-        (ndvi_array >= water_threshold) & (ndvi_array <= buildup_max),
-        2,
-        classified
-    )
-    
-    # Vegetation (unchanged)
-    classified = np.where(
-        (ndvi_array > veg_threshold) & (ndvi_array <= cloud_threshold),
-        3,
-        classified
-    )
+    if t['cloud'] is None:
+        logging.info(f"  Clouds: masked from the SCL (NaN)")
+    else:
+        logging.info(f"  Clouds: NDVI > {t['cloud']}")
+    logging.info(f"  Water: NDVI < {t['water']}")
+    logging.info(f"  Built-up/Water: {t['water']} ≤ NDVI ≤ {t['builtup_max']}")
+    logging.info(f"  Vegetation: NDVI > {t['builtup_max']}")
+
+def classify_raster(ndvi_path: Path,
+                    output_path: Path,
+                    thresholds: Optional[Dict[str, float]] = None,
+                    block_size: int = 512,
+                    cog: Optional[Dict[str, Any]] = None) -> np.ndarray:
+    """
+    Classify an NDVI GeoTIFF block by block
     
-    return classified
-
-def plot_classification(classified: np.ndarray, output_path: Path, filename: str):
-    """Create classification plot with legend and statistics"""
-    # Define colors and labels
-    colors = ['black', 'blue', 'gray', 'green']
-    labels = ['Unclassified', 'Water', 'Built-up', 'Vegetation']
-    cmap = ListedColormap(colors)
+    Each block is classified into a preallocated uint8 buffer, written
+    immediately and counted with a single np.bincount. Blocks left empty
+    in a sparse NDVI with nodata (fully masked) are counted as
+    unclassified without being read. The output is a Cloud-Optimized
+    GeoTIFF with nearest-neighbour overviews.
     
-    # Create figure
-    plt.figure(figsize=(12, 8))
+    Returns:
+        np.ndarray: Pixel count per class
+    """
+    counts = np.zeros(len(CLASS_LABELS), dtype=np.int64)
+    classified_buf = np.empty((block_size, block_size), dtype=np.uint8)
     
-    # Plot classification
-    im = plt.imshow(classified, cmap=cmap)
+    with rasterio.open(ndvi_path) as src:
+        profile = src.profile.copy()
+        profile.update({'dtype': rasterio.uint8, 'count': 1})
+        profile.pop('nodata', None)
+        profile = cog_profile(profile, cog, block_size)
+        
+        with rasterio.open(output_path, 'w', **profile) as dst:
+            for _, window in dst.block_windows(1):
+                if src.nodata is not None and window_is_sparse(src, window):
+                    counts[0] += int(window.height) * int(window.width)
+                    continue
+                ndvi = src.read(1, window=window)
+                classified = classify_ndvi(ndvi, thresholds,
+                                           out=classified_buf[:ndvi.shape[0], :ndvi.shape[1]])
+                dst.write(classified, 1, window=window)
+                counts += np.bincount(classified.ravel(), minlength=len(CLASS_LABELS))
     
-    # Add title
-    plt.title('Land Cover Classification', fontsize=12, pad=20)
+    finalize_cog(output_path, cog, resampling='nearest')
+    return counts
+
+def analyse_product(ndvi_path: Path,
+                    output_dir: Path,
+                    thresholds: Optional[Dict[str, float]] = None,
+                    block_size: int = 512,
+                    plot: bool = True,
+                    cog: Optional[Dict[str, Any]] = None,
+                    preview_size: int = 1024) -> Dict[str, Any]:
+    """
+    Classify one NDVI product and record its class statistics
     
-    # Create custom legend
-    legend_elements = [plt.Rectangle((0,0),1,1, facecolor=color, label=label)
-                      for color, label in zip(colors, labels)]
-    plt.legend(handles=legend_elements, 
-              loc='center left', 
-              bbox_to_anchor=(1, 0.5),
-              title='Land Cover Types')
+    Writes <stem>_classified.tif, the optional PNG quicklook and a
+    <stem>_classified.json sidecar holding the statistics row.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
     
-    # Calculate and display statistics
-    total_pixels = classified.size
-    stats = {label: np.sum(classified == i) / total_pixels * 100 
-             for i, label in enumerate(labels)}
+    # Save GeoTIFF
+    out_tiff = output_dir / f"{ndvi_path.stem}_classified.tif"
+    with run_metrics.measure('classify', ndvi_path.stem):
+        counts = classify_raster(ndvi_path, out_tiff, thresholds, block_size, cog)
+        run_metrics.add('classify', ndvi_path.stem, bytes_read=file_size(ndvi_path),
+                        bytes_written=file_size(out_tiff), pixels=int(counts.sum()))
     
-    # Add statistics text box
-    stats_text = "Coverage Statistics:\n"
-    stats_text += "\n".join(f"{label}: {stats[label]:.1f}%" 
-                           for label in labels)
-    plt.text(1.5, 0.02, stats_text, 
-            transform=plt.gca().transAxes, 
-            bbox=dict(facecolor='white', alpha=0.8))
+    # Quicklook from the class overviews
+    if plot:
+        save_class_preview(out_tiff, out_tiff.with_suffix('.png'), preview_size)
     
-    # Adjust layout
-    plt.tight_layout()
+    total = max(int(counts.sum()), 1)
+    row = {'product': ndvi_path.stem, 'total_pixels': int(counts.sum())}
+    for i, label in enumerate(CLASS_LABELS):
+        key = label.lower().replace('-', '_')
+        row[f"{key}_pixels"] = int(counts[i])
+        row[f"{key}_pct"] = round(counts[i] / total * 100, 3)
     
-    # Save plot
-    output_path.mkdir(parents=True, exist_ok=True)
-    plt.savefig(output_path / f"{filename}_classified.png", 
-                dpi=300, bbox_inches='tight')
-    plt.close()
+    with open(output_dir / f"{ndvi_path.stem}_classified.json", 'w') as f:
+        json.dump(row, f, indent=2)
+    logging.info(f"Classified {ndvi_path.name} -> {out_tiff.name}")
+    return row
 
-def main():
-    """Main function to run the analysis"""
-    setup_logging()
-    
-    try:
-        input_file = Path(r"C:\Users\fgalassi\Progetti\EO Pipeline\processing-root-folder\data\processed\Sentinel-2\L2A\S2B_MSIL2A_20250404T100029_N0511_R122_T32TQM_20250404T125144_bands_ndvi.tif")
-        
-        with rasterio.open(input_file) as src:
-            ndvi = read_ndvi(src)
-            classified = classify_ndvi(ndvi)
+def analyse_in_worker(*args) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """analyse_product in a worker process, returning its row and run metrics"""
+    return analyse_product(*args), run_metrics.drain()
+
+def write_statistics(rows: List[Dict[str, Any]], analysis_dir: Path) -> Path:
+    """Write the per-product class statistics rows to class_statistics.csv"""
+    analysis_dir.mkdir(parents=True, exist_ok=True)
+    table_path = analysis_dir / "class_statistics.csv"
+    with open(table_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    logging.info(f"Saved class statistics for {len(rows)} products to {table_path}")
+    return table_path
+
+class AnalysisPipeline:
+    def __init__(self, root_dir: Path, config: Optional[Dict[str, Any]] = None):
+        self.root_dir = root_dir
+        self.config = config if config is not None else load_config(root_dir)
+        self.settings = self.config.get('analysis', {})
+
+    def fingerprint(self, cache: StageCache, ndvi_path: Path) -> str:
+        """Fingerprint an NDVI product together with the thresholds and plot setting"""
+        params = {
+            'thresholds': {**DEFAULT_THRESHOLDS, **(self.settings.get('thresholds') or {})},
+            'plot': self.settings.get('plot', True)
+        }
+        return cache.fingerprint([ndvi_path], params, module_digest(*CODE_FILES))
+
+    def run(self) -> bool:
+        """Classify every NDVI product and write one class statistics table"""
+        try:
+            processed_dir = self.root_dir / self.config.get('processing', {}).get('output_folder', 'data/processed')
+            analysis_dir = self.root_dir / "data" / "analysis"
+            thresholds = self.settings.get('thresholds')
+            block_size = self.settings.get('block_size', 512)
+            preview = self.config.get('preview', {})
+            plot = (self.settings.get('plot', True) and preview.get('enabled', True)
+                    and preview.get('inline', True))
+            preview_size = preview.get('max_size', 1024)
+            cog = self.config.get('raster_output', {})
+            log_thresholds(thresholds)
+            
+            ndvi_files = sorted(processed_dir.rglob("*_ndvi.tif"))
+            if not ndvi_files:
+                logging.error(f"No NDVI products found in {processed_dir}")
+                return False
+            logging.info(f"Found {len(ndvi_files)} NDVI products")
+            
+            # Mirror the processed folder structure under data/analysis
+            cache = StageCache.from_config(self.root_dir, self.config)
+            fingerprints = {}
+            tasks = {}
+            rows = {}
+            for ndvi_path in ndvi_files:
+                output_dir = analysis_dir / ndvi_path.parent.relative_to(processed_dir)
+                fingerprints[ndvi_path] = self.fingerprint(cache, ndvi_path)
+                if cache.is_fresh('analysis', str(ndvi_path.relative_to(processed_dir)),
+                                  fingerprints[ndvi_path]):
+                    logging.info(f"Skipping {ndvi_path.name} - outputs up to date")
+                    with open(output_dir / f"{ndvi_path.stem}_classified.json") as f:
+                        rows[ndvi_path] = json.load(f)
+                else:
+                    tasks[ndvi_path] = output_dir
+            
+            workers = min(self.settings.get('workers', 1), max(len(tasks), 1))
+            failed = 0
+            if workers > 1:
+                logging.info(f"Classifying {len(tasks)} products with {workers} workers")
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = {
+                        executor.submit(analyse_in_worker, ndvi_path, output_dir,
+                                        thresholds, block_size, plot, cog,
+                                        preview_size): ndvi_path
+                        for ndvi_path, output_dir in tasks.items()
+                    }
+                    for future in as_completed(futures):
+                        try:
+                            rows[futures[future]], records = future.result()
+                            run_metrics.merge(records)
+                        except Exception as e:
+                            logging.error(f"Failed to classify {futures[future].name}: {str(e)}", exc_info=True)
+                            failed += 1
+            else:
+                for ndvi_path, output_dir in tasks.items():
+                    try:
+                        rows[ndvi_path] = analyse_product(ndvi_path, output_dir,
+                                                          thresholds, block_size, plot, cog,
+                                                          preview_size)
+                    except Exception as e:
+                        logging.error(f"Failed to classify {ndvi_path.name}: {str(e)}", exc_info=True)
+                        failed += 1
             
-            # Save classification
-            output_dir = input_file.parent.parent.parent / "analysis" / "Sentinel-2" / "L2A"
-            output_dir.mkdir(parents=True, exist_ok=True)
+            for ndvi_path, output_dir in tasks.items():
+                if ndvi_path in rows:
+                    outputs = [output_dir / f"{ndvi_path.stem}_classified.tif",
+                               output_dir / f"{ndvi_path.stem}_classified.json"]
+                    cache.record('analysis', str(ndvi_path.relative_to(processed_dir)),
+                                 fingerprints[ndvi_path], outputs)
             
-            # Save GeoTIFF
-            profile = src.profile.copy()
-            profile.update(dtype=rasterio.uint8, count=1)
-            out_tiff = output_dir / f"{input_file.stem}_classified.tif"
-            with rasterio.open(out_tiff, 'w', **profile) as dst:
-                dst.write(classified, 1)
+            # Aggregated per-product class statistics
+            if rows:
+                write_statistics([rows[path] for path in sorted(rows)], analysis_dir)
             
-            # Create visualization
-            plot_classification(classified, output_dir, input_file.stem)
+            logging.info(f"Classified {len(tasks) - failed} products, "
+                         f"{len(ndvi_files) - len(tasks)} up to date, {failed} failed")
+            return failed == 0
             
-    except Exception as e:
-        logging.error(f"Error in processing: {str(e)}", exc_info=True)
+        except Exception as e:
+            logging.error(f"Analysis pipeline error: {str(e)}", exc_info=True)
+            return False
+
+def main():
+    """Main function to run the analysis"""
+    setup_logging()
+    
+    if not AnalysisPipeline(project_root).run():
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -0,0 +1,397 @@
+"""
+Compositing module: cloud-free temporal composites of the preprocessed products
+
+The clipped band stacks of one AOI and tile share a pixel grid, so every
+product of the configured period is read block by block on that grid
+together with its L2A scene classification, and each block is reduced
+across the dates before the next one is read.
+"""
+import sys
+import logging
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+import numpy as np
+import rasterio
+
+# Add project root to Python path
+current_file = Path(__file__).resolve()
+project_root = None
+for parent in current_file.parents:
+    if parent.name == "processing-root-folder":
+        project_root = parent
+        break
+if project_root is None:
+    raise RuntimeError("Project root 'processing-root-folder' not found")
+sys.path.append(str(project_root))
+
+from src.auxiliary.config_utils import load_config
+from src.auxiliary.cache_utils import StageCache, module_digest
+from src.auxiliary.metrics_utils import run_metrics, file_size
+from src.auxiliary.safe_index import SafeIndex
+from src.auxiliary.unzip_utils import vsizip_band_paths
+from src.auxiliary.scl_utils import DEFAULT_MASK_CLASSES, mask_lut, masked_pixels, scl_blocks
+from src.auxiliary.raster_utils import cog_profile, finalize_cog, fit_block_size
+from src.main.processing.indices import normalized_difference
+from src.main.processing.processing import band_indexes
+from src.auxiliary import safe_index, unzip_utils, scl_utils, raster_utils
+from src.main.processing import indices, processing
+
+METHODS = ['median', 'max_ndvi', 'best_pixel']
+
+# Suffix of the clipped products written by preprocessing
+CLIP_SUFFIX = '_bands_clipped'
+
+# Sources of the outputs: code changes in any of them invalidate the cache
+CODE_FILES = [__file__, safe_index.__file__, unzip_utils.__file__, scl_utils.__file__,
+              raster_utils.__file__, indices.__file__, processing.__file__]
+
+class Observation(NamedTuple):
+    path: Path
+    product: str
+    sensing_time: datetime
+    scl_path: Optional[str] = None
+
+def setup_logging():
+    """Configure logging"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+def parse_clip_name(path: Path) -> Optional[Dict[str, Any]]:
+    """
+    Product, AOI, tile and sensing time of a clipped product
+
+    Names are <product>_bands_clipped.tif for a single AOI and
+    <product>_<aoi>_bands_clipped.tif otherwise, where <product> is the
+    seven-field SAFE name, e.g. S2B_MSIL2A_20250401T100029_N0511_R122_T33TTG_20250401T125144.
+    """
+    if not path.stem.endswith(CLIP_SUFFIX):
+        return None
+    parts = path.stem[:-len(CLIP_SUFFIX)].split('_')
+    if len(parts) < 7:
+        return None
+    try:
+        sensing_time = datetime.strptime(parts[2], '%Y%m%dT%H%M%S')
+    except ValueError:
+        return None
+    return {
+        'product': '_'.join(parts[:7]),
+        'aoi': '_'.join(parts[7:]),
+        'tile': parts[5][1:],
+        'sensing_time': sensing_time
+    }
+
+def composite_name(tile: str, aoi: str, start: datetime, end: datetime, method: str) -> str:
+    """Stem of a composite, e.g. S2_T33TTG_aoi_20250401_20250430_median"""
+    aoi_part = f"_{aoi}" if aoi else ""
+    return f"S2_T{tile}{aoi_part}_{start:%Y%m%d}_{end:%Y%m%d}_{method}"
+
+def read_observation(src: rasterio.DatasetReader,
+                     read_indexes: List[int],
+                     read_scl: Optional[Callable],
+                     lut: np.ndarray,
+                     window,
+                     bands: np.ndarray,
+                     clear: np.ndarray) -> np.ndarray:
+    """
+    Read one block of a product and flag its clear pixels
+
+    Pixels are clear when no band is nodata (0) and, if the product has an
+    SCL layer, their scene class is not masked.
+    """
+    src.read(read_indexes, window=window, out=bands)
+    np.all(bands != 0, axis=0, out=clear)
+    if read_scl is not None:
+        clear &= ~masked_pixels(read_scl(window), lut)
+    return clear
+
+def composite_products(observations: List[Observation],
+                       output_path: Path,
+                       method: str = 'median',
+                       mask_classes: Optional[List[int]] = None,
+                       block_size: int = 512,
+                       max_block_memory_mb: float = 256,
+                       cog: Optional[Dict[str, Any]] = None,
+                       target_time: Optional[datetime] = None) -> Optional[Path]:
+    """
+    Write the temporal composite of co-registered band stacks
+
+    'median' takes the per-band median of the clear observations of each
+    pixel; all dates of a block are held at once, so the block edge is
+    shrunk to fit max_block_memory_mb. 'max_ndvi' keeps all bands of the
+    clear observation with the highest NDVI and 'best_pixel' those of the
+    clear observation closest to target_time; both are running reductions
+    holding one date per block, and 'best_pixel' stops reading dates once
+    every pixel of a block is filled. Pixels without any clear observation
+    are 0 (nodata).
+
+    Args:
+        observations: Products of one tile and AOI with their SCL paths; products
+            not on the grid of the first one are skipped
+        output_path: Composite GeoTIFF
+        method: 'median', 'max_ndvi' or 'best_pixel'
+        mask_classes: SCL classes treated as not clear
+        block_size: Edge of the output tiles in pixels
+        max_block_memory_mb: Memory budget for the blocks of all dates
+        cog: 'raster_output' settings of the Cloud-Optimized GeoTIFF output
+        target_time: Preferred date of 'best_pixel', the middle of the observations if None
+
+    Returns:
+        Optional[Path]: The composite, None if the bands needed by the method are missing
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown compositing method: {method}. Available: {', '.join(METHODS)}")
+    lut = mask_lut(mask_classes)
+
+    with run_metrics.measure('composite', output_path.stem), ExitStack() as stack:
+        sources = [stack.enter_context(rasterio.open(obs.path)) for obs in observations]
+        reference = sources[0]
+        band_names = list(band_indexes(reference))
+
+        # Products off the reference grid or with other bands are left out
+        aligned = []
+        for obs, src in zip(observations, sources):
+            if (src.crs == reference.crs and src.transform == reference.transform
+                    and src.shape == reference.shape and set(band_indexes(src)) == set(band_names)):
+                aligned.append((obs, src))
+            else:
+                logging.warning(f"Skipping {obs.path.name} - not on the grid of {observations[0].path.name}")
+        observations = [obs for obs, _ in aligned]
+        sources = [src for _, src in aligned]
+        if method == 'max_ndvi' and not {'B04', 'B08'} <= set(band_names):
+            logging.error(f"max_ndvi compositing needs B04 and B08, found {band_names}")
+            return None
+
+        read_indexes = [[band_indexes(src)[name] for name in band_names] for src in sources]
+        scls = []
+        for obs in observations:
+            if obs.scl_path is None:
+                logging.warning(f"No SCL layer for {obs.product}, masking nodata only")
+                scls.append(None)
+            else:
+                scls.append(stack.enter_context(scl_blocks(obs.scl_path, reference.crs, reference.transform,
+                                                           reference.width, reference.height)))
+
+        # Bands held per pixel: all dates for the median, one date plus the composite otherwise
+        dtype = reference.dtypes[0]
+        count = len(band_names)
+        held = len(sources) * (count + 1) if method == 'median' else 2 * count + 5
+        block_size = fit_block_size(block_size, held, 'float32', max_block_memory_mb)
+
+        profile = cog_profile({**reference.profile, 'count': count, 'nodata': 0}, cog, block_size)
+
+        if method == 'median':
+            stacked = np.empty((len(sources), count, block_size, block_size), dtype=dtype)
+            clear = np.empty((len(sources), block_size, block_size), dtype=bool)
+            fill = np.iinfo(dtype).max if np.issubdtype(np.dtype(dtype), np.integer) else np.inf
+        else:
+            bands = np.empty((count, block_size, block_size), dtype=dtype)
+            composite = np.empty((count, block_size, block_size), dtype=dtype)
+            clear = np.empty((block_size, block_size), dtype=bool)
+            score = np.empty((block_size, block_size), dtype='float32')
+            best = np.empty((block_size, block_size), dtype='float32')
+            red = np.empty((block_size, block_size), dtype='float32')
+            nir = np.empty((block_size, block_size), dtype='float32')
+            scratch = np.empty((block_size, block_size), dtype='float32')
+            valid = np.empty((block_size, block_size), dtype=bool)
+
+        # Dates in order of preference for best_pixel
+        order = list(range(len(sources)))
+        if method == 'best_pixel':
+            times = [obs.sensing_time for obs in observations]
+            target_time = target_time or min(times) + (max(times) - min(times)) / 2
+            order.sort(key=lambda i: abs(times[i] - target_time))
+
+        filled_pixels = 0
+        with rasterio.open(output_path, 'w', **profile) as dst:
+            for idx, name in enumerate(band_names, start=1):
+                dst.set_band_description(idx, name)
+
+            for _, window in dst.block_windows(1):
+                h, w = int(window.height), int(window.width)
+
+                if method == 'median':
+                    block = stacked[:, :, :h, :w]
+                    block_clear = clear[:, :h, :w]
+                    for i in order:
+                        read_observation(sources[i], read_indexes[i], scls[i], lut, window,
+                                         block[i], block_clear[i])
+
+                    # Not clear values sort last; the median is taken among the first n
+                    np.copyto(block, np.asarray(fill, dtype=dtype), where=~block_clear[:, None])
+                    block.sort(axis=0)
+                    n = block_clear.sum(axis=0)
+                    lower = np.take_along_axis(block, np.maximum(n - 1, 0)[None, None] // 2, axis=0)[0]
+                    upper = np.take_along_axis(block, (n // 2)[None, None], axis=0)[0]
+                    result = (lower.astype('float64') + upper) / 2
+                    if np.issubdtype(np.dtype(dtype), np.integer):
+                        np.rint(result, out=result)
+                    result[:, n == 0] = 0
+                    dst.write(result.astype(dtype), window=window)
+                    filled_pixels += int((n > 0).sum())
+                    continue
+
+                block_bands = bands[:, :h, :w]
+                block_composite = composite[:, :h, :w]
+                block_clear = clear[:h, :w]
+                block_score = score[:h, :w]
+                block_best = best[:h, :w]
+                block_composite.fill(0)
+                block_best.fill(-np.inf)
+
+                for rank, i in enumerate(order):
+                    read_observation(sources[i], read_indexes[i], scls[i], lut, window,
+                                     block_bands, block_clear)
+                    if method == 'max_ndvi':
+                        np.copyto(red[:h, :w], block_bands[band_names.index('B04')], casting='unsafe')
+                        np.copyto(nir[:h, :w], block_bands[band_names.index('B08')], casting='unsafe')
+                        normalized_difference(nir[:h, :w], red[:h, :w], block_score,
+                                              scratch[:h, :w], valid[:h, :w])
+                    else:
+                        # Earlier dates in the order are preferred
+                        block_score.fill(-rank)
+                    block_score[~block_clear] = -np.inf
+                    better = block_score > block_best
+                    np.copyto(block_composite, block_bands, where=better)
+                    np.maximum(block_best, block_score, out=block_best)
+
+                    if method == 'best_pixel' and np.isfinite(block_best).all():
+                        break
+
+                dst.write(block_composite, window=window)
+                filled_pixels += int(np.isfinite(block_best).sum())
+
+        finalize_cog(output_path, cog)
+        total_pixels = reference.width * reference.height
+        run_metrics.add('composite', output_path.stem,
+                        bytes_read=sum(file_size(obs.path) for obs in observations),
+                        bytes_written=file_size(output_path),
+                        pixels=total_pixels * count * len(sources))
+
+    logging.info(f"Saved {method} composite of {len(observations)} products to {output_path} "
+                 f"({filled_pixels / max(total_pixels, 1) * 100:.1f}% of pixels clear at least once)")
+    return output_path
+
+class CompositingPipeline:
+    def __init__(self, root_dir: Path, config: Optional[Dict[str, Any]] = None):
+        self.root_dir = root_dir
+        self.config = config if config is not None else load_config(root_dir)
+        self.settings = self.config.get('compositing', {})
+        self._safe_index = None
+
+    @property
+    def safe_index(self) -> SafeIndex:
+        """SAFE product index, opened on first use"""
+        if self._safe_index is None:
+            self._safe_index = SafeIndex.from_config(self.root_dir, self.config)
+        return self._safe_index
+
+    def input_dir(self) -> Path:
+        """Folder of the clipped band stacks"""
+        return self.root_dir / "data" / "preprocessed" / "Sentinel-2" / "L2A"
+
+    def output_dir(self) -> Path:
+        """Folder of the composites"""
+        return self.root_dir / self.settings.get('output_folder', 'data/composites') / "Sentinel-2" / "L2A"
+
+    def period(self) -> tuple:
+        """First and last day of the period, compositing.start/end or data.dates"""
+        dates = self.config.get('data', {}).get('dates', {})
+        start = self.settings.get('start') or dates.get('start')
+        end = self.settings.get('end') or dates.get('end')
+        return datetime.strptime(str(start), '%Y-%m-%d'), datetime.strptime(str(end), '%Y-%m-%d')
+
+    def scl_path(self, product_name: str) -> Optional[str]:
+        """
+        R20m SCL band of a product
+
+        Looked up in the SAFE index of the extracted product, or read in place
+        from the product zip when it was not extracted (extract_mode 'bands').
+        """
+        raw_dir = self.root_dir / "data" / "raw" / "Sentinel-2"
+        safe_dir = raw_dir / f"{product_name}.SAFE"
+        zip_path = raw_dir / f"{product_name}.zip"
+        source = safe_dir if (safe_dir / "GRANULE").exists() else zip_path
+        if source.exists() and self.safe_index.index(source):
+            scl = self.safe_index.band_paths(product_name, ['SCL'], resolution='R20m')
+            if 'SCL' in scl:
+                return scl['SCL']
+        if zip_path.exists():
+            return vsizip_band_paths(str(zip_path), ['SCL'], 'R20m').get('SCL')
+        return None
+
+    def groups(self, start: datetime, end: datetime) -> Dict[tuple, List[Observation]]:
+        """Clipped products of the period by (tile, AOI), oldest first"""
+        groups = {}
+        for path in sorted(self.input_dir().glob(f"*{CLIP_SUFFIX}.tif")):
+            info = parse_clip_name(path)
+            if info is None or not start <= info['sensing_time'] < end + timedelta(days=1):
+                continue
+            groups.setdefault((info['tile'], info['aoi']), []).append(
+                Observation(path, info['product'], info['sensing_time']))
+        return {key: sorted(group, key=lambda obs: obs.sensing_time) for key, group in groups.items()}
+
+    def run(self) -> bool:
+        """Build one composite per tile and AOI over the configured period"""
+        try:
+            start, end = self.period()
+            method = self.settings.get('method', 'median')
+            mask_classes = self.settings.get('mask_classes', DEFAULT_MASK_CLASSES)
+            target_date = self.settings.get('target_date')
+            target_time = datetime.strptime(str(target_date), '%Y-%m-%d') if target_date else None
+            block_size = self.settings.get('block_size', 512)
+            output_dir = self.output_dir()
+            output_dir.mkdir(parents=True, exist_ok=True)
+
+            groups = self.groups(start, end)
+            if not groups:
+                logging.error(f"No preprocessed products between {start:%Y-%m-%d} and {end:%Y-%m-%d}")
+                return False
+            logging.info(f"Compositing {sum(len(group) for group in groups.values())} products "
+                         f"into {len(groups)} {method} composites ({start:%Y-%m-%d} to {end:%Y-%m-%d})")
+
+            cache = StageCache.from_config(self.root_dir, self.config)
+            params = {'method': method, 'mask_classes': mask_classes, 'target_date': target_date,
+                      'block_size': block_size}
+            failed = 0
+            for (tile, aoi), observations in groups.items():
+                output_path = output_dir / f"{composite_name(tile, aoi, start, end, method)}.tif"
+                fingerprint = cache.fingerprint([obs.path for obs in observations], params,
+                                                module_digest(*CODE_FILES))
+                if cache.is_fresh('compositing', output_path.stem, fingerprint):
+                    logging.info(f"Skipping {output_path.name} - outputs up to date")
+                    continue
+
+                observations = [obs._replace(scl_path=self.scl_path(obs.product)) for obs in observations]
+                try:
+                    result = composite_products(observations, output_path, method, mask_classes, block_size,
+                                                self.settings.get('max_block_memory_mb', 256),
+                                                self.config.get('raster_output', {}), target_time)
+                except Exception as e:
+                    logging.error(f"Failed to composite {output_path.name}: {str(e)}", exc_info=True)
+                    result = None
+
+                if result is None:
+                    failed += 1
+                else:
+                    cache.record('compositing', output_path.stem, fingerprint, [result])
+
+            logging.info(f"Composited {len(groups) - failed} of {len(groups)} tile/AOI groups")
+            return failed == 0
+
+        except Exception as e:
+            logging.error(f"Compositing pipeline error: {str(e)}", exc_info=True)
+            return False
+
+def main():
+    """Build the composites configured in config.yaml"""
+    setup_logging()
+
+    if not CompositingPipeline(project_root).run():
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,19 @@
 #!/usr/bin/env python3
 
 import os
+import sys
+import copy
+import json
+import time
 import yaml
+import shutil
+import hashlib
 import logging
+import threading
+import requests
+from pathlib import Path
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from oauthlib.oauth2 import BackendApplicationClient
 from requests_oauthlib import OAuth2Session
 from requests.adapters import HTTPAdapter
@@ -11,27 +21,64 @@ from urllib3.util.retry import Retry
 import boto3
 import botocore
 from botocore.client import Config as BotoConfig
+from boto3.s3.transfer import TransferConfig
+from boto3.exceptions import S3TransferFailedError
+
+# Add project root to Python path
+current_file = Path(__file__).resolve()
+project_root = None
+for parent in current_file.parents:
+    if parent.name == "processing-root-folder":
+        project_root = parent
+        break
+if project_root is None:
+    raise RuntimeError("Project root 'processing-root-folder' not found")
+sys.path.append(str(project_root))
+
+from src.auxiliary.metrics_utils import run_metrics, file_size, write_report
+
+MB = 1024 * 1024
 
 class CopernicusDataSpaceDownloader:
     def __init__(self, config):
         self.config = config
+        transfer = config['download'].get('transfer', {})
+        self.max_concurrent = transfer.get('max_concurrent_downloads', 4)
+        self.chunk_size = int(transfer.get('chunk_size_mb', 8) * MB)
+        self.multipart_threshold = int(transfer.get('multipart_threshold_mb', 256) * MB)
+        self.multipart_parts = transfer.get('multipart_parts', 8)
+        self.max_attempts = transfer.get('max_attempts', 3)
+        self.retry_backoff = transfer.get('retry_backoff_s', 2)
+        self._token_lock = threading.Lock()
         self.session = self._create_oauth_session()
         # S3 client for public buckets (unsigned)
         self.s3 = boto3.client(
             's3',
-            config=BotoConfig(signature_version=botocore.UNSIGNED)
+            endpoint_url=transfer.get('s3_endpoint_url'),
+            config=BotoConfig(
+                signature_version=botocore.UNSIGNED,
+                max_pool_connections=self.max_concurrent * self.multipart_parts
+            )
         )
+        self.s3_transfer = TransferConfig(
+            multipart_threshold=self.multipart_threshold,
+            multipart_chunksize=self.chunk_size,
+            max_concurrency=self.multipart_parts,
+            use_threads=True
+        )
+
+    def for_config(self, config):
+        """Return a downloader for another config sharing this HTTP session, token and S3 client"""
+        clone = copy.copy(self)
+        clone.config = config
+        return clone
 
     def _create_oauth_session(self):
         """Set up OAuth2 session with client_credentials grant and retry."""
         auth_cfg = self.config['auth']
         client = BackendApplicationClient(client_id=auth_cfg['client_id'])
         session = OAuth2Session(client=client)
-        token = session.fetch_token(
-            token_url=auth_cfg['token_url'],
-            client_id=auth_cfg['client_id'],
-            client_secret=auth_cfg['client_secret']
-        )
+        self._fetch_token(session)
         # Attach retry logic for transient errors
         retry_strategy = Retry(
             total=5,
@@ -39,10 +86,37 @@ class CopernicusDataSpaceDownloader:
             backoff_factor=1,
             allowed_methods=["GET", "POST"]
         )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
+        adapter = HTTPAdapter(
+            max_retries=retry_strategy,
+            pool_connections=self.max_concurrent,
+            pool_maxsize=self.max_concurrent * self.multipart_parts
+        )
         session.mount("https://", adapter)
         return session
 
+    def _fetch_token(self, session):
+        """Fetch a client_credentials token into session"""
+        auth_cfg = self.config['auth']
+        session.fetch_token(
+            token_url=auth_cfg['token_url'],
+            client_id=auth_cfg['client_id'],
+            client_secret=auth_cfg['client_secret']
+        )
+
+    def ensure_token(self, margin: float = 60):
+        """
+        Fetch a new token when the current one expires within margin seconds
+
+        client_credentials tokens are short-lived and carry no refresh
+        token, so long runs and the download service renew them before
+        every request instead of failing with TokenExpiredError or 401.
+        """
+        with self._token_lock:
+            expires_at = self.session.token.get('expires_at')
+            if expires_at is not None and expires_at - time.time() <= margin:
+                logging.info("Renewing OAuth token")
+                self._fetch_token(self.session)
+
     def create_search_query(self):
         """Build the query parameters for mosaic search from the config."""
         geom = self.config['data']['geometry']
@@ -68,76 +142,262 @@ class CopernicusDataSpaceDownloader:
             'datetime': datetime_str,
             'collections': [self.config['download']['copernicus_mosaic']['collection']],
             'maxCloudCover': self.config['download']['copernicus_mosaic']['max_cloud_cover'],
-            'limit': 10
+            'limit': self.config['download']['copernicus_mosaic'].get('page_size', 100)
         }
 
+    def _search_cache_path(self, query) -> str:
+        """Cache file of a search, keyed by bbox, datetime, collection and cloud cover"""
+        cache_cfg = self.config['download'].get('search_cache', {})
+        key = json.dumps([query['bbox'], query['datetime'],
+                          query['collections'], query['maxCloudCover']])
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+        return os.path.join(cache_cfg.get('folder', 'data/cache/search'), f"{digest}.json")
+
+    def _read_search_cache(self, query):
+        """Return cached features for a query, or None if missing or expired"""
+        cache_cfg = self.config['download'].get('search_cache', {})
+        if not cache_cfg.get('enabled', True):
+            return None
+        cache_path = self._search_cache_path(query)
+        if not os.path.exists(cache_path):
+            return None
+        age_hours = (time.time() - os.path.getmtime(cache_path)) / 3600
+        if age_hours > cache_cfg.get('ttl_hours', 24):
+            logging.info(f"Search cache expired ({age_hours:.1f} h old): {cache_path}")
+            return None
+        with open(cache_path, "r", encoding="utf-8") as f:
+            return json.load(f)['features']
+
+    def _write_search_cache(self, query, features) -> None:
+        """Store the complete result of a search"""
+        cache_cfg = self.config['download'].get('search_cache', {})
+        if not cache_cfg.get('enabled', True):
+            return
+        cache_path = self._search_cache_path(query)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({'query': query, 'features': features}, f)
+        os.replace(tmp_path, cache_path)
+
+    def iter_search_features(self):
+        """
+        Yield search result features, following 'next' links page by page
+
+        A fresh cached result for the same query is replayed without any
+        network round trip; a completed search refreshes the cache.
+        """
+        query = self.create_search_query()
+        cached = self._read_search_cache(query)
+        if cached is not None:
+            logging.info(f"Using cached search result ({len(cached)} products)")
+            yield from cached
+            return
+
+        features = []
+        self.ensure_token()
+        resp = self.session.get(self.config['download']['copernicus_mosaic']['url'],
+                                params=query, timeout=60)
+        while True:
+            resp.raise_for_status()
+            page = resp.json()
+            for feat in page.get('features', []):
+                features.append(feat)
+                yield feat
+
+            next_link = next((link for link in page.get('links', [])
+                              if link.get('rel') == 'next'), None)
+            if not next_link:
+                break
+            self.ensure_token()
+            if next_link.get('method', 'GET').upper() == 'POST':
+                resp = self.session.post(next_link['href'], json=next_link.get('body'), timeout=60)
+            else:
+                resp = self.session.get(next_link['href'], timeout=60)
+
+        self._write_search_cache(query, features)
+
+    def existing_products(self, out_dir: str) -> set:
+        """Index of product ids already downloaded or extracted in out_dir"""
+        if not os.path.isdir(out_dir):
+            return set()
+        return {name.split('.')[0] for name in os.listdir(out_dir)
+                if name.endswith(('.zip', '.SAFE'))}
+
+    def _fetch_range(self, url: str, part_path: str, start: int = 0, end: int = None) -> bool:
+        """
+        Download bytes [start, end] of url into part_path, resuming a partial file
+
+        Bytes already present in part_path are skipped with an HTTP Range
+        request, both across runs and when a transfer drops mid-stream.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            done = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            first = start + done
+            if end is not None and first > end:
+                return True
+
+            headers = {}
+            if first > 0 or end is not None:
+                headers['Range'] = f"bytes={first}-{'' if end is None else end}"
+
+            try:
+                self.ensure_token()
+                with self.session.get(url, headers=headers, stream=True, timeout=60) as resp:
+                    if resp.status_code == 416:
+                        # Requested range starts at or past the end of the file; the
+                        # caller checks the size against Content-Length
+                        return True
+                    resp.raise_for_status()
+                    if resp.status_code != 206 and end is not None:
+                        raise IOError(f"Server does not support range requests for {url}")
+                    mode = "ab" if resp.status_code == 206 else "wb"
+                    if done and mode == "wb":
+                        logging.warning(f"Server ignored range request, restarting {part_path}")
+                    with open(part_path, mode) as f:
+                        for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                            if chunk:
+                                f.write(chunk)
+                return True
+            except requests.exceptions.RequestException as e:
+                logging.warning(f"Transfer of {part_path} interrupted "
+                                f"(attempt {attempt}/{self.max_attempts}): {e}")
+                if attempt < self.max_attempts:
+                    # Exponential backoff, so retries outlast a transient outage or rate limit
+                    time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+        return False
+
+    def _download_multipart(self, url: str, out_path: str, size: int) -> bool:
+        """Fetch a large file as parallel byte ranges, then join the parts"""
+        part_size = -(-size // self.multipart_parts)
+        ranges = [(i, start, min(start + part_size, size) - 1)
+                  for i, start in enumerate(range(0, size, part_size))]
+        part_paths = [f"{out_path}.part{i}" for i, _, _ in ranges]
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(self._fetch_range, url, part_paths[i], start, end)
+                       for i, start, end in ranges]
+            if not all(future.result() for future in futures):
+                return False
+
+        # An interrupted join leaves a valid prefix in .part, resumed as a single range
+        try:
+            with open(f"{out_path}.part", "wb") as out:
+                for part_path in part_paths:
+                    with open(part_path, "rb") as part:
+                        shutil.copyfileobj(part, out, self.chunk_size)
+        finally:
+            for part_path in part_paths:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+        return True
+
     def _download_asset(self, url: str, out_path: str) -> bool:
         """Download via S3 or HTTP(S), return True on success."""
         if url.startswith("s3://"):
             bucket, key = url[5:].split("/", 1)
             try:
-                self.s3.download_file(bucket, key, out_path)
+                self.s3.download_file(bucket, key, out_path, Config=self.s3_transfer)
                 return True
-            except botocore.exceptions.ClientError as e:
+            except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError,
+                    S3TransferFailedError) as e:
                 logging.error(f"S3 download error for {url}: {e}")
                 return False
 
-        # HTTP(S) download
+        # HTTP(S) download into a .part file, resumed on the next attempt
+        part_path = f"{out_path}.part"
         try:
-            resp = self.session.get(url, stream=True, timeout=60)
-            resp.raise_for_status()
-            with open(out_path, "wb") as f:
-                for chunk in resp.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+            self.ensure_token()
+            head = self.session.head(url, allow_redirects=True, timeout=60)
+            size = int(head.headers.get('Content-Length', 0)) if head.ok else 0
+            ranged = head.ok and head.headers.get('Accept-Ranges') == 'bytes'
+
+            # A .part larger than the remote file is left from another version of it
+            if size and os.path.exists(part_path) and os.path.getsize(part_path) > size:
+                logging.warning(f"Discarding stale {part_path}: larger than the remote file")
+                os.remove(part_path)
+
+            if ranged and size >= self.multipart_threshold and not os.path.exists(part_path):
+                logging.info(f"Fetching {url} in {self.multipart_parts} parallel parts")
+                if not self._download_multipart(head.url, out_path, size):
+                    return False
+            elif not self._fetch_range(url, part_path):
+                return False
+
+            if size and os.path.getsize(part_path) != size:
+                logging.error(f"Size mismatch for {url}: {os.path.getsize(part_path)} bytes "
+                              f"instead of {size}, discarding {part_path}")
+                os.remove(part_path)
+                return False
+
+            os.replace(part_path, out_path)
             return True
         except Exception as e:
             logging.error(f"HTTP download failed for {url}: {e}")
             return False
 
+    def _download_feature(self, feat, out_dir: str) -> bool:
+        """Download the first available asset of a search result feature"""
+        pid = feat.get('id', 'unknown_id')
+        assets = feat.get('assets', {})
+        # pick the first available asset
+        href = next((a.get('href') for a in assets.values() if a.get('href')), None)
+        if not href:
+            logging.error(f"No download href for product {pid}")
+            return False
+
+        out_file = os.path.join(out_dir, f"{pid}.zip")
+        logging.info(f"Downloading product {pid} from {href}")
+        with run_metrics.measure('download', pid):
+            ok = self._download_asset(href, out_file)
+        if ok:
+            run_metrics.add('download', pid, network_bytes=file_size(out_file))
+            logging.info(f"Successfully downloaded: {out_file}")
+            return True
+        logging.error(f"Failed to download: {pid}")
+        return False
+
     def download_data(self):
         """Perform mosaic search and download all returned assets."""
-        query = self.create_search_query()
-        search_url = self.config['download']['copernicus_mosaic']['url']
-
         logging.info(f"Searching for data between {self.config['data']['dates']['start']} and {self.config['data']['dates']['end']}")
+
+        out_dir = self.config['download'].get('output_folder', os.path.join('data', 'raw', 'Sentinel-2'))
+        os.makedirs(out_dir, exist_ok=True)
+        downloaded = self.existing_products(out_dir)
+
+        # Bounded pool of concurrent transfers, fed while pages stream in
+        found = skipped = success_count = 0
         try:
-            resp = self.session.get(search_url, params=query, timeout=60)
-            resp.raise_for_status()
+            with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+                futures = []
+                for feat in self.iter_search_features():
+                    found += 1
+                    pid = feat.get('id', 'unknown_id').split('.')[0]
+                    if pid in downloaded:
+                        logging.info(f"Skipping {pid} - already present in {out_dir}")
+                        skipped += 1
+                        continue
+                    downloaded.add(pid)
+                    futures.append(executor.submit(self._download_feature, feat, out_dir))
+
+                # One failed product must not abort the rest of the batch
+                for future in as_completed(futures):
+                    try:
+                        if future.result():
+                            success_count += 1
+                    except Exception as e:
+                        logging.error(f"Download failed: {e}")
         except Exception as e:
-            logging.error(f"Mosaic search failed: {e}")
+            logging.error(f"Mosaic search or download failed: {e}")
             return False
 
-        features = resp.json().get('features', [])
-        if not features:
+        if not found:
             logging.error("No products found matching the criteria")
             return False
 
-        logging.info(f"Found {len(features)} products")
-
-        out_dir = os.path.join(self.config['processing']['output_folder'], 'sentinel2')
-        os.makedirs(out_dir, exist_ok=True)
-
-        success_count = 0
-        for feat in features:
-            pid = feat.get('id', 'unknown_id')
-            assets = feat.get('assets', {})
-            # pick the first available asset
-            href = next((a.get('href') for a in assets.values() if a.get('href')), None)
-            if not href:
-                logging.error(f"No download href for product {pid}")
-                continue
-
-            out_file = os.path.join(out_dir, f"{pid}.zip")
-            logging.info(f"Downloading product {pid} from {href}")
-            if self._download_asset(href, out_file):
-                logging.info(f"Successfully downloaded: {out_file}")
-                success_count += 1
-            else:
-                logging.error(f"Failed to download: {pid}")
-
-        logging.info(f"Downloaded {success_count} out of {len(features)} products")
-        return success_count > 0
+        logging.info(f"Found {found} products, {skipped} already present")
+        logging.info(f"Downloaded {success_count} out of {found - skipped} products")
+        return success_count > 0 or found == skipped
 
 def main():
     # Load configuration
@@ -160,6 +420,7 @@ def main():
         logging.info("Download completed successfully")
     else:
         logging.error("Download failed")
+    write_report(project_root, config, name='download')
 
 if __name__ == "__main__":
     main()
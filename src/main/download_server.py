@@ -1,13 +1,53 @@
-from fastapi import FastAPI, BackgroundTasks
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+from pathlib import Path
 import yaml
 import logging
 import os
-from datetime import datetime
-import requests
+import sys
+import copy
+import time
+import uuid
 import asyncio
 
-app = FastAPI()
+# Add project root to Python path
+current_file = Path(__file__).resolve()
+project_root = None
+for parent in current_file.parents:
+    if parent.name == "processing-root-folder":
+        project_root = parent
+        break
+if project_root is None:
+    raise RuntimeError("Project root 'processing-root-folder' not found")
+sys.path.append(str(project_root))
+
+from src.main.download import CopernicusDataSpaceDownloader
+from src.auxiliary.metrics_utils import run_metrics, file_size
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load config once, run the shared downloader and job workers, then stop them"""
+    config = load_config()
+    setup_logging(config)
+    server_cfg = config['download'].get('server', {})
+
+    app.state.config = config
+    app.state.downloader = await asyncio.to_thread(CopernicusDataSpaceDownloader, config)
+    app.state.in_flight = set()
+    app.state.queue = asyncio.Queue(maxsize=server_cfg.get('queue_size', 100))
+    app.state.workers = [asyncio.create_task(job_worker(i))
+                         for i in range(server_cfg.get('workers', 2))]
+    logging.info(f"Download service started with {len(app.state.workers)} workers")
+    yield
+
+    for worker in app.state.workers:
+        worker.cancel()
+    await asyncio.gather(*app.state.workers, return_exceptions=True)
+
+app = FastAPI(lifespan=lifespan)
 
 class DownloadRequest(BaseModel):
     start_date: str
@@ -15,6 +55,30 @@ class DownloadRequest(BaseModel):
     cloud_cover: int
     polygon: list
 
+class JobStatus(BaseModel):
+    id: str
+    status: str = "queued"
+    request: DownloadRequest
+    created: float
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    products_found: int = 0
+    products_skipped: int = 0
+    products_done: int = 0
+    products_failed: int = 0
+    bytes_downloaded: int = 0
+    error: Optional[str] = None
+
+jobs: Dict[str, JobStatus] = {}
+metrics = {
+    'started': time.time(),
+    'jobs_submitted': 0,
+    'jobs_finished': 0,
+    'products_downloaded': 0,
+    'products_failed': 0,
+    'bytes_downloaded': 0
+}
+
 def load_config():
     with open("config/config.yaml", "r") as f:
         return yaml.safe_load(f)
@@ -29,39 +93,170 @@ def setup_logging(config):
         format='%(asctime)s - %(levelname)s - %(message)s'
     )
 
-async def download_image(url: str, output_path: str):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status == 200:
-                with open(output_path, 'wb') as f:
-                    while True:
-                        chunk = await response.content.read(1024)
-                        if not chunk:
-                            break
-                        f.write(chunk)
-                logging.info(f"Downloaded: {output_path}")
-            else:
-                logging.error(f"Failed to download {url}")
+def job_config(config: Dict, request: DownloadRequest) -> Dict:
+    """Overlay the dates, cloud cover and polygon of a request on the base config"""
+    cfg = copy.deepcopy(config)
+    cfg['data']['dates'] = {'start': request.start_date, 'end': request.end_date}
+    cfg['data']['geometry'] = {'type': 'Polygon', 'coordinates': [request.polygon]}
+    cfg['download']['copernicus_mosaic']['max_cloud_cover'] = request.cloud_cover
+    return cfg
+
+async def download_product(feat: Dict, job: JobStatus, downloader: CopernicusDataSpaceDownloader,
+                           out_dir: str, semaphore: asyncio.Semaphore) -> None:
+    """
+    Download a product within the concurrency limit and record job progress
+
+    The transfer runs in a thread through the downloader, with its resume
+    attempts, multipart ranges, token renewal, S3 transfer settings and
+    run metrics.
+    """
+    pid = feat.get('id', 'unknown_id')
+
+    async with semaphore:
+        try:
+            ok = await asyncio.to_thread(downloader._download_feature, feat, out_dir)
+        except Exception as e:
+            logging.error(f"Failed to download {pid}: {e}")
+            ok = False
+        finally:
+            app.state.in_flight.discard(pid.split('.')[0])
+
+    if ok:
+        size = file_size(os.path.join(out_dir, f"{pid}.zip"))
+        job.bytes_downloaded += size
+        job.products_done += 1
+        metrics['bytes_downloaded'] += size
+        metrics['products_downloaded'] += 1
+    else:
+        job.products_failed += 1
+        metrics['products_failed'] += 1
+
+async def run_job(job: JobStatus) -> None:
+    """Search the catalogue for a job and download every new product"""
+    config = app.state.config
+    downloader = app.state.downloader.for_config(job_config(config, job.request))
+    out_dir = config['download'].get('output_folder', os.path.join('data', 'raw', 'Sentinel-2'))
+    os.makedirs(out_dir, exist_ok=True)
+
+    logging.info(f"Job {job.id}: searching {job.request.start_date} to {job.request.end_date}, "
+                 f"cloud cover <= {job.request.cloud_cover}")
+    job.status = "searching"
+    features = await asyncio.to_thread(lambda: list(downloader.iter_search_features()))
+    job.products_found = len(features)
+
+    # Skip products on disk or being downloaded by another job; no await
+    # until the claims are made, so concurrent jobs never share a .part file
+    downloaded = downloader.existing_products(out_dir)
+    in_flight = app.state.in_flight
+    pending = []
+    for feat in features:
+        pid = feat.get('id', 'unknown_id').split('.')[0]
+        if pid in downloaded or pid in in_flight:
+            job.products_skipped += 1
+            continue
+        in_flight.add(pid)
+        pending.append(feat)
+
+    job.status = "downloading"
+    semaphore = asyncio.Semaphore(downloader.max_concurrent)
+    await asyncio.gather(*(download_product(feat, job, downloader, out_dir, semaphore)
+                           for feat in pending))
+
+async def job_worker(worker_id: int) -> None:
+    """Drain the job queue, one job at a time"""
+    queue = app.state.queue
+    while True:
+        job = await queue.get()
+        job.started = time.time()
+        try:
+            await run_job(job)
+            job.status = "failed" if job.products_failed and not job.products_done else "completed"
+        except Exception as e:
+            logging.error(f"Job {job.id} failed: {e}", exc_info=True)
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished = time.time()
+            metrics['jobs_finished'] += 1
+            logging.info(f"Job {job.id} {job.status} on worker {worker_id}: "
+                         f"{job.products_done}/{job.products_found} products, "
+                         f"{job.bytes_downloaded} bytes")
+            queue.task_done()
+
+def evict_jobs(server_cfg: Dict) -> None:
+    """Drop finished jobs past their TTL, then the oldest beyond the cap"""
+    ttl = server_cfg.get('job_ttl_s', 3600)
+    max_finished = server_cfg.get('max_finished_jobs', 1000)
+    now = time.time()
+    finished = sorted((job for job in jobs.values() if job.finished is not None),
+                      key=lambda job: job.finished)
+    # Oldest first, so the expired jobs are a prefix of the list
+    expired = sum(1 for job in finished if now - job.finished > ttl)
+    expired = finished[:max(expired, len(finished) - max_finished)]
+    for job in expired:
+        del jobs[job.id]
+    if expired:
+        logging.info(f"Evicted {len(expired)} finished jobs")
 
 @app.post("/download/")
-async def create_download(request: DownloadRequest, background_tasks: BackgroundTasks):
-    config = load_config()
-    setup_logging(config)
-    
-    output_folder = os.path.join(
-        config['processing']['output_folder'],
-        config['satellite']['copernicus']['platform'],
-        config['satellite']['copernicus']['product_level']
-    )
-    os.makedirs(output_folder, exist_ok=True)
-    
-    logging.info(f"Starting download for dates: {request.start_date} to {request.end_date}")
-    logging.info(f"Cloud cover threshold: {request.cloud_cover}")
-    
-    # Here you would implement the actual download logic
-    # This is a placeholder for the actual implementation
-    return {"status": "Download started", "output_folder": output_folder}
+async def create_download(request: DownloadRequest):
+    job = JobStatus(id=uuid.uuid4().hex, request=request, created=time.time())
+    try:
+        app.state.queue.put_nowait(job)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Download queue is full")
+
+    evict_jobs(app.state.config['download'].get('server', {}))
+    jobs[job.id] = job
+    metrics['jobs_submitted'] += 1
+    logging.info(f"Queued job {job.id} for dates: {request.start_date} to {request.end_date}")
+    return {"status": "queued", "job_id": job.id, "queue_position": app.state.queue.qsize()}
+
+@app.get("/jobs")
+async def list_jobs() -> List[Dict]:
+    return [job.model_dump(exclude={'request'}) for job in jobs.values()]
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+
+    status = job.model_dump()
+    elapsed = (job.finished or time.time()) - job.started if job.started else 0
+    pending = job.products_found - job.products_skipped
+    status['progress'] = (job.products_done + job.products_failed) / pending if pending else 0.0
+    status['throughput_mb_s'] = job.bytes_downloaded / elapsed / 1024 / 1024 if elapsed else 0.0
+    return status
+
+@app.get("/metrics")
+async def get_metrics():
+    uptime = time.time() - metrics['started']
+    return {
+        **metrics,
+        'uptime_s': uptime,
+        'queued_jobs': app.state.queue.qsize(),
+        'throughput_mb_s': metrics['bytes_downloaded'] / uptime / 1024 / 1024 if uptime else 0.0
+    }
+
+@app.get("/metrics/prometheus", response_class=PlainTextResponse)
+async def get_prometheus_metrics():
+    """Service counters and per-stage run metrics in the Prometheus text format"""
+    if not app.state.config['download'].get('server', {}).get('prometheus', True):
+        raise HTTPException(status_code=404, detail="Prometheus endpoint disabled")
+
+    uptime = time.time() - metrics['started']
+    lines = [
+        "# TYPE eo_download_uptime_seconds gauge",
+        f"eo_download_uptime_seconds {uptime}",
+        "# TYPE eo_download_queued_jobs gauge",
+        f"eo_download_queued_jobs {app.state.queue.qsize()}"
+    ]
+    for name in ('jobs_submitted', 'jobs_finished', 'products_downloaded', 'products_failed', 'bytes_downloaded'):
+        lines.append(f"# TYPE eo_download_{name}_total counter")
+        lines.append(f"eo_download_{name}_total {metrics[name]}")
+    return "\n".join(lines) + "\n" + run_metrics.prometheus()
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000)
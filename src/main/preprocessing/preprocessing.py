@@ -5,17 +5,17 @@ Handles unzipping, band extraction and data organization
 import os
 import sys
 import logging
-from datetime import datetime
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
 import rasterio
 import numpy as np
+from rasterio import windows
 from rasterio.warp import transform_bounds
-from shapely.geometry import box, shape
-from rasterio.mask import mask
-import geopandas as gpd
-import json
-from osgeo import gdal, ogr, osr  # Changed from direct import to osgeo package
+from rasterio.windows import Window
+from shapely.geometry import box
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from osgeo import gdal  # Changed from direct import to osgeo package
 
 # Add project root to Python path
 current_file = Path(__file__).resolve()
@@ -28,8 +28,24 @@ if project_root is None:
     raise RuntimeError("Project root 'processing-root-folder' not found")
 sys.path.append(str(project_root))
 
-from src.auxiliary.unzip_utils import unzip_sentinel_data
-from src.auxiliary.read_geojson import read_geojson
+from src.auxiliary.unzip_utils import unzip_sentinel_data, extract_band_members
+from src.auxiliary.safe_index import SafeIndex
+from src.auxiliary.aoi_utils import AOI, AOISet
+from src.auxiliary.config_utils import load_config
+from src.auxiliary.cache_utils import StageCache, module_digest
+from src.auxiliary.metrics_utils import run_metrics, file_size
+from src.auxiliary.scl_utils import DEFAULT_MASK_CLASSES, mask_lut, masked_pixels, masked_fraction, scl_blocks
+from src.main.processing.indices import REFLECTANCE_SCALE, compute_indices
+from src.auxiliary.raster_utils import (stream_clip_bands, aoi_window, overview_level_for,
+                                        cog_profile, finalize_cog, gdal_creation_options,
+                                        aoi_mask, apply_mask, bounds_window, reproject_geometry)
+from src.auxiliary import (unzip_utils, safe_index, aoi_utils, read_geojson,
+                           scl_utils, raster_utils)
+from src.main.processing import indices
+
+# Sources of the outputs: code changes in any of them invalidate the cache
+CODE_FILES = [__file__, unzip_utils.__file__, safe_index.__file__, aoi_utils.__file__,
+              read_geojson.__file__, scl_utils.__file__, raster_utils.__file__, indices.__file__]
 
 def setup_logging() -> None:
     """Configure logging to results/logs/preprocessing.log"""
@@ -53,55 +69,92 @@ def calculate_ndvi(red: np.ndarray, nir: np.ndarray) -> np.ndarray:
     Calculate NDVI from BOA reflectance values
     """
     # Scale DN to reflectance
-    red_ref = red.astype('float32') / 10000.0
-    nir_ref = nir.astype('float32') / 10000.0
-    
-    # Calculate NDVI
-    ndvi = np.where(
-        (nir_ref + red_ref) > 0,
-        (nir_ref - red_ref) / (nir_ref + red_ref),
-        0
-    )
-    
-    return np.clip(ndvi, -1, 1)
+    bands = {
+        'B04': red.astype('float32') * REFLECTANCE_SCALE,
+        'B08': nir.astype('float32') * REFLECTANCE_SCALE
+    }
+    return compute_indices(bands, ['ndvi'])['ndvi']
 
 class PreprocessingPipeline:
-    def __init__(self, root_dir: Path):
+    def __init__(self, root_dir: Path, config: Optional[Dict[str, Any]] = None):
         self.root_dir = root_dir
+        self.config = config if config is not None else load_config(root_dir)
+        self.settings = self.config.get('preprocessing', {})
+        self.cog = self.config.get('raster_output', {})
+        self._safe_index = None
+    
+    @property
+    def safe_index(self) -> SafeIndex:
+        """SAFE product index, opened on first use so worker processes open their own"""
+        if self._safe_index is None:
+            self._safe_index = SafeIndex.from_config(self.root_dir, self.config)
+        return self._safe_index
+        
+    def get_product_sources(self, raw_dir: Path) -> List[Path]:
+        """Get zip files and extracted SAFE directories, one entry per product"""
+        sources = list(raw_dir.glob("*.zip"))
+        zipped = {zip_file.stem.split('.')[0] for zip_file in sources}
+        
+        # Add any existing SAFE directories not shadowed by a newer zip
+        for safe_dir in raw_dir.glob("*.SAFE"):
+            if safe_dir.name.split('.')[0] not in zipped and (safe_dir / "GRANULE").exists():
+                sources.append(safe_dir)
+                logging.info(f"Found existing SAFE directory: {safe_dir.name}")
+        
+        return sources
+
+    def extract_product(self, source: Path) -> Optional[Path]:
+        """
+        Return the SAFE directory of a product, unzipping in place if necessary
+        
+        preprocessing.extract_mode selects how much of a zip is materialised:
+        'full' extracts everything and deletes the zip, 'bands' extracts only
+        the required R10m band files (and the R20m SCL when masking clouds)
+        and 'vsizip' extracts nothing, returning the zip itself so bands are
+        read in place through GDAL /vsizip/.
+        """
+        if source.suffix.lower() != ".zip":
+            return source
+        
+        extract_mode = self.settings.get('extract_mode', 'full')
+        if extract_mode == 'vsizip':
+            return source
         
+        product_name = source.name.split('.')[0]
+        with run_metrics.measure('extract', product_name):
+            run_metrics.add('extract', product_name, bytes_read=file_size(source))
+            try:
+                if extract_mode == 'bands':
+                    bands = self.settings.get('bands', ['B02', 'B03', 'B04', 'B08'])
+                    safe_dir = extract_band_members(str(source), str(source.parent), bands)
+                    if safe_dir and self.settings.get('scl_mask', True):
+                        extract_band_members(str(source), str(source.parent), ['SCL'], 'R20m')
+                    return Path(safe_dir) if safe_dir else None
+            
+                # Extract directly in raw directory
+                safe_dir = unzip_sentinel_data(str(source), str(source.parent))
+                if not safe_dir:
+                    return None
+            
+                safe_path = Path(safe_dir)
+                logging.info(f"Successfully extracted: {safe_path.name}")
+            
+                # Delete zip file after successful extraction
+                source.unlink()
+                logging.info(f"Deleted zip file: {source.name}")
+                return safe_path
+            
+            except Exception as e:
+                logging.error(f"Failed to process {source.name}: {str(e)}", exc_info=True)
+                return None
+
     def get_safe_paths(self, raw_dir: Path) -> List[Path]:
         """Get paths to SAFE directories, unzipping in place if necessary"""
         safe_paths = []
-        
-        # Process zip files first
-        zip_files = list(raw_dir.glob("*.zip"))
-        if zip_files:
-            logging.info(f"Found {len(zip_files)} zip files to extract")
-            
-            for zip_file in zip_files:
-                try:
-                    # Extract directly in raw directory
-                    safe_dir = unzip_sentinel_data(str(zip_file), str(raw_dir))
-                    
-                    if safe_dir:
-                        safe_path = Path(safe_dir)
-                        safe_paths.append(safe_path)
-                        logging.info(f"Successfully extracted: {safe_path.name}")
-                        
-                        # Delete zip file after successful extraction
-                        zip_file.unlink()
-                        logging.info(f"Deleted zip file: {zip_file.name}")
-                        
-                except Exception as e:
-                    logging.error(f"Failed to process {zip_file.name}: {str(e)}", exc_info=True)
-                    continue
-        
-        # Add any existing SAFE directories
-        existing_safes = list(raw_dir.glob("*.SAFE"))
-        for safe_dir in existing_safes:
-            if safe_dir not in safe_paths and (safe_dir / "GRANULE").exists():
-                safe_paths.append(safe_dir)
-                logging.info(f"Found existing SAFE directory: {safe_dir.name}")
+        for source in self.get_product_sources(raw_dir):
+            safe_path = self.extract_product(source)
+            if safe_path:
+                safe_paths.append(safe_path)
         
         if not safe_paths:
             logging.error("No valid SAFE directories found")
@@ -110,210 +163,292 @@ class PreprocessingPipeline:
             
         return safe_paths
 
+    def find_band_files(self, safe_path: Path, bands_to_process: List[str]) -> Dict[str, Any]:
+        """Look up the R10m band files of a SAFE directory, or /vsizip/ paths of a SAFE zip, in the SAFE index"""
+        product_name = self.safe_index.index(safe_path)
+        if product_name is None:
+            return {}
+        
+        band_files = self.safe_index.band_paths(product_name, bands_to_process, resolution='R10m')
+        for band in bands_to_process:
+            if band in band_files:
+                logging.info(f"Found {band}: {Path(band_files[band]).name}")
+            else:
+                logging.warning(f"Band {band} not found in {safe_path.name}")
+        
+        return band_files
+
+    def find_scl_file(self, product_name: str) -> Optional[str]:
+        """R20m scene classification of an indexed product, None when SCL masking is off or it is missing"""
+        if not self.settings.get('scl_mask', True):
+            return None
+        scl_file = self.safe_index.band_paths(product_name, ['SCL'], resolution='R20m').get('SCL')
+        if scl_file is None:
+            logging.warning(f"SCL not found in {product_name}, clouds are not masked")
+        return scl_file
+
+    def drop_masked_clips(self,
+                          product_name: str,
+                          clips: Dict[Path, Tuple[Window, Any]],
+                          scl_file: str,
+                          crs,
+                          transform) -> Dict[Path, Tuple[Window, Any]]:
+        """
+        Leave out the clips whose SCL is masked beyond preprocessing.scl_max_masked
+        
+        Only the 20 m classification under each clip window is read, so
+        cloudy products are dropped before any band is decoded.
+        """
+        lut = mask_lut(self.settings.get('scl_mask_classes', DEFAULT_MASK_CLASSES))
+        max_masked = self.settings.get('scl_max_masked', 1.0)
+        kept = {}
+        for output_path, (window, mask_geometry) in clips.items():
+            fraction = masked_fraction(scl_file, crs, transform, window, lut)
+            if fraction >= max_masked:
+                logging.info(f"Dropping {output_path.name} - {fraction:.0%} masked by the SCL")
+            else:
+                kept[output_path] = (window, mask_geometry)
+        if not kept:
+            logging.warning(f"Skipping {product_name} - masked by the SCL")
+        return kept
+
     def process_safe_directory(self, 
                              safe_path: Path, 
                              output_dir: Path,
-                             bands_to_process: List[str]) -> bool:
-        """Process a single SAFE directory with correct SAFE structure navigation"""
+                             bands_to_process: List[str],
+                             aois: Optional[AOISet] = None) -> List[Path]:
+        """
+        Process a single SAFE directory with correct SAFE structure navigation
+        
+        When AOIs are given, the AOIs touching the tile footprint are looked
+        up in the AOI index and the union of their envelope windows is
+        decoded once, fanning out to one clipped product per AOI.
+        
+        With preprocessing.scl_mask, pixels of the masked scene classes are
+        written as 0 (nodata): outputs whose classification is masked are
+        dropped up front, and blocks that are fully masked are not decoded.
+        
+        Returns:
+            List[Path]: Written products, empty on failure or without overlap
+        """
         try:
             output_dir.mkdir(parents=True, exist_ok=True)
             
-            # Navigate through correct SAFE structure
-            granule_dirs = list(safe_path.glob("GRANULE/*"))
-            if not granule_dirs:
-                logging.error(f"No GRANULE subdirectories found in {safe_path}")
-                return False
-                
-            granule_dir = granule_dirs[0]  # Use first granule directory
-            r10m_path = granule_dir / "IMG_DATA" / "R10m"
-            
-            if not r10m_path.exists():
-                logging.error(f"R10m directory not found in {granule_dir}/IMG_DATA")
-                return False
-                
-            logging.info(f"Processing bands from: {r10m_path}")
-            
-            # Find band files with correct pattern matching
-            band_files = {}
-            for band in bands_to_process:
-                # Use wider pattern matching for band files
-                band_files_found = list(r10m_path.glob(f"*_{band}_*.jp2"))
-                if band_files_found:
-                    band_files[band] = band_files_found[0]
-                    logging.info(f"Found {band}: {band_files_found[0].name}")
-                else:
-                    logging.warning(f"Band {band} not found in {r10m_path}")
-            
+            band_files = self.find_band_files(safe_path, bands_to_process)
             if not band_files:
                 logging.error("No bands found to process")
-                return False
+                return []
             
             # Process and save bands
             product_name = safe_path.name.split('.')[0]
-            output_path = output_dir / f"{product_name}_bands.tif"
             
-            # Read and stack bands
+            # Resolve the read windows and JP2 resolution level up front
+            first_band = next(iter(band_files.values()))
+            with rasterio.open(first_band) as src:
+                overview_level = overview_level_for(src.res[0],
+                                                    self.settings.get('target_resolution'),
+                                                    len(src.overviews(1)))
+            open_kwargs = {} if overview_level is None else {'overview_level': overview_level}
+            with rasterio.open(first_band, **open_kwargs) as src:
+                grid = (src.crs, src.transform, src.width, src.height)
+            
+            if aois is None:
+                clips = {output_dir / f"{product_name}_bands.tif": (Window(0, 0, grid[2], grid[3]), None)}
+            else:
+                clips = {}
+                with rasterio.open(first_band, **open_kwargs) as src:
+                    footprint = box(*transform_bounds(src.crs, 'EPSG:4326', *src.bounds))
+                    for aoi in aois.intersecting(footprint):
+                        window = aoi_window(src, aoi.geometry.bounds)
+                        if window is not None:
+                            clips[self.clip_path(output_dir, product_name, aoi, aois)] = (
+                                window, self.mask_geometry(aoi.geometry, src.crs))
+                if not clips:
+                    logging.warning(f"Skipping {product_name} - No overlap with any AOI")
+                    return []
+                logging.info(f"Clipping {product_name} to {len(clips)} of {len(aois)} AOIs")
+            
+            # Drop cloudy outputs from the 20 m classification before decoding bands
+            scl_file = self.find_scl_file(product_name)
+            if scl_file is not None:
+                clips = self.drop_masked_clips(product_name, clips, scl_file, grid[0], grid[1])
+                if not clips:
+                    return []
+            lut = mask_lut(self.settings.get('scl_mask_classes', DEFAULT_MASK_CLASSES))
+            
+            union = windows.union(*(window for window, _ in clips.values()))
+            run_metrics.add('clip', product_name,
+                            bytes_read=sum(file_size(path) for path in band_files.values()),
+                            pixels=int(union.width * union.height) * len(band_files))
+            
+            # Stream block windows straight to the outputs to bound memory
+            if self.settings.get('streaming', True):
+                with (scl_blocks(scl_file, *grid) if scl_file else nullcontext()) as read_scl:
+                    return stream_clip_bands(
+                        band_files,
+                        clips,
+                        block_size=self.settings.get('block_size', 512),
+                        max_block_memory_mb=self.settings.get('max_block_memory_mb', 64),
+                        overview_level=overview_level,
+                        cog=self.cog,
+                        nodata_mask=(lambda window: masked_pixels(read_scl(window), lut)) if read_scl else None
+                    )
+            
+            # Read the union of the clip windows once and slice it per AOI
             band_data = []
             band_names = []
             metadata = None
             
             for band_name, band_file in band_files.items():
-                with rasterio.open(band_file) as src:
+                with rasterio.open(band_file, **open_kwargs) as src:
                     if metadata is None:
                         metadata = src.profile
-                    band_data.append(src.read(1))
+                        src_transform = src.transform
+                    band_data.append(src.read(1, window=union))
                     band_names.append(band_name)
                     logging.debug(f"Read band {band_name}")
             
             # Stack bands and save
             stacked_data = np.stack(band_data)
+            metadata.update({'count': len(band_data)})
+            if scl_file is not None:
+                with scl_blocks(scl_file, *grid) as read_scl:
+                    apply_mask(stacked_data, ~masked_pixels(read_scl(union), lut))
+                metadata['nodata'] = 0
+            
+            for output_path, (window, mask_geometry) in clips.items():
+                row_off = int(window.row_off - union.row_off)
+                col_off = int(window.col_off - union.col_off)
+                clip_data = stacked_data[:, row_off:row_off + int(window.height),
+                                         col_off:col_off + int(window.width)]
+                clip_metadata = dict(metadata)
+                clip_metadata.update({
+                    'width': int(window.width),
+                    'height': int(window.height),
+                    'transform': windows.transform(window, src_transform)
+                })
+                if mask_geometry is not None:
+                    clip_data = apply_mask(clip_data.copy(), aoi_mask(mask_geometry, clip_metadata['transform'],
+                                                                      clip_data.shape[1:]))
+                    clip_metadata['nodata'] = 0
+                clip_metadata = cog_profile(clip_metadata, self.cog)
+                
+                with rasterio.open(output_path, 'w', **clip_metadata) as dst:
+                    dst.write(clip_data)
+                    for idx, name in enumerate(band_names, start=1):
+                        dst.set_band_description(idx, name)
+                finalize_cog(output_path, self.cog)
+                logging.info(f"Saved {len(band_data)} bands to {output_path}")
             
-            metadata.update({
-                'count': len(band_data),
-                'compress': 'lzw',
-                'driver': 'GTiff'
-            })
-            
-            with rasterio.open(output_path, 'w', **metadata) as dst:
-                dst.write(stacked_data)
-                for idx, name in enumerate(band_names, start=1):
-                    dst.set_band_description(idx, name)
-            
-            logging.info(f"Saved {len(band_data)} bands to {output_path}")
-            return True
+            return list(clips)
             
         except Exception as e:
             logging.error(f"Error processing {safe_path}: {str(e)}", exc_info=True)
-            return False
+            return []
+
+    def clip_path(self, output_dir: Path, product_name: str, aoi: AOI, aois: AOISet) -> Path:
+        """Clipped product of an AOI, named after the AOI unless the set holds a single one"""
+        if len(aois) == 1:
+            return output_dir / f"{product_name}_bands_clipped.tif"
+        return output_dir / f"{product_name}_{aoi.name}_bands_clipped.tif"
 
-    def validate_overlap(self, geotiff_path: Path, geojson_path: Path) -> bool:
+    def mask_geometry(self, aoi_geometry, crs):
         """
-        Validate that the GeoJSON AOI overlaps with the GeoTIFF extent
+        AOI polygon in the raster CRS when preprocessing.aoi_mask is 'polygon'
+        
+        Returns None in the default 'envelope' mode, where outputs are only
+        cropped to the AOI bounding box.
+        """
+        if self.settings.get('aoi_mask', 'envelope') != 'polygon':
+            return None
+        return reproject_geometry(aoi_geometry, crs)
+
+    def validate_overlap(self, geotiff_path: Path, aois: AOISet) -> List[AOI]:
+        """
+        Find the AOIs overlapping the GeoTIFF extent
         
         Args:
             geotiff_path: Path to the GeoTIFF file
-            geojson_path: Path to the GeoJSON file
+            aois: Indexed AOIs in EPSG:4326
         
         Returns:
-            bool: True if there is overlap, False otherwise
+            List[AOI]: AOIs intersecting the raster footprint, empty if none
         """
         try:
-            # Read GeoJSON
-            geojson_data = read_geojson(geojson_path)
-            if not geojson_data:
-                logging.error("Failed to read GeoJSON file")
-                return False
-                
-            # Get GeoJSON geometry
-            feature = geojson_data["features"][0]
-            aoi_geometry = shape(feature["geometry"])
-            
             # Read GeoTIFF bounds
             with rasterio.open(geotiff_path) as src:
-                # Get bounds in the same CRS as GeoJSON (assuming EPSG:4326)
+                # Get bounds in the same CRS as the AOIs (EPSG:4326)
                 bounds = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
                 raster_bbox = box(*bounds)
-                
-            # Check for intersection
-            if aoi_geometry.intersects(raster_bbox):
-                overlap_area = aoi_geometry.intersection(raster_bbox).area
-                total_area = aoi_geometry.area
-                coverage = (overlap_area / total_area) * 100
-                
-                logging.info(f"AOI coverage: {coverage:.2f}%")
-                return True
-            else:
-                logging.error("No overlap between GeoJSON and GeoTIFF")
-                return False
+            
+            # Check for intersection through the AOI index
+            overlapping = aois.intersecting(raster_bbox)
+            for aoi in overlapping:
+                overlap_area = aoi.geometry.intersection(raster_bbox).area
+                coverage = (overlap_area / aoi.geometry.area) * 100
+                logging.info(f"AOI {aoi.name} coverage: {coverage:.2f}%")
+            
+            if not overlapping:
+                logging.error("No overlap between the AOIs and GeoTIFF")
+            return overlapping
                 
         except Exception as e:
             logging.error(f"Error validating overlap: {str(e)}", exc_info=True)
-            return False
+            return []
 
-    def clip_to_aoi(self, geotiff_path: Path, geojson_path: Path) -> bool:
-        """Clip GeoTIFF to AOI boundary using GDAL"""
+    def clip_to_aoi(self, geotiff_path: Path, aoi_geometry, clip_path: Path) -> bool:
+        """
+        Clip GeoTIFF to AOI boundary using GDAL
+        
+        The AOI is reprojected into the raster CRS (cached per CRS), snapped
+        to a pixel window and copied with a single gdal.Translate, keeping
+        the source data type. In polygon mode pixels outside the AOI are
+        then set to nodata block by block.
+        
+        Args:
+            geotiff_path: Full product GeoTIFF, left in place
+            aoi_geometry: AOI geometry in EPSG:4326
+            clip_path: Clipped GeoTIFF to write
+        """
         try:
-            logging.info(f"Clipping {geotiff_path.name} to AOI")
-            
-            # Read GeoJSON and get bounds
-            with open(geojson_path) as f:
-                geojson = json.load(f)
-            
-            # Get bounding box from first feature
-            feature = geojson["features"][0]
-            geom = feature["geometry"]
-            geom_ogr = ogr.CreateGeometryFromJson(json.dumps(geom))
-            min_x, max_x, min_y, max_y = geom_ogr.GetEnvelope()
-            
-            # Open source dataset
-            src_ds = gdal.Open(str(geotiff_path))
-            if src_ds is None:
-                logging.error(f"Could not open {geotiff_path}")
+            logging.info(f"Clipping {geotiff_path.name} to {clip_path.name}")
+            
+            with rasterio.open(geotiff_path) as src:
+                dtype = src.dtypes[0]
+                crs = src.crs
+                projected = reproject_geometry(aoi_geometry, crs)
+                window = bounds_window(projected.bounds, src.transform, src.width, src.height)
+            
+            if window is None:
+                logging.error(f"AOI does not overlap {geotiff_path.name}")
                 return False
-                
-            # Get image dimensions and georeference
-            cols = src_ds.RasterXSize
-            rows = src_ds.RasterYSize
-            bands = src_ds.RasterCount
-            transform = src_ds.GetGeoTransform()
-            
-            # Calculate pixel coordinates
-            x_origin = transform[0]
-            y_origin = transform[3]
-            pixel_width = transform[1]
-            pixel_height = -transform[5]
-            
-            # Compute crop coordinates
-            i1 = max(0, int((min_x - x_origin) / pixel_width))
-            j1 = max(0, int((y_origin - max_y) / pixel_height))
-            i2 = min(cols, int((max_x - x_origin) / pixel_width))
-            j2 = min(rows, int((y_origin - min_y) / pixel_height))
-            
-            new_cols = i2 - i1 + 1
-            new_rows = j2 - j1 + 1
-            
-            # Read bands
-            band_list = []
-            for i in range(bands):
-                band = src_ds.GetRasterBand(i + 1)
-                data = band.ReadAsArray(i1, j1, new_cols, new_rows)
-                band_list.append(data)
-            
-            # Update geotransform for new extent
-            new_x = x_origin + i1 * pixel_width
-            new_y = y_origin - j1 * pixel_height
-            new_transform = (new_x, transform[1], transform[2], 
-                            new_y, transform[4], transform[5])
-            
-            # Create output dataset
-            clip_path = geotiff_path.parent / f"{geotiff_path.stem}_clipped.tif"
-            driver = gdal.GetDriverByName("GTiff")
-            dst_ds = driver.Create(str(clip_path), new_cols, new_rows, 
-                                 bands, gdal.GDT_Float32,
-                                 options=['COMPRESS=LZW'])
             
+            mask_geometry = self.mask_geometry(aoi_geometry, crs)
+            
+            # Windowed copy of all bands, descriptions and georeferencing
+            options = gdal.TranslateOptions(
+                format='GTiff',
+                srcWin=[window.col_off, window.row_off, window.width, window.height],
+                creationOptions=gdal_creation_options(dtype, self.cog),
+                noData=0 if mask_geometry is not None else None
+            )
+            dst_ds = gdal.Translate(str(clip_path), str(geotiff_path), options=options)
             if dst_ds is None:
                 logging.error("Could not create output file")
                 return False
-            
-            # Write bands
-            for i, data in enumerate(band_list):
-                dst_band = dst_ds.GetRasterBand(i + 1)
-                dst_band.WriteArray(data)
-                # Copy band description
-                src_band = src_ds.GetRasterBand(i + 1)
-                dst_band.SetDescription(src_band.GetDescription())
-            
-            # Set spatial reference
-            dst_ds.SetGeoTransform(new_transform)
-            dst_ds.SetProjection(src_ds.GetProjection())
-            
-            # Clean up
-            src_ds = None
             dst_ds = None
             
-            # Remove original file
-            geotiff_path.unlink()
+            # Polygon mode: blank everything outside the AOI
+            if mask_geometry is not None:
+                with rasterio.open(clip_path, 'r+') as dst:
+                    mask = aoi_mask(mask_geometry, dst.transform, dst.shape)
+                    for _, block_window in dst.block_windows(1):
+                        (row_start, row_stop), (col_start, col_stop) = block_window.toranges()
+                        block = dst.read(window=block_window)
+                        dst.write(apply_mask(block, mask[row_start:row_stop, col_start:col_stop]),
+                                  window=block_window)
+            
+            finalize_cog(clip_path, self.cog)
             logging.info(f"Saved clipped raster to: {clip_path}")
             
             return True
@@ -322,52 +457,207 @@ class PreprocessingPipeline:
             logging.error(f"Error clipping to AOI: {str(e)}", exc_info=True)
             return False
 
+    def process_product(self,
+                        source: Path,
+                        output_dir: Path,
+                        bands_to_process: List[str],
+                        aois: AOISet) -> List[Path]:
+        """Run extract, stack, validate and clip for a single product, returning its clipped outputs"""
+        logging.info(f"\nProcessing: {source.name}")
+        
+        safe_path = self.extract_product(source)
+        if safe_path is None:
+            return []
+        return self.clip_product(safe_path, output_dir, bands_to_process, aois)
+
+    def clip_product(self,
+                     safe_path: Path,
+                     output_dir: Path,
+                     bands_to_process: List[str],
+                     aois: AOISet) -> List[Path]:
+        """Stack, validate and clip an extracted product, returning its clipped outputs"""
+        product_name = safe_path.name.split('.')[0]
+        with run_metrics.measure('clip', product_name):
+            outputs = self._clip_product(safe_path, output_dir, bands_to_process, aois)
+            run_metrics.add('clip', product_name, bytes_written=sum(file_size(path) for path in outputs))
+        return outputs
+
+    def _clip_product(self,
+                      safe_path: Path,
+                      output_dir: Path,
+                      bands_to_process: List[str],
+                      aois: AOISet) -> List[Path]:
+        # Decode only the AOI windows and write the clipped products once
+        if self.settings.get('aoi_window', True):
+            outputs = self.process_safe_directory(safe_path, output_dir, bands_to_process, aois)
+            if not outputs:
+                logging.error(f"Failed to process {safe_path.name}")
+            return outputs
+        
+        if not self.process_safe_directory(safe_path, output_dir, bands_to_process):
+            logging.error(f"Failed to process {safe_path.name}")
+            return []
+        
+        product_name = safe_path.name.split('.')[0]
+        geotiff_path = output_dir / f"{product_name}_bands.tif"
+        
+        # Validate overlap and clip once per overlapping AOI
+        outputs = []
+        for aoi in self.validate_overlap(geotiff_path, aois):
+            clip_path = self.clip_path(output_dir, product_name, aoi, aois)
+            if self.clip_to_aoi(geotiff_path, aoi.geometry, clip_path):
+                outputs.append(clip_path)
+            else:
+                logging.error(f"Failed to clip {geotiff_path.name} to AOI {aoi.name}")
+        
+        # Remove original file
+        geotiff_path.unlink()
+        if not outputs:
+            logging.warning(f"Removed {geotiff_path.name} - No clipped outputs")
+        return outputs
+
+    def fingerprint(self, cache: StageCache, source: Path,
+                    bands_to_process: List[str], aoi_path: Path) -> str:
+        """Fingerprint the inputs of a product: source, AOIs, band list and settings"""
+        params = {
+            'bands': bands_to_process,
+            'aoi_window': self.settings.get('aoi_window', True),
+            'aoi_mask': self.settings.get('aoi_mask', 'envelope'),
+            'aoi_name_field': self.settings.get('aoi_name_field', 'name'),
+            'target_resolution': self.settings.get('target_resolution'),
+            'scl_mask': self.settings.get('scl_mask', True),
+            'scl_mask_classes': self.settings.get('scl_mask_classes', DEFAULT_MASK_CLASSES),
+            'scl_max_masked': self.settings.get('scl_max_masked', 1.0)
+        }
+        aoi_files = sorted(aoi_path.glob('*.geojson')) if aoi_path.is_dir() else [aoi_path]
+        inputs, read_files = [source], []
+        if source.is_dir():
+            inputs, read_files = self.safe_inputs(source, bands_to_process)
+        return cache.fingerprint([*inputs, *aoi_files], params, module_digest(*CODE_FILES), read_files)
+
+    def safe_inputs(self, safe_path: Path, bands_to_process: List[str]) -> Tuple[List[Path], List[str]]:
+        """
+        Inputs identifying an extracted SAFE without walking it
+
+        Returns:
+            Tuple[List[Path], List[str]]: Files hashed (MTD_MSIL2A.xml, or the
+                directory itself if it cannot be indexed) and the band files the
+                stage reads, identified by name, size and mtime
+        """
+        product_name = self.safe_index.index(safe_path)
+        if product_name is None:
+            return [safe_path], []
+        read_files = self.safe_index.band_paths(product_name, bands_to_process, resolution='R10m')
+        if self.settings.get('scl_mask', True):
+            read_files.update(self.safe_index.band_paths(product_name, ['SCL'], resolution='R20m'))
+        metadata = safe_path / 'MTD_MSIL2A.xml'
+        inputs = [metadata] if metadata.exists() else [safe_path]
+        return inputs, [read_files[band] for band in sorted(read_files)]
+
+    def record_product(self, cache: StageCache, source: Path, fingerprint: str,
+                       bands_to_process: List[str], aoi_path: Path, outputs: List[Path]) -> None:
+        """Record a preprocessed product against the source the next run will see"""
+        product_name = source.name.split('.')[0]
+        next_source = source if source.exists() else source.parent / f"{product_name}.SAFE"
+        if next_source != source:
+            fingerprint = self.fingerprint(cache, next_source, bands_to_process, aoi_path)
+        cache.record('preprocessing', product_name, fingerprint, outputs)
+
+    def raw_dir(self) -> Path:
+        """Folder of the downloaded zips and SAFE directories"""
+        return self.root_dir / "data" / "raw" / "Sentinel-2"
+
+    def output_dir(self) -> Path:
+        """Folder of the clipped band stacks"""
+        return self.root_dir / "data" / "preprocessed" / "Sentinel-2" / "L2A"
+
+    def aoi_path(self) -> Path:
+        """AOI GeoJSON file or directory named by preprocessing.aoi"""
+        return self.root_dir / self.settings.get('aoi', 'data/external/municipio_1_Rome.geojson')
+
     def run(self) -> bool:
         """Run the preprocessing pipeline"""
         try:
             logging.info("Starting preprocessing pipeline...")
             
             # Setup paths
-            raw_dir = self.root_dir / "data" / "raw" / "Sentinel-2"
-            output_dir = self.root_dir / "data" / "preprocessed" / "Sentinel-2" / "L2A"
-            geojson_path = self.root_dir / "data" / "external" / "municipio_1_Rome.geojson"
+            raw_dir = self.raw_dir()
+            output_dir = self.output_dir()
+            aoi_path = self.aoi_path()
             
             # Create necessary directories
             raw_dir.mkdir(parents=True, exist_ok=True)
             output_dir.mkdir(parents=True, exist_ok=True)
             
-            # Step 1: Get all SAFE directories (unzipping if needed)
-            safe_paths = self.get_safe_paths(raw_dir)
-            if not safe_paths:
-                logging.error("No SAFE directories found to process")
+            # AOIs are loaded and indexed once per run
+            aois = AOISet.from_path(aoi_path, self.settings.get('aoi_name_field', 'name'))
+            if not len(aois):
+                logging.error(f"No AOIs found in {aoi_path}")
                 return False
             
-            # Step 2: Process each SAFE directory
-            bands_to_process = ['B02', 'B03', 'B04', 'B08']
-            
-            for safe_path in safe_paths:
-                logging.info(f"\nProcessing: {safe_path.name}")
-                if not self.process_safe_directory(safe_path, output_dir, bands_to_process):
-                    logging.error(f"Failed to process {safe_path.name}")
-                    continue
-
-            # Step 4: Validate overlap and clip
-            logging.info("\nStep 4: Validating overlap with AOI and clipping...")
-            
-            for geotiff_path in output_dir.glob("*_bands.tif"):
-                logging.info(f"Processing: {geotiff_path.name}")
-                
-                # Check overlap
-                if self.validate_overlap(geotiff_path, geojson_path):
-                    # Clip to AOI if overlapping
-                    if not self.clip_to_aoi(geotiff_path, geojson_path):
-                        logging.error(f"Failed to clip {geotiff_path.name}")
-                        continue
+            # Step 1: Get all products (zip files or SAFE directories)
+            sources = self.get_product_sources(raw_dir)
+            if not sources:
+                logging.error("No SAFE directories found to process")
+                return False
+            logging.info(f"Total products to process: {len(sources)}")
+            
+            # Step 2: Skip products whose inputs are unchanged since the last run
+            bands_to_process = self.settings.get('bands', ['B02', 'B03', 'B04', 'B08'])
+            cache = StageCache.from_config(self.root_dir, self.config)
+            fingerprints = {}
+            pending = []
+            for source in sources:
+                product_name = source.name.split('.')[0]
+                fingerprints[source] = self.fingerprint(cache, source, bands_to_process, aoi_path)
+                if cache.is_fresh('preprocessing', product_name, fingerprints[source]):
+                    logging.info(f"Skipping {product_name} - outputs up to date")
                 else:
-                    logging.warning(f"Skipping {geotiff_path.name} - No overlap with AOI")
-                    # Optionally remove non-overlapping files
-                    geotiff_path.unlink()
-                    logging.info(f"Removed non-overlapping raster: {geotiff_path}")
+                    pending.append(source)
+            skipped = len(sources) - len(pending)
+            sources = pending
+            
+            # Step 3: Process each product end-to-end as an independent task
+            workers = min(self.settings.get('workers', 1), max(len(sources), 1))
+            
+            results = {}
+            if workers > 1:
+                logging.info(f"Processing products with {workers} workers")
+                with ProcessPoolExecutor(
+                    max_workers=workers,
+                    initializer=init_worker,
+                    initargs=(self.settings.get('gdal_cache_mb', 256), aoi_path,
+                              self.settings.get('aoi_name_field', 'name'))
+                ) as executor:
+                    futures = {
+                        executor.submit(preprocess_product, self.root_dir, self.config,
+                                        source, output_dir, bands_to_process): source
+                        for source in sources
+                    }
+                    for future in as_completed(futures):
+                        source = futures[future]
+                        try:
+                            results[source.name], records = future.result()
+                            run_metrics.merge(records)
+                        except Exception as e:
+                            logging.error(f"Worker failed on {source.name}: {str(e)}", exc_info=True)
+                            results[source.name] = []
+            else:
+                for source in sources:
+                    results[source.name] = self.process_product(
+                        source, output_dir, bands_to_process, aois
+                    )
+
+            for source in sources:
+                if results.get(source.name):
+                    self.record_product(cache, source, fingerprints[source], bands_to_process,
+                                        aoi_path, results[source.name])
+
+            failed = sorted(name for name, ok in results.items() if not ok)
+            logging.info(f"\nPreprocessed {len(results) - len(failed)} out of {len(results)} products"
+                         f" ({skipped} up to date)")
+            for name in failed:
+                logging.warning(f"Not preprocessed: {name}")
 
             logging.info("\nPreprocessing pipeline completed")
             return True
@@ -376,6 +666,27 @@ class PreprocessingPipeline:
             logging.error(f"Pipeline error: {str(e)}", exc_info=True)
             return False
 
+# AOI index of a worker process, built once by init_worker
+_worker_aois: Optional[AOISet] = None
+
+def init_worker(gdal_cache_mb: int, aoi_path: Path, aoi_name_field: str = 'name') -> None:
+    """Configure logging, the GDAL block cache and the AOI index of a preprocessing worker"""
+    global _worker_aois
+    setup_logging()
+    os.environ["GDAL_CACHEMAX"] = str(gdal_cache_mb)
+    gdal.SetCacheMax(gdal_cache_mb * 1024 * 1024)
+    _worker_aois = AOISet.from_path(aoi_path, aoi_name_field)
+
+def preprocess_product(root_dir: Path,
+                       config: Dict[str, Any],
+                       source: Path,
+                       output_dir: Path,
+                       bands_to_process: List[str]) -> Tuple[List[Path], List[Dict[str, Any]]]:
+    """Process a single product in a worker process, returning its outputs and run metrics"""
+    pipeline = PreprocessingPipeline(root_dir, config)
+    outputs = pipeline.process_product(source, output_dir, bands_to_process, _worker_aois)
+    return outputs, run_metrics.drain()
+
 if __name__ == "__main__":
     # Setup logging first
     setup_logging()
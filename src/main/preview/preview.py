@@ -0,0 +1,105 @@
+"""
+Preview module: PNG quicklooks of processed and classified products
+"""
+import sys
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+# Add project root to Python path
+current_file = Path(__file__).resolve()
+project_root = None
+for parent in current_file.parents:
+    if parent.name == "processing-root-folder":
+        project_root = parent
+        break
+if project_root is None:
+    raise RuntimeError("Project root 'processing-root-folder' not found")
+sys.path.append(str(project_root))
+
+from src.auxiliary.config_utils import load_config
+from src.auxiliary.preview_utils import save_product_preview, save_class_preview
+
+def setup_logging():
+    """Configure logging"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+def is_stale(preview_path: Path, sources: List[Path]) -> bool:
+    """True if the preview is missing or older than any of its source rasters"""
+    if not preview_path.exists():
+        return True
+    mtime = preview_path.stat().st_mtime
+    return any(source.stat().st_mtime > mtime for source in sources)
+
+class PreviewPipeline:
+    """
+    Render quicklooks as a separate stage
+
+    Used when preview.inline is false, or to refresh previews without
+    rerunning processing and analysis. Previews are rendered in a thread
+    pool since reading overviews and writing PNG release the GIL.
+    """
+    def __init__(self, root_dir: Path, config: Optional[Dict[str, Any]] = None):
+        self.root_dir = root_dir
+        self.config = config if config is not None else load_config(root_dir)
+        self.settings = self.config.get('preview', {})
+
+    def find_tasks(self) -> List[Tuple]:
+        """Collect (render function, args) for every missing or stale preview"""
+        processed_dir = self.root_dir / self.config.get('processing', {}).get('output_folder', 'data/processed')
+        analysis_dir = self.root_dir / "data" / "analysis"
+        index = self.settings.get('index', 'ndvi')
+        max_size = self.settings.get('max_size', 1024)
+        index_range = tuple(self.settings.get('index_range', [-1.0, 1.0]))
+
+        tasks = []
+        for rgb_path in sorted(processed_dir.rglob("*_rgb.tif")):
+            stem = rgb_path.name[:-len("_rgb.tif")]
+            index_path = rgb_path.with_name(f"{stem}_{index}.tif")
+            preview_path = rgb_path.with_name(f"{stem}_preview.png")
+            if index_path.exists() and is_stale(preview_path, [rgb_path, index_path]):
+                tasks.append((save_product_preview,
+                              (rgb_path, index_path, preview_path, max_size, index_range)))
+
+        for class_path in sorted(analysis_dir.rglob("*_classified.tif")):
+            preview_path = class_path.with_suffix(".png")
+            if is_stale(preview_path, [class_path]):
+                tasks.append((save_class_preview, (class_path, preview_path, max_size)))
+        return tasks
+
+    def run(self) -> bool:
+        """Render every missing or stale preview"""
+        try:
+            tasks = self.find_tasks()
+            logging.info(f"Rendering {len(tasks)} previews")
+
+            failed = 0
+            with ThreadPoolExecutor(max_workers=self.settings.get('workers', 2)) as executor:
+                futures = {executor.submit(render, *args): args[0] for render, args in tasks}
+                for future in as_completed(futures):
+                    try:
+                        logging.info(f"Saved preview: {future.result()}")
+                    except Exception as e:
+                        logging.error(f"Failed to render preview of {futures[future]}: {str(e)}")
+                        failed += 1
+
+            logging.info(f"Rendered {len(tasks) - failed} previews, {failed} failed")
+            return failed == 0
+
+        except Exception as e:
+            logging.error(f"Preview pipeline error: {str(e)}", exc_info=True)
+            return False
+
+def main():
+    """Render the quicklooks of all products"""
+    setup_logging()
+
+    if not PreviewPipeline(project_root).run():
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
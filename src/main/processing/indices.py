@@ -0,0 +1,131 @@
+"""
+Spectral index registry for Sentinel-2 L2A data
+
+Each index declares the bands it needs and a vectorised formula working
+on reflectance arrays, so the processing stage can compute every
+requested index from a single read of each block. Formulas work in
+preallocated output and scratch buffers, without temporary arrays.
+"""
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+import numpy as np
+
+# L2A digital numbers to BOA reflectance
+REFLECTANCE_SCALE = 1.0 / 10000.0
+
+class SpectralIndex(NamedTuple):
+    name: str
+    bands: tuple
+    formula: Callable[[Dict[str, np.ndarray], np.ndarray, np.ndarray, np.ndarray], np.ndarray]
+    description: str = ""
+
+INDEX_REGISTRY: Dict[str, SpectralIndex] = {}
+
+def register_index(name: str, bands: Iterable[str], description: str = ""):
+    """
+    Decorator registering an index formula
+
+    The formula receives {band_name: reflectance array}, a preallocated
+    float32 output array of the same shape, a float32 scratch array and a
+    bool scratch array, fills the output in place and returns it.
+    """
+    def decorator(formula):
+        INDEX_REGISTRY[name] = SpectralIndex(name, tuple(bands), formula, description)
+        return formula
+    return decorator
+
+def get_indices(names: Iterable[str]) -> List[SpectralIndex]:
+    """Look up indices by name, raising ValueError for unknown ones"""
+    unknown = [name for name in names if name.lower() not in INDEX_REGISTRY]
+    if unknown:
+        raise ValueError(f"Unknown spectral index: {', '.join(unknown)}. "
+                         f"Available: {', '.join(sorted(INDEX_REGISTRY))}")
+    return [INDEX_REGISTRY[name.lower()] for name in names]
+
+def required_bands(names: Iterable[str]) -> List[str]:
+    """Union of the bands needed by the given indices, in a stable order"""
+    bands = []
+    for index in get_indices(names):
+        bands.extend(band for band in index.bands if band not in bands)
+    return bands
+
+def divide_valid(out: np.ndarray, denominator: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """out / denominator in place where valid, 0 elsewhere; valid is overwritten"""
+    np.divide(out, denominator, out=out, where=valid)
+    np.logical_not(valid, out=valid)
+    np.copyto(out, 0, where=valid)
+    return out
+
+def normalized_difference(a: np.ndarray, b: np.ndarray, out: np.ndarray,
+                          scratch: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """(a - b) / (a + b) into out, 0 where a + b is not positive"""
+    np.add(a, b, out=scratch)
+    np.greater(scratch, 0, out=valid)
+    np.subtract(a, b, out=out)
+    divide_valid(out, scratch, valid)
+    return np.clip(out, -1, 1, out=out)
+
+@register_index('ndvi', ('B08', 'B04'), "Normalized Difference Vegetation Index")
+def ndvi(b: Dict[str, np.ndarray], out: np.ndarray, scratch: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    return normalized_difference(b['B08'], b['B04'], out, scratch, valid)
+
+@register_index('ndwi', ('B03', 'B08'), "Normalized Difference Water Index (McFeeters)")
+def ndwi(b: Dict[str, np.ndarray], out: np.ndarray, scratch: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    return normalized_difference(b['B03'], b['B08'], out, scratch, valid)
+
+@register_index('savi', ('B08', 'B04'), "Soil Adjusted Vegetation Index (L = 0.5)")
+def savi(b: Dict[str, np.ndarray], out: np.ndarray, scratch: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    nir, red = b['B08'], b['B04']
+    np.add(nir, red, out=scratch)
+    np.greater(scratch, 0, out=valid)
+    scratch += 0.5
+    np.subtract(nir, red, out=out)
+    out *= 1.5
+    divide_valid(out, scratch, valid)
+    return np.clip(out, -1.5, 1.5, out=out)
+
+@register_index('evi', ('B08', 'B04', 'B02'), "Enhanced Vegetation Index")
+def evi(b: Dict[str, np.ndarray], out: np.ndarray, scratch: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    nir, red, blue = b['B08'], b['B04'], b['B02']
+    # Denominator nir + 6 red - 7.5 blue + 1, built in scratch with out as a temporary
+    np.add(nir, 1.0, out=scratch)
+    np.multiply(red, 6.0, out=out)
+    scratch += out
+    np.multiply(blue, 7.5, out=out)
+    scratch -= out
+    np.not_equal(scratch, 0, out=valid)
+    np.subtract(nir, red, out=out)
+    out *= 2.5
+    divide_valid(out, scratch, valid)
+    return np.clip(out, -1, 1, out=out)
+
+def compute_indices(bands: Dict[str, np.ndarray],
+                    names: Iterable[str],
+                    outputs: Optional[Dict[str, np.ndarray]] = None,
+                    scratch: Optional[np.ndarray] = None,
+                    valid: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+    """
+    Compute several indices from one set of reflectance arrays
+
+    Args:
+        bands: {band_name: reflectance array}, shared by all indices
+        names: Index names to compute
+        outputs: Optional preallocated float32 output arrays per index
+        scratch: Optional float32 scratch array of the band shape, shared by all indices
+        valid: Optional bool scratch array of the band shape, shared by all indices
+
+    Returns:
+        dict: {index_name: index array}
+    """
+    shape = next(iter(bands.values())).shape
+    if scratch is None:
+        scratch = np.empty(shape, dtype='float32')
+    if valid is None:
+        valid = np.empty(shape, dtype=bool)
+
+    results = {}
+    for index in get_indices(names):
+        out = outputs.get(index.name) if outputs else None
+        if out is None:
+            out = np.empty(shape, dtype='float32')
+        results[index.name] = index.formula(bands, out, scratch, valid)
+    return results
@@ -1,12 +1,38 @@
 """
-Processing module for Sentinel-2 data: RGB and NDVI generation
+Processing module for Sentinel-2 data: RGB and spectral index generation
 """
 import os
+import sys
 import logging
 from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
 import numpy as np
 import rasterio
-import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+
+# Add project root to Python path
+current_file = Path(__file__).resolve()
+project_root = None
+for parent in current_file.parents:
+    if parent.name == "processing-root-folder":
+        project_root = parent
+        break
+if project_root is None:
+    raise RuntimeError("Project root 'processing-root-folder' not found")
+sys.path.append(str(project_root))
+
+from src.auxiliary.config_utils import load_config
+from src.auxiliary.cache_utils import StageCache, module_digest
+from src.auxiliary.metrics_utils import run_metrics, file_size
+from src.main.processing.indices import REFLECTANCE_SCALE, compute_indices, required_bands
+from src.auxiliary.raster_utils import cog_profile, finalize_cog, window_is_sparse
+from src.auxiliary.preview_utils import save_product_preview
+from src.auxiliary import raster_utils, preview_utils
+from src.main.processing import indices as indices_module
+
+# Band order of stacks written without band descriptions
+DEFAULT_BAND_ORDER = ['B02', 'B03', 'B04', 'B08']
+RGB_BANDS = ['B04', 'B03', 'B02']
 
 def setup_logging():
     """Configure logging"""
@@ -15,99 +41,276 @@ def setup_logging():
         format='%(asctime)s - %(levelname)s - %(message)s'
     )
 
-def process_sentinel_data(input_path: Path, output_path: Path):
-    """Process Sentinel-2 data to generate RGB and NDVI images"""
+def scale_to_uint8(arr: np.ndarray, out: np.ndarray, lower: float = 0, upper: float = 3000) -> np.ndarray:
+    """Scale reflectance DN to 8-bit in place: clips arr and writes the result to out"""
+    np.clip(arr, lower, upper, out=arr)
+    arr -= lower
+    arr *= 255.0 / (upper - lower)
+    np.copyto(out, arr, casting='unsafe')
+    return out
+
+def band_indexes(src: rasterio.DatasetReader) -> Dict[str, int]:
+    """Map band names to 1-based band indexes using the band descriptions"""
+    if all(src.descriptions):
+        return {name: idx for idx, name in enumerate(src.descriptions, start=1)}
+    return {name: idx for idx, name in enumerate(DEFAULT_BAND_ORDER[:src.count], start=1)}
+
+def needed_bands(indices: List[str]) -> List[str]:
+    """Bands read per block: RGB first, then the extra bands of the indices"""
+    return RGB_BANDS + [band for band in required_bands(indices) if band not in RGB_BANDS]
+
+def allocate_buffers(indices: List[str], block_size: int = 512) -> Dict[str, Any]:
+    """Reusable block buffers: bands in, RGB and one array per index out"""
+    return {
+        'bands': np.empty((len(needed_bands(indices)), block_size, block_size), dtype='float32'),
+        'rgb': np.empty((3, block_size, block_size), dtype='uint8'),
+        'indices': {name: np.empty((block_size, block_size), dtype='float32') for name in indices},
+        'scratch': np.empty((block_size, block_size), dtype='float32'),
+        'valid': np.empty((block_size, block_size), dtype=bool),
+        'nodata': np.empty((block_size, block_size), dtype=bool)
+    }
+
+def output_paths(tiff_file: Path, output_path: Path, indices: List[str]) -> Tuple[Path, Dict[str, Path]]:
+    """RGB and index outputs of a product"""
+    rgb_path = output_path / f"{tiff_file.stem}_rgb.tif"
+    return rgb_path, {name: output_path / f"{tiff_file.stem}_{name}.tif" for name in indices}
+
+# Sources of the outputs: code changes in any of them invalidate the cache
+CODE_FILES = [__file__, indices_module.__file__, raster_utils.__file__, preview_utils.__file__]
+
+def fingerprint(cache: StageCache, tiff_file: Path, indices: List[str]) -> str:
+    """Fingerprint a preprocessed product together with the requested indices"""
+    return cache.fingerprint([tiff_file], {'indices': indices}, module_digest(*CODE_FILES))
+
+def process_product(tiff_file: Path,
+                    output_path: Path,
+                    indices: List[str],
+                    block_size: int = 512,
+                    cog: Optional[Dict[str, Any]] = None,
+                    buffers: Optional[Dict[str, Any]] = None) -> Optional[Tuple[Path, Dict[str, Path]]]:
+    """
+    Write the RGB and index GeoTIFFs of one preprocessed product
+    
+    When the product has nodata (pixels masked by the SCL or outside the
+    AOI polygon), its nodata pixels are NaN in the indices and blocks with
+    no valid pixel are skipped, left empty in the outputs.
+    
+    Args:
+        tiff_file: Preprocessed band stack
+        output_path: Output directory
+        indices: Lower-case index names
+        block_size: Block edge in pixels
+        cog: 'raster_output' settings of the Cloud-Optimized GeoTIFF outputs
+        buffers: Block buffers from allocate_buffers, allocated here if None
+    
+    Returns:
+        Optional[Tuple[Path, Dict[str, Path]]]: RGB path and index paths,
+            None if the product lacks a needed band
+    """
+    needed = needed_bands(indices)
+    if buffers is None:
+        buffers = allocate_buffers(indices, block_size)
+    
+    with run_metrics.measure('indices', tiff_file.stem):
+        logging.info(f"Processing {tiff_file.name}")
+    
+        with rasterio.open(tiff_file) as src:
+            available = band_indexes(src)
+            missing = [band for band in needed if band not in available]
+            if missing:
+                logging.error(f"Skipping {tiff_file.name} - missing bands {missing}")
+                return None
+            read_indexes = [available[band] for band in needed]
+        
+            # Get metadata for output files
+            profile = src.profile
+            nodata = src.nodata
+        
+            rgb_profile = cog_profile({**profile, "count": 3, "dtype": "uint8"}, cog, block_size)
+            index_profile = cog_profile({**profile, "count": 1, "dtype": "float32",
+                                         "nodata": np.nan if nodata is not None else None}, cog, block_size)
+        
+            rgb_path, index_paths = output_paths(tiff_file, output_path, indices)
+        
+            rgb_dst = rasterio.open(rgb_path, "w", **rgb_profile)
+            index_dsts = {name: rasterio.open(path, "w", **index_profile)
+                          for name, path in index_paths.items()}
+            skipped = 0
+            try:
+                for _, window in rgb_dst.block_windows(1):
+                    h, w = int(window.height), int(window.width)
+                    bands = buffers['bands'][:, :h, :w]
+                    rgb = buffers['rgb'][:, :h, :w]
+                    scratch = buffers['scratch'][:h, :w]
+                    valid = buffers['valid'][:h, :w]
+                    invalid = buffers['nodata'][:h, :w]
+                
+                    # Masked blocks are left empty and read back as nodata
+                    if nodata is not None and window_is_sparse(src, window):
+                        skipped += 1
+                        continue
+                
+                    # One read of every needed band for this block
+                    src.read(read_indexes, window=window, out=bands)
+                    if nodata is not None:
+                        np.equal(bands[0], nodata, out=invalid)
+                        if invalid.all():
+                            skipped += 1
+                            continue
+                
+                    # 8-bit RGB from DN, through the scratch buffer
+                    for i in range(3):
+                        np.copyto(scratch, bands[i])
+                        scale_to_uint8(scratch, rgb[i])
+                    rgb_dst.write(rgb, window=window)
+                
+                    # Reflectance once, shared by all indices
+                    bands *= REFLECTANCE_SCALE
+                    reflectance = dict(zip(needed, bands))
+                    outputs = {name: buf[:h, :w] for name, buf in buffers['indices'].items()}
+                    for name, values in compute_indices(reflectance, indices, outputs, scratch, valid).items():
+                        if nodata is not None:
+                            np.copyto(values, np.nan, where=invalid)
+                        index_dsts[name].write(values, 1, window=window)
+            finally:
+                rgb_dst.close()
+                for dst in index_dsts.values():
+                    dst.close()
+    
+        # Overviews built once per output, after all blocks are written
+        for path in [rgb_path, *index_paths.values()]:
+            finalize_cog(path, cog)
+        run_metrics.add('indices', tiff_file.stem,
+                        bytes_read=file_size(tiff_file),
+                        bytes_written=sum(file_size(path) for path in [rgb_path, *index_paths.values()]),
+                        pixels=profile['width'] * profile['height'] * len(needed))
+    
+        if skipped:
+            logging.info(f"Skipped {skipped} blocks without valid pixels")
+        logging.info(f"Saved RGB image: {rgb_path}")
+        for name, path in index_paths.items():
+            logging.info(f"Saved {name.upper()} image: {path}")
+        return rgb_path, index_paths
+
+
+def process_sentinel_data(input_path: Path,
+                          output_path: Path,
+                          block_size: int = 512,
+                          indices: Optional[List[str]] = None,
+                          cache: Optional[StageCache] = None,
+                          cog: Optional[Dict[str, Any]] = None,
+                          preview: Optional[Dict[str, Any]] = None):
+    """
+    Process Sentinel-2 data to generate RGB and spectral index images
+    
+    Rasters are processed block by block: each window of the needed bands
+    is read once into preallocated buffers, scaled to 8-bit RGB, converted
+    to reflectance in place and shared by every requested index, and all
+    outputs are written immediately. Peak memory depends on block_size,
+    not raster size. Outputs are tiled Cloud-Optimized GeoTIFFs with
+    block_size tiles and internal overviews, as configured by cog. With a
+    cache, products whose input and indices are unchanged since the last
+    run are skipped. With preview settings, the RGB/index quicklook of each
+    product is rendered from the overviews in a background thread while
+    the next product is being written.
+    """
     try:
+        indices = [name.lower() for name in (indices or ['ndvi'])]
+        
         # Create output directory
         output_path.mkdir(parents=True, exist_ok=True)
         
         # Find all GeoTIFF files
         tiff_files = list(input_path.glob("*.tif"))
         logging.info(f"Found {len(tiff_files)} GeoTIFF files")
+        logging.info(f"Computing indices: {', '.join(indices)}")
+        
+        # Block buffers shared by all products
+        buffers = allocate_buffers(indices, block_size)
+        
+        preview_index = preview.get('index', 'ndvi') if preview is not None else None
+        previews = ThreadPoolExecutor(max_workers=preview.get('workers', 2)) if preview is not None else None
+        preview_jobs = {}
         
         for tiff_file in tiff_files:
-            logging.info(f"Processing {tiff_file.name}")
+            if cache is not None:
+                product_fingerprint = fingerprint(cache, tiff_file, indices)
+                if cache.is_fresh('processing', tiff_file.stem, product_fingerprint):
+                    logging.info(f"Skipping {tiff_file.name} - outputs up to date")
+                    continue
             
-            with rasterio.open(tiff_file) as src:
-                # Read bands (assuming order: B02, B03, B04, B08)
-                blue = src.read(1).astype('float32')
-                green = src.read(2).astype('float32')
-                red = src.read(3).astype('float32')
-                nir = src.read(4).astype('float32')
-                
-                # Get metadata for output files
-                profile = src.profile
-                
-                # Scale to 8-bit RGB
-                def scale_to_uint8(arr, lower=0, upper=3000):
-                    arr = np.clip(arr, lower, upper)
-                    return ((arr - lower) / (upper - lower) * 255).astype('uint8')
-                
-                rgb = np.stack([
-                    scale_to_uint8(red),
-                    scale_to_uint8(green),
-                    scale_to_uint8(blue)
-                ])
-                
-                # Calculate NDVI
-                ndvi = np.where(
-                    (nir + red) > 0,
-                    (nir - red) / (nir + red),
-                    0
-                )
-                ndvi = np.clip(ndvi, -1, 1)
-                
-                # Save RGB GeoTIFF
-                rgb_profile = profile.copy()
-                rgb_profile.update({
-                    "driver": "GTiff",
-                    "count": 3,
-                    "dtype": "uint8",
-                    "compress": "lzw"
-                })
-                
-                rgb_path = output_path / f"{tiff_file.stem}_rgb.tif"
-                with rasterio.open(rgb_path, "w", **rgb_profile) as dst:
-                    dst.write(rgb)
-                logging.info(f"Saved RGB image: {rgb_path}")
-                
-                # Save NDVI GeoTIFF
-                ndvi_profile = profile.copy()
-                ndvi_profile.update({
-                    "driver": "GTiff",
-                    "count": 1,
-                    "dtype": "float32",
-                    "compress": "lzw"
-                })
-                
-                ndvi_path = output_path / f"{tiff_file.stem}_ndvi.tif"
-                with rasterio.open(ndvi_path, "w", **ndvi_profile) as dst:
-                    dst.write(ndvi, 1)
-                logging.info(f"Saved NDVI image: {ndvi_path}")
-                
-                # Create preview image
-                fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(12, 6))
-                
-                # RGB preview
-                ax1.set_title("RGB True Color")
-                ax1.imshow(np.transpose(rgb, (1, 2, 0)))
-                ax1.axis('off')
-                
-                # NDVI preview
-                ax2.set_title("NDVI")
-                ndvi_plot = ax2.imshow(ndvi, cmap='RdYlGn', vmin=-1, vmax=1)
-                plt.colorbar(ndvi_plot, ax=ax2)
-                ax2.axis('off')
-                
+            result = process_product(tiff_file, output_path, indices, block_size, cog, buffers)
+            if result is None:
+                continue
+            rgb_path, index_paths = result
+            
+            # Render the preview image alongside the next product
+            if previews is not None and preview_index in index_paths:
                 preview_path = output_path / f"{tiff_file.stem}_preview.png"
-                plt.savefig(preview_path, dpi=300, bbox_inches='tight')
-                plt.close()
-                logging.info(f"Saved preview: {preview_path}")
+                preview_jobs[preview_path] = previews.submit(
+                    save_product_preview, rgb_path, index_paths[preview_index], preview_path,
+                    preview.get('max_size', 1024), tuple(preview.get('index_range', [-1.0, 1.0]))
+                )
+            
+            if cache is not None:
+                cache.record('processing', tiff_file.stem, product_fingerprint,
+                             [rgb_path, *index_paths.values()])
+        
+        if previews is not None:
+            for preview_path, job in preview_jobs.items():
+                try:
+                    job.result()
+                    logging.info(f"Saved preview: {preview_path}")
+                except Exception as e:
+                    logging.error(f"Failed to render preview {preview_path}: {str(e)}")
+            previews.shutdown()
                 
     except Exception as e:
         logging.error(f"Error processing data: {str(e)}")
         raise
 
+def inline_preview_settings(config: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Preview settings when quicklooks are rendered inside the writing stages, else None"""
+    settings = config.get('preview', {})
+    if settings.get('enabled', True) and settings.get('inline', True):
+        return settings
+    return None
+
+class ProcessingPipeline:
+    def __init__(self, root_dir: Path, config: Optional[Dict[str, Any]] = None):
+        self.root_dir = root_dir
+        self.config = config if config is not None else load_config(root_dir)
+        self.settings = self.config.get('processing', {})
+
+    def output_dir(self) -> Path:
+        """Folder of the RGB and index products"""
+        return (self.root_dir / self.settings.get('output_folder', 'data/processed')
+                / "Sentinel-2" / "L2A")
+
+    def indices(self) -> List[str]:
+        """Lower-case index names; processing.algorithm may name one index or list several"""
+        algorithm = self.settings.get('algorithm', 'ndvi')
+        return [name.lower() for name in (algorithm if isinstance(algorithm, list) else [algorithm])]
+
+    def run(self) -> bool:
+        """Run the processing stage on all preprocessed products"""
+        try:
+            input_path = self.root_dir / "data" / "preprocessed" / "Sentinel-2" / "L2A"
+            output_path = self.output_dir()
+            indices = self.indices()
+            
+            process_sentinel_data(input_path, output_path,
+                                  block_size=self.settings.get('block_size', 512),
+                                  indices=indices,
+                                  cache=StageCache.from_config(self.root_dir, self.config),
+                                  cog=self.config.get('raster_output', {}),
+                                  preview=inline_preview_settings(self.config))
+            return True
+            
+        except Exception as e:
+            logging.error(f"Processing pipeline error: {str(e)}", exc_info=True)
+            return False
+
 def main():
     # Setup paths
     input_path = Path(r"C:\Users\fgalassi\Progetti\EO Pipeline\processing-root-folder\data\preprocessed\Sentinel-2\L2A")
@@ -118,7 +321,7 @@ def main():
     
     # Process data
     logging.info("Starting processing...")
-    process_sentinel_data(input_path, output_path)
+    process_sentinel_data(input_path, output_path, preview={})
     logging.info("Processing completed")
 
 if __name__ == "__main__":
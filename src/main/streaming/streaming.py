@@ -0,0 +1,377 @@
+"""
+Streaming pipeline: products flow through every stage without barriers
+
+Stages (download -> extract -> stack/clip -> indices -> classify -> preview)
+are pools of worker threads connected by bounded queues. A product moves on
+as soon as a stage is done with it, so downloads, JP2 decoding, index
+computation and writing of different products overlap, and the first
+product is finished before the last one is downloaded. GDAL, numpy and the
+network transfers release the GIL, so threads overlap compute as well as
+I/O; the bounded queues keep a fast stage from running ahead of a slow one.
+"""
+import sys
+import json
+import time
+import queue
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+# Add project root to Python path
+current_file = Path(__file__).resolve()
+project_root = None
+for parent in current_file.parents:
+    if parent.name == "processing-root-folder":
+        project_root = parent
+        break
+if project_root is None:
+    raise RuntimeError("Project root 'processing-root-folder' not found")
+sys.path.append(str(project_root))
+
+from src.auxiliary.config_utils import load_config
+from src.auxiliary.cache_utils import StageCache
+from src.auxiliary.aoi_utils import AOISet
+from src.auxiliary.preview_utils import save_product_preview, save_class_preview
+from src.main.preprocessing.preprocessing import PreprocessingPipeline
+from src.main.processing import processing
+from src.main.processing.processing import ProcessingPipeline, allocate_buffers, output_paths, process_product
+from src.main.analysis.analysis import AnalysisPipeline, analyse_product, log_thresholds, write_statistics
+from src.main.preview.preview import is_stale
+
+# Worker threads per stage unless pipeline.workers overrides them
+DEFAULT_WORKERS = {
+    'download': 4,
+    'extract': 2,
+    'clip': 2,
+    'indices': 2,
+    'classify': 1,
+    'preview': 2
+}
+
+# End of a stage's input, one per worker thread
+_DONE = object()
+
+class Product(NamedTuple):
+    source: Path
+    fingerprint: str
+    safe_path: Optional[Path]  # None when the clipped outputs are up to date
+
+class Processed(NamedTuple):
+    tiff_file: Path
+    rgb_path: Path
+    index_paths: Dict[str, Path]
+    class_path: Optional[Path] = None
+
+def describe(item: Any) -> str:
+    """Short name of a queue item for log messages"""
+    if isinstance(item, Path):
+        return item.name
+    if isinstance(item, Product):
+        return item.source.name
+    if isinstance(item, Processed):
+        return item.tiff_file.name
+    if isinstance(item, dict):
+        return item.get('id', 'unknown_id')
+    return str(item)
+
+class Stage:
+    """
+    A pool of worker threads reading one bounded queue and feeding the next
+
+    make_handler is called once in each worker thread, so handlers can hold
+    per-thread state (SQLite connections, block buffers). A handler maps one
+    item to a list of output items: empty drops the item (e.g. a product
+    outside every AOI), several fan out (one clip per AOI), and None marks
+    a failure the handler has already logged.
+    """
+    def __init__(self, name: str, make_handler: Callable[[], Callable], workers: int = 1):
+        self.name = name
+        self.make_handler = make_handler
+        self.workers = max(1, int(workers))
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.first_output = None
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self, inbox: queue.Queue, outbox: Optional[queue.Queue]) -> None:
+        self.inbox = inbox
+        self.outbox = outbox
+        self._started = time.perf_counter()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self) -> None:
+        try:
+            handler = self.make_handler()
+        except Exception as e:
+            logging.error(f"Could not start {self.name} worker: {str(e)}", exc_info=True)
+            handler = None
+
+        while True:
+            item = self.inbox.get()
+            if item is _DONE:
+                return
+            if handler is None:
+                with self._lock:
+                    self.failed += 1
+                continue
+
+            start = time.perf_counter()
+            try:
+                results = handler(item)
+            except Exception as e:
+                logging.error(f"{self.name} failed on {describe(item)}: {str(e)}", exc_info=True)
+                results = None
+
+            with self._lock:
+                self.busy += time.perf_counter() - start
+                if results is None:
+                    self.failed += 1
+                    continue
+                self.processed += 1
+                if results and self.first_output is None:
+                    self.first_output = time.perf_counter() - self._started
+
+            if self.outbox is not None:
+                for result in results:
+                    self.outbox.put(result)
+
+    def finish(self) -> None:
+        """Signal the end of the input and wait for the workers to drain it"""
+        for _ in self._threads:
+            self.inbox.put(_DONE)
+        for thread in self._threads:
+            thread.join()
+
+class StreamingPipeline:
+    def __init__(self, root_dir: Path, config: Optional[Dict[str, Any]] = None):
+        self.root_dir = root_dir
+        self.config = config if config is not None else load_config(root_dir)
+        self.settings = self.config.get('pipeline', {})
+        self.preprocessing = PreprocessingPipeline(root_dir, self.config)
+        self.processing = ProcessingPipeline(root_dir, self.config)
+        self.analysis = AnalysisPipeline(root_dir, self.config)
+        self.cache = StageCache.from_config(root_dir, self.config)
+        self.rows = {}
+        self._rows_lock = threading.Lock()
+
+    def workers(self, stage: str) -> int:
+        return self.settings.get('workers', {}).get(stage, DEFAULT_WORKERS[stage])
+
+    def sources(self, downloader=None) -> Iterable[Any]:
+        """Products already on disk, then the search results still to download"""
+        raw_dir = self.preprocessing.raw_dir()
+        raw_dir.mkdir(parents=True, exist_ok=True)
+        yield from self.preprocessing.get_product_sources(raw_dir)
+
+        if downloader is not None:
+            present = downloader.existing_products(str(raw_dir))
+            for feat in downloader.iter_search_features():
+                pid = feat.get('id', 'unknown_id').split('.')[0]
+                if pid not in present:
+                    present.add(pid)
+                    yield feat
+
+    def download_handler(self, downloader) -> Callable:
+        raw_dir = self.preprocessing.raw_dir()
+
+        def download(item):
+            if isinstance(item, Path):
+                return [item]
+            if not downloader._download_feature(item, str(raw_dir)):
+                return None
+            return [raw_dir / f"{item.get('id', 'unknown_id')}.zip"]
+        return download
+
+    def extract_handler(self, bands: List[str], aoi_path: Path) -> Callable:
+        # One pipeline, and so one SAFE index connection, per thread
+        pipeline = PreprocessingPipeline(self.root_dir, self.config)
+
+        def extract(source: Path):
+            product_name = source.name.split('.')[0]
+            fingerprint = pipeline.fingerprint(self.cache, source, bands, aoi_path)
+            if self.cache.is_fresh('preprocessing', product_name, fingerprint):
+                logging.info(f"Skipping {product_name} - outputs up to date")
+                return [Product(source, fingerprint, None)]
+            safe_path = pipeline.extract_product(source)
+            if safe_path is None:
+                return None
+            return [Product(source, fingerprint, safe_path)]
+        return extract
+
+    def clip_handler(self, bands: List[str], aoi_path: Path, aois: AOISet) -> Callable:
+        pipeline = PreprocessingPipeline(self.root_dir, self.config)
+        output_dir = pipeline.output_dir()
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+        def clip(product: Product):
+            if product.safe_path is None:
+                return self.cache.outputs('preprocessing', product.source.name.split('.')[0])
+            outputs = pipeline.clip_product(product.safe_path, output_dir, bands, aois)
+            if outputs:
+                pipeline.record_product(self.cache, product.source, product.fingerprint,
+                                        bands, aoi_path, outputs)
+            return outputs
+        return clip
+
+    def indices_handler(self) -> Callable:
+        output_dir = self.processing.output_dir()
+        output_dir.mkdir(parents=True, exist_ok=True)
+        indices = self.processing.indices()
+        block_size = self.processing.settings.get('block_size', 512)
+        cog = self.config.get('raster_output', {})
+        buffers = allocate_buffers(indices, block_size)
+
+        def compute(tiff_file: Path):
+            fingerprint = processing.fingerprint(self.cache, tiff_file, indices)
+            if self.cache.is_fresh('processing', tiff_file.stem, fingerprint):
+                logging.info(f"Skipping {tiff_file.name} - outputs up to date")
+                return [Processed(tiff_file, *output_paths(tiff_file, output_dir, indices))]
+            result = process_product(tiff_file, output_dir, indices, block_size, cog, buffers)
+            if result is None:
+                return None
+            rgb_path, index_paths = result
+            self.cache.record('processing', tiff_file.stem, fingerprint, [rgb_path, *index_paths.values()])
+            return [Processed(tiff_file, rgb_path, index_paths)]
+        return compute
+
+    def classify_handler(self) -> Callable:
+        processed_dir = self.root_dir / self.config.get('processing', {}).get('output_folder', 'data/processed')
+        analysis_dir = self.root_dir / "data" / "analysis"
+        settings = self.analysis.settings
+        cog = self.config.get('raster_output', {})
+
+        def classify(item: Processed):
+            ndvi_path = item.index_paths.get('ndvi')
+            if ndvi_path is None:
+                return [item]
+            key = str(ndvi_path.relative_to(processed_dir))
+            output_dir = analysis_dir / ndvi_path.parent.relative_to(processed_dir)
+            class_path = output_dir / f"{ndvi_path.stem}_classified.tif"
+            json_path = output_dir / f"{ndvi_path.stem}_classified.json"
+
+            fingerprint = self.analysis.fingerprint(self.cache, ndvi_path)
+            if self.cache.is_fresh('analysis', key, fingerprint):
+                logging.info(f"Skipping {ndvi_path.name} - outputs up to date")
+                with open(json_path) as f:
+                    row = json.load(f)
+            else:
+                # Quicklooks are left to the preview stage
+                row = analyse_product(ndvi_path, output_dir, settings.get('thresholds'),
+                                      settings.get('block_size', 512), False, cog)
+                self.cache.record('analysis', key, fingerprint, [class_path, json_path])
+
+            with self._rows_lock:
+                self.rows[key] = row
+            return [item._replace(class_path=class_path)]
+        return classify
+
+    def preview_handler(self) -> Callable:
+        settings = self.config.get('preview', {})
+        index = settings.get('index', 'ndvi')
+        max_size = settings.get('max_size', 1024)
+        index_range = tuple(settings.get('index_range', [-1.0, 1.0]))
+        plot = self.analysis.settings.get('plot', True)
+
+        def render(item: Processed):
+            index_path = item.index_paths.get(index)
+            if index_path is not None:
+                preview_path = item.rgb_path.with_name(f"{item.tiff_file.stem}_preview.png")
+                if is_stale(preview_path, [item.rgb_path, index_path]):
+                    save_product_preview(item.rgb_path, index_path, preview_path, max_size, index_range)
+                    logging.info(f"Saved preview: {preview_path}")
+            if plot and item.class_path is not None:
+                preview_path = item.class_path.with_suffix('.png')
+                if is_stale(preview_path, [item.class_path]):
+                    save_class_preview(item.class_path, preview_path, max_size)
+                    logging.info(f"Saved preview: {preview_path}")
+            return [item]
+        return render
+
+    def build_stages(self, downloader=None) -> List[Stage]:
+        """Stages in pipeline order, each with its configured worker count"""
+        bands = self.preprocessing.settings.get('bands', ['B02', 'B03', 'B04', 'B08'])
+        aoi_path = self.preprocessing.aoi_path()
+        aois = AOISet.from_path(aoi_path, self.preprocessing.settings.get('aoi_name_field', 'name'))
+        if not len(aois):
+            raise ValueError(f"No AOIs found in {aoi_path}")
+
+        stages = []
+        if downloader is not None:
+            stages.append(Stage('download', lambda: self.download_handler(downloader), self.workers('download')))
+        stages += [
+            Stage('extract', lambda: self.extract_handler(bands, aoi_path), self.workers('extract')),
+            Stage('clip', lambda: self.clip_handler(bands, aoi_path, aois), self.workers('clip')),
+            Stage('indices', self.indices_handler, self.workers('indices')),
+            Stage('classify', self.classify_handler, self.workers('classify'))
+        ]
+        if self.config.get('preview', {}).get('enabled', True):
+            stages.append(Stage('preview', self.preview_handler, self.workers('preview')))
+        return stages
+
+    def run(self) -> bool:
+        """Stream every product through all stages"""
+        try:
+            logging.info("Starting streaming pipeline...")
+            start = time.perf_counter()
+            log_thresholds(self.analysis.settings.get('thresholds'))
+
+            downloader = None
+            if self.settings.get('download', False):
+                from src.main.download import CopernicusDataSpaceDownloader
+                downloader = CopernicusDataSpaceDownloader(self.config)
+
+            stages = self.build_stages(downloader)
+            queue_size = self.settings.get('queue_size', 4)
+            queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+            for i, stage in enumerate(stages):
+                stage.start(queues[i], queues[i + 1] if i + 1 < len(stages) else None)
+            logging.info("Stages: " + " -> ".join(f"{stage.name} ({stage.workers})" for stage in stages))
+
+            # Feed the first stage; put blocks while it is full
+            fed = 0
+            listed = True
+            try:
+                for item in self.sources(downloader):
+                    queues[0].put(item)
+                    fed += 1
+            except Exception as e:
+                logging.error(f"Product search failed after {fed} products: {str(e)}", exc_info=True)
+                listed = False
+
+            # Close the stages in order once each upstream stage has drained
+            for stage in stages:
+                stage.finish()
+
+            if self.rows:
+                write_statistics([self.rows[key] for key in sorted(self.rows)],
+                                 self.root_dir / "data" / "analysis")
+
+            logging.info(f"\nStreamed {fed} products in {time.perf_counter() - start:.1f}s")
+            for stage in stages:
+                first = f", first output after {stage.first_output:.1f}s" if stage.first_output is not None else ""
+                logging.info(f"  {stage.name}: {stage.processed} done, {stage.failed} failed, "
+                             f"{stage.busy:.1f}s busy over {stage.workers} workers{first}")
+            return listed and all(stage.failed == 0 for stage in stages)
+
+        except Exception as e:
+            logging.error(f"Streaming pipeline error: {str(e)}", exc_info=True)
+            return False
+
+def main():
+    """Run the streaming pipeline"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s'
+    )
+
+    if not StreamingPipeline(project_root).run():
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()